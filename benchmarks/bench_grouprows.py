@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Time groupRows plus setInventory on generated inventory rows (4 warehouses per sku), e.g.
+#   python benchmarks/bench_grouprows.py 10000 25000 50000 100000
+# The us/row column stays flat when the build scales linearly.
+from __future__ import print_function
+
+import sys, os, importlib.util
+from time import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "taskqueue", "common"))
+sys.path.insert(0, os.path.join(ROOT, "taskqueue", "syncproductsdata"))
+os.environ.setdefault("LOGGINGLEVEL", "logging.ERROR")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+spec = importlib.util.spec_from_file_location(
+    "syncproductsdata_tasks", os.path.join(ROOT, "taskqueue", "syncproductsdata", "tasks.py")
+)
+tasks = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tasks)
+ProductsDataSync = tasks.ProductsDataSync
+
+
+def getRows(n, warehouses=4):
+    return [
+        {
+            "sku": "SKU-{i:07d}".format(i=i // warehouses),
+            "warehouse": "WH{w}".format(w=i % warehouses),
+            "store_id": "0",
+            "qty": str(i % 17)
+        } for i in range(n)
+    ]
+
+
+def bench(n, repeat=3):
+    productsDataSync = ProductsDataSync.__new__(ProductsDataSync)
+    best = None
+    for _ in range(repeat):
+        rows = getRows(n)
+        stime = time()
+        productsDataSync.setInventory(ProductsDataSync.groupRows(rows, "sku", "warehouse"))
+        spend = time() - stime
+        best = spend if best is None else min(best, spend)
+    return best
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 25000, 50000, 100000]
+    print("{rows:>8} {secs:>8} {us:>8}".format(rows="rows", secs="secs", us="us/row"))
+    for n in sizes:
+        spend = bench(n)
+        print("{rows:>8} {secs:>8.3f} {us:>8.2f}".format(rows=n, secs=spend, us=spend / n * 1000000))
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Parse the same generated products tab as a csv and as an xlsx export and check both give the same rows, e.g.
+#   python benchmarks/bench_xlsx.py 20000
+# The exports are served from memory, so only the parse is timed.
+from __future__ import print_function
+
+import sys, os, io, importlib.util
+from datetime import datetime, timedelta
+from time import time
+from openpyxl import Workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "taskqueue", "common"))
+sys.path.insert(0, os.path.join(ROOT, "taskqueue", "syncproductsdata"))
+os.environ.setdefault("LOGGINGLEVEL", "logging.ERROR")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+spec = importlib.util.spec_from_file_location(
+    "syncproductsdata_tasks", os.path.join(ROOT, "taskqueue", "syncproductsdata", "tasks.py")
+)
+tasks = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tasks)
+ProductsDataSync = tasks.ProductsDataSync
+
+HEADER = ["SKU", "Name", "Price", "Weight", "Release Date", "Active", "Attribute Name 1", "Attribute Value 1"]
+
+
+def getExports(n):
+    # The csv lines are written the way the Google Sheets export renders the formatted cells.
+    workbook = Workbook()
+    worksheet = workbook.active
+    worksheet.title = "products"
+    worksheet.append(HEADER)
+    lines = [",".join(HEADER)]
+    for i in range(n):
+        price, weight = i % 500 + 0.5, (i % 7) / 4
+        released = datetime(2020, 1, 1) + timedelta(days=i % 365)
+        worksheet.append(["SKU-{i:07d}".format(i=i), "Product {i}".format(i=i), price, weight, released, i % 2 == 0, "Color", "C{c}".format(c=i % 9)])
+        worksheet.cell(row=worksheet.max_row, column=3).number_format = "0.00"
+        worksheet.cell(row=worksheet.max_row, column=5).number_format = "m/d/yyyy"
+        lines.append(",".join([
+            "SKU-{i:07d}".format(i=i), "Product {i}".format(i=i), "{0:.2f}".format(price),
+            str(int(weight)) if weight.is_integer() else str(weight),
+            "{d.month}/{d.day}/{d.year}".format(d=released), "TRUE" if i % 2 == 0 else "FALSE", "Color", "C{c}".format(c=i % 9)
+        ]))
+    xlsx = io.BytesIO()
+    workbook.save(xlsx)
+    return ("\r\n".join(lines) + "\r\n").encode("utf-8"), xlsx.getvalue()
+
+
+def bench(n):
+    params = {"data_type": "products", "decode": "utf-8", "source": "S"}
+    productsDataSync = ProductsDataSync(**params)
+    content, xlsx = getExports(n)
+    stime = time()
+    csvRows = list(productsDataSync.getRows(io.BytesIO(content), **params))
+    csvSecs = time() - stime
+    stime = time()
+    xlsxRows = list(productsDataSync.getRows(xlsx, export_format="xlsx", sheet_name="products", **params))
+    xlsxSecs = time() - stime
+    return len(content), csvSecs, len(xlsx), xlsxSecs, csvRows == xlsxRows
+
+
+if __name__ == "__main__":
+    sizes = [int(n) for n in sys.argv[1:]] or [20000]
+    print("{rows:>8} {csvmb:>8} {csvs:>8} {xlsxmb:>8} {xlsxs:>8} {same:>6}".format(
+        rows="rows", csvmb="csv MB", csvs="csv s", xlsxmb="xlsx MB", xlsxs="xlsx s", same="same"
+    ))
+    for n in sizes:
+        csvBytes, csvSecs, xlsxBytes, xlsxSecs, same = bench(n)
+        print("{rows:>8} {csvmb:>8.2f} {csvs:>8.2f} {xlsxmb:>8.2f} {xlsxs:>8.2f} {same!s:>6}".format(
+            rows=n, csvmb=csvBytes / 1048576, csvs=csvSecs, xlsxmb=xlsxBytes / 1048576, xlsxs=xlsxSecs, same=same
+        ))
@@ -1,12 +1,16 @@
-import requests, csv, sys, traceback, json, os, dotenv
-from io import StringIO
+import requests, csv, sys, traceback, json, os, dotenv, zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
 from decimal import Decimal
-from aws_mage2connector import Mage2Connector
-from sshtunnel import SSHTunnelForwarder
-from time import sleep
+from time import time
 from txmap import txmap
 
+# The instrumentation and the sheet parsing shared with the Lambda functions.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "taskqueue", "common"))
+from metrics import Metrics
+from mage2connection import getMage2Connection
+from sheetparser import iterLines, getColumnPlan, getRow, getProductData
+
 import logging
 logging.basicConfig(
     level=logging.INFO,
@@ -37,71 +41,81 @@ class JSONEncoder(json.JSONEncoder):
 # Mage2 From Google Sheet
 class ProductsDataSync(object):
     def __init__(self, **params):
-        self.mage2Connector = Mage2Connector(
-            setting=params.get("mage2_setting"), 
-            logger=logger
+        self.metrics = Metrics(
+            dimensions={"FunctionName": "products_data_sync_mage2_from_googlesheets"},
+            sampleRate=params.get("debug_sample_rate", 0)
         )
 
-    def getRows(self, googleSheetId, gid, decode):
+    def getRows(self, googleSheetId, gid, decode, bufferSize=65536):
         dataFeedUrl = "https://docs.google.com/spreadsheets/d/{id}/export?format=csv&id={id}&gid={gid}".format(
             id=googleSheetId,
             gid=gid
         )
 
-        s = requests.get(dataFeedUrl).content
-
-        rows = []
-        for row in csv.DictReader(StringIO(s.decode(decode))):
-            row = dict(
-                (
-                    k.lower().strip().replace(" ", "_").replace("/", "_").replace("(", "").replace(")", ""), 
-                    v.strip().split("|") if len(v.split("|")) > 1 else v.strip()
-                ) for k, v in row.items() if k is not None and (v!="" and v is not None)
+        self.columnPlan = None
+        with requests.get(dataFeedUrl, stream=True) as response:
+            for values in csv.reader(iterLines(response, decode, bufferSize=bufferSize, metrics=self.metrics)):
+                if self.columnPlan is None:
+                    self.columnPlan = getColumnPlan(values)
+                    continue
+                with self.metrics.timer("parse"):
+                    row = getRow(self.columnPlan, values)
+                if "sku" in row.keys() and row["sku"] != "---":
+                    yield {
+                        'sku': row.pop('sku'),
+                        'data': row
+                    }
+
+    def syncPartition(self, mage2Connection, slot, attributeSet, products):
+        # A writer thread on its own connection of the shared tunnel.
+        mage2Connector = mage2Connection.getConnector(slot=slot)
+        for product in products:
+            sku = product["sku"]
+            typeId = product["data"].pop("type_id", "simple")
+            storeId = product["data"].pop("store_id", "0")
+            product["data"] = dict (
+                (k, v) for k, v in dict(
+                    (
+                        k,
+                        product["data"].get(v.get("key")) if product["data"].get(v.get("key")) is not None else v.get("default")
+                    ) for k, v in txmap.items()
+                ).items() if v is not None
             )
-            if "sku" in row.keys() and row["sku"] != "---":
-                row = {
-                    'sku': row.pop('sku'),
-                    'data': row
-                }
-                rows.append(row)
-        return rows
-
-    def syncProduct(self, mage2Setting, attributeSet, products):
-        with SSHTunnelForwarder(
-            (mage2Setting['SSHSERVER'], mage2Setting['SSHSERVERPORT']),
-            ssh_username=mage2Setting['SSHUSERNAME'],
-            ssh_pkey=mage2Setting.get('SSHPKEY'),
-            ssh_password=mage2Setting.get('SSHPASSWORD'),
-            remote_bind_address=(mage2Setting['REMOTEBINDSERVER'], mage2Setting['REMOTEBINDSERVERPORT']),
-            local_bind_address=(mage2Setting['LOCALBINDSERVER'], mage2Setting['LOCALBINDSERVERPORT'])
-        ) as server:
-            sleep(2)
-            for product in products:
-                sku = product["sku"]
-                typeId = product["data"].pop("type_id", "simple")
-                storeId = product["data"].pop("store_id", "0")
-                product["data"] = dict (
-                    (k, v) for k, v in dict(
-                        (
-                            k,
-                            product["data"].get(v.get("key")) if product["data"].get(v.get("key")) is not None else v.get("default")
-                        ) for k, v in txmap.items()
-                    ).items() if v is not None
-                )
-                try:
-                    product['product_id'] = self.mage2Connector.syncProduct(sku, attributeSet, product["data"], typeId, storeId)
-                    product['sync_status'] = 'S'
-                except Exception:
-                    product['sync_status'] = 'F'
-                    product['log'] = traceback.format_exc()
-                
+            try:
+                with self.metrics.timer("mage2-write"):
+                    product['product_id'] = mage2Connector.syncProduct(sku, attributeSet, product["data"], typeId, storeId)
+                product['sync_status'] = 'S'
+                self.metrics.count("synced")
+            except Exception:
+                product['sync_status'] = 'F'
+                product['log'] = traceback.format_exc()
+                self.metrics.count("failed")
+            
+            if self.metrics.isSampled():
                 logger.info(json.dumps(
                         product, indent=4, cls=JSONEncoder, ensure_ascii=False
                     )
                 )
-            del self.mage2Connector
-            server.stop()
-            server.close()
+            self.metrics.tick()
+
+    def syncProduct(self, mage2Setting, attributeSet, products, workers=1):
+        # Opens the tunnel and waits until the database answers through it.
+        mage2Connection = getMage2Connection(mage2Setting, logger=logger)
+        try:
+            partitions = [[] for slot in range(max(workers, 1))]
+            for product in products:
+                # A sku always goes to the same writer, so no two connections touch one entity.
+                partitions[zlib.crc32(product["sku"].encode("utf-8")) % len(partitions)].append(product)
+            with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+                futures = [
+                    executor.submit(self.syncPartition, mage2Connection, slot, attributeSet, partition)
+                    for slot, partition in enumerate(partitions)
+                ]
+                for future in futures:
+                    future.result()
+            self.metrics.flush()
+        finally:
+            mage2Connection.close()
 
     @classmethod
     def dataSync(cls, **params):
@@ -111,30 +125,22 @@ class ProductsDataSync(object):
         gid = params.get('gid')
         decode = params.get('decode')
         attributeSet = params.get('attribute_set')
-
-        # Retrieve value 'attribute_value_x' by 'attribute_name_x'.
-        txFunct = lambda src: src.get(
-            list(
-                filter(lambda key: key.find('attribute_name') != -1 and src[key]==src['code'], src.keys())
-            ).pop().replace('name', 'value')
-        ) if any((k.find('attribute_name') != -1 and v == src['code'] for k,v in src.items())) else None
+        bufferSize = int(params.get('buffer_size', 65536))
 
         products = []
-        for row in productsDataSync.getRows(googleSheetId, gid, decode):
+        for row in productsDataSync.getRows(googleSheetId, gid, decode, bufferSize=bufferSize):
+            stime = time()
+            plan = productsDataSync.columnPlan
             product = {
                 'sku': row['sku'],
-                'data': {}
+                'data': getProductData(plan, row['data'])
             }
-            for k,v in row['data'].items():
-                if k.find('attribute') != -1:
-                    product['data'][
-                        v.lower().strip().replace(" ", "_").replace("/", "_").replace("(", "").replace(")", "")
-                    ] = txFunct({'code': v, **row['data']})
-                else:
-                    product['data'][k] = v
             products.append(product)
+            productsDataSync.metrics.add("transform", (time() - stime) * 1000)
 
-        productsDataSync.syncProduct(mage2Setting, attributeSet, products)
+        productsDataSync.syncProduct(
+            mage2Setting, attributeSet, products, workers=int(params.get('mage2_workers', 1))
+        )
 
 
 if __name__ == '__main__':
@@ -148,6 +154,9 @@ if __name__ == '__main__':
         'google_sheet_id': os.getenv("GOOGLESHEETID"),
         'gid': os.getenv("GID"),
         'attribute_set': os.getenv("ATTRIBUTESET"),
+        'buffer_size': os.getenv("BUFFERSIZE", "65536"),
+        'debug_sample_rate': os.getenv("DEBUGSAMPLERATE", "0"),
+        'mage2_workers': os.getenv("MAGE2WORKERS", "1"),
         'mage2_setting': {
             "SSHSERVER": os.getenv("SSHSERVER"),
             "SSHSERVERPORT": int(os.getenv("SSHSERVERPORT")),
@@ -0,0 +1,106 @@
+import boto3, sys, os, dotenv
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+# Look for a .env file
+if os.path.exists('.env'):
+    dotenv.load_dotenv('.env')
+
+
+import logging
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger()
+
+
+# One-off backfill of the sparse sync indexes for the items staged before they existed:
+# an N item gets its sku on 'pending' (pending_index) and an F item on 'failed' (failed_index),
+# due for a retry at once. Safe to run again; the items already indexed are skipped.
+class SyncIndexesBackfill(object):
+    def __init__(self, tableName, segments=4):
+        self.table = boto3.resource(
+            'dynamodb',
+            region_name=os.getenv("region_name"),
+            aws_access_key_id=os.getenv('aws_access_key_id'),
+            aws_secret_access_key=os.getenv('aws_secret_access_key')
+        ).Table(tableName)
+        self.segments = segments
+
+    def getItems(self, segment):
+        kwargs = dict(
+            Segment=segment,
+            TotalSegments=self.segments,
+            FilterExpression=(
+                (Attr('tx_status').eq('N') & Attr('pending').not_exists()) |
+                (Attr('tx_status').eq('F') & Attr('failed').not_exists())
+            ),
+            ProjectionExpression="id,sku,tx_status"
+        )
+        while True:
+            response = self.table.scan(**kwargs)
+            for item in response['Items']:
+                yield item
+            if response.get('LastEvaluatedKey') is None:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def backfillItem(self, item):
+        if item['tx_status'] == 'N':
+            updateExpression = "set pending=:val0"
+            expressionAttributeValues = {':val0': item['sku'], ':val1': 'N'}
+        else:
+            updateExpression = "set failed=:val0, retry_at=:val2, tx_attempts=if_not_exists(tx_attempts, :val3)"
+            expressionAttributeValues = {
+                ':val0': item['sku'],
+                ':val1': 'F',
+                ':val2': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                ':val3': 1
+            }
+        try:
+            # A sync or a restage since the scan wins.
+            self.table.update_item(
+                Key={'id': item['id']},
+                UpdateExpression=updateExpression,
+                ConditionExpression="tx_status=:val1",
+                ExpressionAttributeValues=expressionAttributeValues
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return item['tx_status']
+
+    def backfillSegment(self, segment):
+        counts = {'N': 0, 'F': 0}
+        for item in self.getItems(segment):
+            status = self.backfillItem(item)
+            if status is not None:
+                counts[status] += 1
+        return counts
+
+    @classmethod
+    def backfill(cls, tableName, segments=4):
+        backfill = cls(tableName, segments=segments)
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            results = list(executor.map(backfill.backfillSegment, range(segments)))
+        logger.info(
+            "{table}: {n} pending and {f} failed items backfilled.".format(
+                table=tableName,
+                n=sum(r['N'] for r in results),
+                f=sum(r['F'] for r in results)
+            )
+        )
+
+
+if __name__ == "__main__":
+    SyncIndexesBackfill.backfill(
+        sys.argv[1] if len(sys.argv) > 1 else "stg_products",
+        segments=int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    )
@@ -96,7 +96,7 @@ class CloudformationStack(object):
             )
         fzip.close()
 
-    def packAWSLambdaLayer(self, layerFile, packages, packageFiles=[], files={}):
+    def packAWSLambdaLayer(self, layerFile, packages, packageFiles=[], modules=[], files={}):
         fzip = zipfile.ZipFile(layerFile, 'w', zipfile.ZIP_DEFLATED)
         for package in packages:
             self.zip_dir(
@@ -115,6 +115,12 @@ class CloudformationStack(object):
                 ),
                 f
             )
+        # Shared modules of the project are placed at the layer root (/opt).
+        for f in modules:
+            fzip.write(
+                "{root_path}/{file}".format(root_path=os.getenv('root_path'), file=f),
+                os.path.basename(f)
+            )
         for f, path in files.items():
             fzip.write(
                 "{path}/{file}".format(path=path, file=f), f
@@ -164,6 +170,7 @@ class CloudformationStack(object):
                     layerFile,
                     layer["packages"],
                     packageFiles=layer["package_files"],
+                    modules=layer.get("modules", []),
                     files=layer["files"]
                 )
                 cf.uploadAWSS3Bucket(layerFile, os.getenv("bucket"))
@@ -210,7 +217,13 @@ class CloudformationStack(object):
                     "Value": 'true'
                 }
             ],
-            "Parameters": []
+            # The template parameters set in .env, e.g. FailedIndex=false.
+            "Parameters": [
+                {
+                    "ParameterKey": key,
+                    "ParameterValue": os.getenv(key)
+                } for key in template.get("Parameters", {}).keys() if os.getenv(key) is not None
+            ]
         }
         if cf._stackExists(stackName):
             response = cf.awsCloudformation.update_stack(**params)
@@ -26,6 +26,8 @@ lambdaConfig = {
                 "idna",
                 "aws_mage2connector",
                 "pymysql",
+                "openpyxl",
+                "et_xmlfile",
                 "asn1crypto",
                 "bcrypt",
                 "cffi",
@@ -41,6 +43,14 @@ lambdaConfig = {
                 "sshtunnel.py",
                 "_cffi_backend.cpython-37m-x86_64-linux-gnu.so"
             ],
+            "modules": [
+                "taskqueue/common/writepool.py",
+                "taskqueue/common/timebudget.py",
+                "taskqueue/common/metrics.py",
+                "taskqueue/common/mage2connection.py",
+                "taskqueue/common/metadatacache.py",
+                "taskqueue/common/sheetparser.py"
+            ],
             "files": {}
         }
     }
@@ -0,0 +1,3 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+__author__ = 'bibow'
\ No newline at end of file
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import threading, json, logging
+from aws_mage2connector import Mage2Connector
+from metadatacache import CachedMage2Connector, getMetadataCache
+from sshtunnel import SSHTunnelForwarder
+from time import sleep, time
+
+connections = {}
+connectionsLock = threading.Lock()
+
+
+class Mage2Connection(object):
+    """SSH tunnel and Mage2Connectors kept open across warm invocations; checked with a ping and reopened only on failure.
+    Each slot is its own MySQL connection through the shared tunnel, e.g. one per writer thread.
+    """
+
+    def __init__(self, setting, logger=None, readyTimeout=30, probeInterval=0.1):
+        self.setting = setting
+        self.logger = logger or logging.getLogger()
+        self.readyTimeout = readyTimeout
+        self.probeInterval = probeInterval
+        self.tunnel = None
+        self.mage2Connectors = {}
+        self.metadataCache = getMetadataCache(setting, logger=self.logger)
+        self.lock = threading.RLock()
+        self.counters = {"reuses": 0, "reconnects": 0, "tunnels": 0}
+
+    def startTunnel(self):
+        self.tunnel = SSHTunnelForwarder(
+            (self.setting['SSHSERVER'], self.setting['SSHSERVERPORT']),
+            ssh_username=self.setting['SSHUSERNAME'],
+            ssh_pkey=self.setting.get('SSHPKEY'),
+            ssh_password=self.setting.get('SSHPASSWORD'),
+            remote_bind_address=(self.setting['REMOTEBINDSERVER'], self.setting['REMOTEBINDSERVERPORT']),
+            local_bind_address=(self.setting['LOCALBINDSERVER'], self.setting['LOCALBINDSERVERPORT'])
+        )
+        self.tunnel.start()
+        self.counters["tunnels"] += 1
+        self.logger.info("Open SSH tunnel")
+
+    def stopTunnel(self):
+        if self.tunnel is not None:
+            try:
+                self.tunnel.stop()
+                self.tunnel.close()
+            except Exception:
+                pass
+            self.tunnel = None
+
+    def isTunnelUp(self):
+        if self.setting.get('SSHSERVER') is None:
+            # A direct connection, e.g. a CLI run next to the database.
+            return True
+        if self.tunnel is None or not self.tunnel.is_active:
+            return False
+        self.tunnel.check_tunnels()
+        return all(self.tunnel.tunnel_is_up.values())
+
+    @staticmethod
+    def ping(mage2Connector):
+        # A round trip through the tunnel and the MySQL connection.
+        try:
+            mage2Connector.adaptor.mySQLCursor.execute("SELECT 1")
+            mage2Connector.adaptor.mySQLCursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def waitReady(self, slot=0):
+        # The readiness probe: ping until the tunnel forwards, instead of a fixed sleep.
+        deadline = time() + self.readyTimeout
+        interval = self.probeInterval
+        while True:
+            if self.metadataCache is not None:
+                # The slots share the EAV metadata of the database.
+                mage2Connector = CachedMage2Connector(
+                    setting=self.setting, logger=self.logger, metadataCache=self.metadataCache
+                )
+            else:
+                mage2Connector = Mage2Connector(setting=self.setting, logger=self.logger)
+            if self.ping(mage2Connector):
+                self.mage2Connectors[slot] = mage2Connector
+                return mage2Connector
+            if time() >= deadline:
+                raise Exception("Mage2 DB connection is not ready in {timeout}s.".format(timeout=self.readyTimeout))
+            sleep(interval)
+            interval = min(interval * 2, 1)
+
+    def getConnector(self, slot=0):
+        with self.lock:
+            mage2Connector = self.mage2Connectors.pop(slot, None)
+            if mage2Connector is not None and self.ping(mage2Connector):
+                self.counters["reuses"] += 1
+                self.mage2Connectors[slot] = mage2Connector
+                return mage2Connector
+            if mage2Connector is not None:
+                self.counters["reconnects"] += 1
+                self.logger.info("Reopen Mage2 DB connection")
+            if not self.isTunnelUp():
+                self.stopTunnel()
+                self.startTunnel()
+            return self.waitReady(slot=slot)
+
+    def close(self):
+        with self.lock:
+            if self.metadataCache is not None:
+                self.metadataCache.flush()
+            self.mage2Connectors = {}
+            self.stopTunnel()
+
+
+def getMage2Connection(setting, logger=None):
+    # One connection per setting for the life of the container.
+    key = json.dumps(setting, sort_keys=True, default=str)
+    with connectionsLock:
+        if key not in connections.keys():
+            connections[key] = Mage2Connection(setting, logger=logger)
+        return connections[key]
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import threading, json, os, hashlib, tempfile, logging
+from aws_mage2connector import Mage2Connector
+from time import time
+
+caches = {}
+cachesLock = threading.Lock()
+
+
+class MetadataCache(object):
+    """Attribute sets, attributes and admin option ids of the Magento 2 EAV tables, preloaded once and kept in a JSON
+    file in /tmp until the TTL expires, so the next invocations of a warm container skip the metadata queries.
+    """
+
+    ENTITIESSQL = """
+        SELECT eet.entity_type_code, eas.attribute_set_name, eet.entity_type_id, eas.attribute_set_id
+        FROM eav_entity_type eet, eav_attribute_set eas
+        WHERE eet.entity_type_id = eas.entity_type_id;"""
+
+    ATTRIBUTESSQL = """
+        SELECT t2.entity_type_code, t1.attribute_code, t1.attribute_id, t2.entity_type_id, t1.backend_type, t1.frontend_input
+        FROM eav_attribute t1, eav_entity_type t2
+        WHERE t1.entity_type_id = t2.entity_type_id;"""
+
+    OPTIONSSQL = """
+        SELECT t1.attribute_id, t2.value, t2.option_id
+        FROM eav_attribute_option t1, eav_attribute_option_value t2
+        WHERE t1.option_id = t2.option_id
+        AND t2.store_id = %s;"""
+
+    def __init__(self, path, ttl=900, adminStoreId=0, logger=None):
+        self.path = path
+        self.ttl = int(ttl)
+        self.adminStoreId = adminStoreId
+        self.logger = logger or logging.getLogger()
+        self.lock = threading.RLock()
+        self.loadedAt = None
+        # The changes since the file was written; saved once by flush, not on every change.
+        self.dirty = False
+        self.entities = {}
+        self.attributes = {}
+        self.options = {}
+
+    @staticmethod
+    def getKey(*values):
+        return "/".join(str(value) for value in values)
+
+    def isExpired(self):
+        return self.loadedAt is None or time() - self.loadedAt > self.ttl
+
+    def read(self):
+        # The file of a previous invocation, if it is still fresh.
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r") as f:
+                cache = json.load(f)
+        except Exception:
+            return False
+        if time() - cache["loaded_at"] > self.ttl:
+            return False
+        self.loadedAt = cache["loaded_at"]
+        self.entities, self.attributes, self.options = cache["entities"], cache["attributes"], cache["options"]
+        return True
+
+    def save(self):
+        cache = {
+            "loaded_at": self.loadedAt,
+            "entities": self.entities,
+            "attributes": self.attributes,
+            "options": self.options
+        }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def preload(self, cursor):
+        cursor.execute(self.ENTITIESSQL)
+        self.entities = dict(
+            (
+                self.getKey(row["entity_type_code"], row["attribute_set_name"]),
+                {"entity_type_id": row["entity_type_id"], "attribute_set_id": row["attribute_set_id"]}
+            ) for row in cursor.fetchall()
+        )
+        cursor.execute(self.ATTRIBUTESSQL)
+        self.attributes = dict(
+            (
+                self.getKey(row["entity_type_code"], row["attribute_code"]),
+                dict((k, row[k]) for k in ("attribute_id", "entity_type_id", "backend_type", "frontend_input"))
+            ) for row in cursor.fetchall()
+        )
+        cursor.execute(self.OPTIONSSQL, [self.adminStoreId])
+        self.options = {}
+        for row in cursor.fetchall():
+            self.options.setdefault(str(row["attribute_id"]), {}).setdefault(str(row["value"]), row["option_id"])
+        self.loadedAt = time()
+        self.save()
+        self.logger.info("Preload Mage2 metadata: {attributes} attributes/{options} option values".format(
+                attributes=len(self.attributes), options=sum(len(v) for v in self.options.values())
+            )
+        )
+
+    def refresh(self, mage2Connector):
+        with self.lock:
+            if self.isExpired() and not self.read():
+                self.preload(mage2Connector.adaptor.mySQLCursor)
+
+    def getEntity(self, entityTypeCode, attributeSet):
+        return self.entities.get(self.getKey(entityTypeCode, attributeSet))
+
+    def setEntity(self, entityTypeCode, attributeSet, entityMetadata):
+        with self.lock:
+            self.entities[self.getKey(entityTypeCode, attributeSet)] = dict(entityMetadata)
+
+    def getAttribute(self, entityTypeCode, attributeCode):
+        return self.attributes.get(self.getKey(entityTypeCode, attributeCode))
+
+    def setAttribute(self, entityTypeCode, attributeCode, attributeMetadata):
+        with self.lock:
+            self.attributes[self.getKey(entityTypeCode, attributeCode)] = dict(attributeMetadata)
+
+    def getOptionId(self, attributeId, value):
+        return self.options.get(str(attributeId), {}).get(str(value))
+
+    def setOptionId(self, attributeId, value, optionId):
+        with self.lock:
+            self.options.setdefault(str(attributeId), {})[str(value)] = optionId
+            self.dirty = True
+
+    def invalidateOptions(self, attributeId, values):
+        # A write added or changed option values; the next lookup goes to the database.
+        with self.lock:
+            options = self.options.get(str(attributeId), {})
+            for value in values:
+                options.pop(str(value), None)
+            self.dirty = True
+
+
+class CachedMage2Connector(Mage2Connector):
+    """Mage2Connector resolving the EAV metadata through a MetadataCache; misses fall through to the database.
+    """
+
+    def __init__(self, setting=None, logger=None, metadataCache=None):
+        super(CachedMage2Connector, self).__init__(setting=setting, logger=logger)
+        self.metadataCache = metadataCache
+
+    def getEntityMetaData(self, entityTypeCode='catalog_product', attributeSet='Default'):
+        self.metadataCache.refresh(self)
+        entityMetadata = self.metadataCache.getEntity(entityTypeCode, attributeSet)
+        if entityMetadata is None:
+            entityMetadata = super(CachedMage2Connector, self).getEntityMetaData(entityTypeCode, attributeSet)
+            self.metadataCache.setEntity(entityTypeCode, attributeSet, entityMetadata)
+        return dict(entityMetadata)
+
+    def getAttributeMetadata(self, attributeCode, entityTypeCode):
+        self.metadataCache.refresh(self)
+        attributeMetadata = self.metadataCache.getAttribute(entityTypeCode, attributeCode)
+        if attributeMetadata is None:
+            (dataType, attributeMetadata) = super(CachedMage2Connector, self).getAttributeMetadata(
+                attributeCode, entityTypeCode
+            )
+            self.metadataCache.setAttribute(entityTypeCode, attributeCode, attributeMetadata)
+        return (attributeMetadata['backend_type'], dict(attributeMetadata))
+
+    def getOptionId(self, attributeId, value, adminStoreId=0):
+        if adminStoreId != self.metadataCache.adminStoreId:
+            return super(CachedMage2Connector, self).getOptionId(attributeId, value, adminStoreId=adminStoreId)
+        self.metadataCache.refresh(self)
+        optionId = self.metadataCache.getOptionId(attributeId, value)
+        if optionId is None:
+            # Not cached is not missing: the value may differ in case or be added since the preload.
+            optionId = super(CachedMage2Connector, self).getOptionId(attributeId, value, adminStoreId=adminStoreId)
+            if optionId is not None:
+                self.metadataCache.setOptionId(attributeId, value, optionId)
+        return optionId
+
+    def setAttributeOptionValues(self, attributeId, options, entityTypeCode="catalog_product", adminStoreId=0, updateExistingOption=False):
+        optionId = super(CachedMage2Connector, self).setAttributeOptionValues(
+            attributeId, options, entityTypeCode=entityTypeCode, adminStoreId=adminStoreId,
+            updateExistingOption=updateExistingOption
+        )
+        self.metadataCache.invalidateOptions(attributeId, options.values())
+        return optionId
+
+
+def getMetadataCache(setting, logger=None):
+    # One cache per Magento 2 database; METADATACACHETTL=0 turns it off.
+    ttl = int(os.environ.get("METADATACACHETTL", 900))
+    if ttl <= 0:
+        return None
+    key = hashlib.md5(
+        json.dumps([setting.get(k) for k in ("SSHSERVER", "REMOTEBINDSERVER", "MAGE2DBSERVER", "MAGE2DBPORT", "MAGE2DB")], default=str).encode("utf-8")
+    ).hexdigest()
+    with cachesLock:
+        if key not in caches.keys():
+            path = os.path.join(
+                os.environ.get("METADATACACHEDIR", tempfile.gettempdir()),
+                "mage2metadata-{key}.json".format(key=key)
+            )
+            caches[key] = MetadataCache(path, ttl=ttl, logger=logger)
+        return caches[key]
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import threading, random, json
+from contextlib import contextmanager
+from time import time
+
+
+class Metrics(object):
+    """Stage timers and counters emitted as CloudWatch embedded metric format (EMF) records, one per batch of items.
+    """
+
+    def __init__(self, namespace="GooglesheetsPIMMage2", dimensions=None, batchSize=1000, sampleRate=0, emit=None):
+        self.namespace = namespace
+        self.dimensions = dict((k, str(v)) for k, v in (dimensions or {}).items())
+        self.batchSize = max(int(batchSize), 1)
+        self.sampleRate = float(sampleRate)
+        # EMF records are only picked up as bare JSON lines on stdout.
+        self.emit = emit or (lambda record: print(json.dumps(record), flush=True))
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        self.items = 0
+
+    def add(self, stage, ms):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(ms)
+
+    @contextmanager
+    def timer(self, stage):
+        stime = time()
+        try:
+            yield
+        finally:
+            self.add(stage, (time() - stime) * 1000)
+
+    def timed(self, stage, iterable):
+        # Time every step of the iterable, e.g. each chunk of a download.
+        iterator = iter(iterable)
+        while True:
+            stime = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, (time() - stime) * 1000)
+            yield item
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def tick(self, n=1):
+        # Count the finished items; a full batch is emitted as one record.
+        with self.lock:
+            self.items += n
+            full = self.items >= self.batchSize
+        if full:
+            self.flush()
+
+    def isSampled(self):
+        # The switch for the per-entity debug logging.
+        return self.sampleRate > 0 and random.random() < self.sampleRate
+
+    def flush(self):
+        with self.lock:
+            timings, counters, items = self.timings, self.counters, self.items
+            self.reset()
+        if not (timings or counters or items):
+            return None
+
+        record = dict(self.dimensions, items=items)
+        metrics = [{"Name": "items", "Unit": "Count"}]
+        for name, n in counters.items():
+            record[name] = n
+            metrics.append({"Name": name, "Unit": "Count"})
+        for stage, values in timings.items():
+            # The latency histogram of the stage summarized by its count, sum and percentiles.
+            values = sorted(values)
+            stats = (
+                ("count", len(values), "Count"),
+                ("sum", sum(values), "Milliseconds"),
+                ("p50", values[len(values) // 2], "Milliseconds"),
+                ("p99", values[min(int(len(values) * 0.99), len(values) - 1)], "Milliseconds"),
+                ("max", values[-1], "Milliseconds")
+            )
+            for stat, value, unit in stats:
+                name = "{stage}.{stat}".format(stage=stage, stat=stat)
+                record[name] = round(value, 3)
+                metrics.append({"Name": name, "Unit": unit})
+        record["_aws"] = {
+            "Timestamp": int(time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions.keys())],
+                    "Metrics": metrics
+                }
+            ]
+        }
+        self.emit(record)
+        return record
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import codecs, re, calendar
+from datetime import datetime, date, time as dtime
+from time import time
+
+
+def iterLines(response, decode, bufferSize=65536, fingerprint=None, metrics=None, fetchStage="fetch"):
+    # Decode the chunked download incrementally and yield complete lines to the csv reader.
+    # fetchStage=None times the decode only, e.g. for an export read back from where it was downloaded to.
+    decoder = codecs.getincrementaldecoder(decode)()
+    pending = ""
+    chunks = response.iter_content(chunk_size=bufferSize)
+    if metrics is not None and fetchStage is not None:
+        chunks = metrics.timed(fetchStage, chunks)
+    for chunk in chunks:
+        stime = time()
+        if fingerprint is not None:
+            fingerprint.update(chunk)
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        if metrics is not None:
+            metrics.add("decode", (time() - stime) * 1000)
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def normalizeKey(key):
+    return key.lower().strip().replace(" ", "_").replace("/", "_").replace("(", "").replace(")", "")
+
+
+def getColumnPlan(header):
+    # Compile the header row once per sheet:
+    # normalized names, 'attribute_name_x' -> 'attribute_value_x' pairs and the pipe-split columns.
+    names = [normalizeKey(k) for k in header]
+    pairs = dict(
+        (name, name.replace('name', 'value')) for name in names if name.find('attribute_name') != -1
+    )
+    return {
+        'columns': [(i, name, name not in pairs) for i, name in enumerate(names)],
+        'pairs': pairs,
+        'values': set(name for name in names if name.find('attribute_value') != -1),
+        'codes': {}
+    }
+
+
+def getRow(plan, values):
+    row = {}
+    for i, name, split in plan['columns']:
+        if i >= len(values) or values[i] == "":
+            continue
+        v = values[i]
+        row[name] = v.strip().split("|") if split and "|" in v else v.strip()
+    return row
+
+
+def getAttributeCode(plan, value):
+    # The attribute codes repeat on every row, normalize each distinct cell once.
+    code = plan['codes'].get(value)
+    if code is None:
+        code = plan['codes'][value] = normalizeKey(value)
+    return code
+
+
+def getProductData(plan, row):
+    # The product attributes of a row; 'attribute_value_x' is stored under the code in 'attribute_name_x'.
+    data = {}
+    for k, v in row.items():
+        if k in plan['values']:
+            continue
+        elif k in plan['pairs']:
+            data[getAttributeCode(plan, v)] = row.get(plan['pairs'][k])
+        else:
+            data[k] = v
+    return data
+
+
+DATETOKENS = re.compile(r'yyyy|yy|mmmm|mmm|mm|m|dddd|ddd|dd|d|hh|h|ss|s|am/pm|a/p|"[^"]*"|\\.|.', re.IGNORECASE)
+
+
+def getFormatSection(numberFormat):
+    # The positive section of the number format without its [color] or [$-locale] tags.
+    return re.sub(r'\[[^\]]*\]', "", (numberFormat or "General").split(";")[0]).strip()
+
+
+def formatDate(value, numberFormat):
+    # Render a date/time cell by its number format, as the CSV export shows it.
+    tokens = DATETOKENS.findall(getFormatSection(numberFormat))
+    kinds = [token.lower() for token in tokens]
+    if not any(kind[0] in "ymdhs" for kind in kinds):
+        # A date without a date format, e.g. from a formula.
+        return value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, datetime) else value.isoformat()
+    twelve = any(kind in ("am/pm", "a/p") for kind in kinds)
+    parts = []
+    for i, kind in enumerate(kinds):
+        if kind in ("m", "mm"):
+            # m is the minute right after an hour or right before a second, the month otherwise.
+            before = [k for k in kinds[:i] if k[0] in "ymdhs"]
+            after = [k for k in kinds[i+1:] if k[0] in "ymdhs"]
+            minute = (len(before) > 0 and before[-1][0] == "h") or (len(after) > 0 and after[0][0] == "s")
+            number = getattr(value, "minute" if minute else "month", 0)
+            parts.append("{0:02d}".format(number) if kind == "mm" else str(number))
+        elif kind == "yyyy":
+            parts.append("{0:04d}".format(value.year))
+        elif kind == "yy":
+            parts.append("{0:02d}".format(value.year % 100))
+        elif kind == "mmmm":
+            parts.append(calendar.month_name[value.month])
+        elif kind == "mmm":
+            parts.append(calendar.month_abbr[value.month])
+        elif kind == "dddd":
+            parts.append(calendar.day_name[value.weekday()])
+        elif kind == "ddd":
+            parts.append(calendar.day_abbr[value.weekday()])
+        elif kind in ("d", "dd"):
+            parts.append("{0:02d}".format(value.day) if kind == "dd" else str(value.day))
+        elif kind in ("h", "hh"):
+            hour = getattr(value, "hour", 0)
+            hour = (hour % 12 or 12) if twelve else hour
+            parts.append("{0:02d}".format(hour) if kind == "hh" else str(hour))
+        elif kind in ("s", "ss"):
+            second = getattr(value, "second", 0)
+            parts.append("{0:02d}".format(second) if kind == "ss" else str(second))
+        elif kind in ("am/pm", "a/p"):
+            pm = getattr(value, "hour", 0) >= 12
+            parts.append(("PM" if pm else "AM") if kind == "am/pm" else ("P" if pm else "A"))
+        elif kind.startswith('"'):
+            parts.append(tokens[i][1:-1])
+        elif kind.startswith("\\"):
+            parts.append(tokens[i][1:])
+        else:
+            parts.append(tokens[i])
+    return "".join(parts)
+
+
+def formatNumber(value, numberFormat):
+    # General, fixed decimals with or without thousands separators, and percentages are rendered as the CSV export
+    # does; any other format (currency, scientific, custom text) falls back to General.
+    section = getFormatSection(numberFormat)
+    match = re.match(r'^([#,0]*)(?:\.(0+))?(%?)$', section)
+    if section.lower() == "general" or section == "" or match is None or "0" not in match.group(1):
+        if float(value).is_integer():
+            return str(int(value))
+        # The 15 significant digits of a spreadsheet number, without the float noise of repr.
+        return "{0:.15g}".format(value)
+    decimals = len(match.group(2) or "")
+    if match.group(3) == "%":
+        value = value * 100
+    return "{0:{comma}.{decimals}f}".format(
+        value, comma="," if "," in match.group(1) else "", decimals=decimals
+    ) + match.group(3)
+
+
+def getCellValue(value, numberFormat="General"):
+    # Render an xlsx cell as the CSV export does, so both export formats produce the same rows and hashes.
+    if value is None:
+        return ""
+    elif isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    elif isinstance(value, (datetime, date, dtime)):
+        return formatDate(value, numberFormat)
+    elif isinstance(value, (int, float)):
+        return formatNumber(value, numberFormat)
+    return str(value)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+from collections import deque
+
+
+class TimeBudget(object):
+    """Rolling per-stage latency estimates (EWMA and a high percentile) to hand off an invocation at the last safe point.
+    """
+
+    def __init__(self, estimates=None, alpha=0.2, percentile=0.99, window=200, minSamples=20, reserveMs=3000):
+        self.alpha = alpha
+        self.percentile = percentile
+        self.window = window
+        self.minSamples = minSamples
+        self.reserveMs = int(reserveMs)
+        # The estimates of the previous invocation, e.g. {"stage": [ewma, p99]}, seed the warm-up.
+        self.seeds = dict((stage, [float(v) for v in values]) for stage, values in (estimates or {}).items())
+        self.ewmas = dict((stage, values[0]) for stage, values in self.seeds.items())
+        self.samples = {}
+
+    def record(self, spendms):
+        # spendms: {stage: ms} of one item.
+        for stage, ms in spendms.items():
+            ewma = self.ewmas.get(stage)
+            self.ewmas[stage] = ms if ewma is None else self.alpha * ms + (1 - self.alpha) * ewma
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(ms)
+
+    def getPercentile(self, stage):
+        samples = sorted(self.samples.get(stage, []))
+        seed = self.seeds.get(stage, [0, 0])[1]
+        if len(samples) < self.minSamples:
+            # Too few samples of this invocation; keep the seeded tail unless it is already exceeded.
+            return max([seed] + samples)
+        return samples[min(int(len(samples) * self.percentile), len(samples) - 1)]
+
+    def getEstimate(self, stage):
+        return max(self.ewmas.get(stage, 0), self.getPercentile(stage))
+
+    def getRequiredMs(self):
+        # The next item through every stage plus the reserve for the hand-off itself.
+        return sum(self.getEstimate(stage) for stage in self.ewmas.keys()) + self.reserveMs
+
+    def shouldHandOff(self, remainingMs, pending):
+        return pending > 0 and remainingMs <= self.getRequiredMs()
+
+    def getEstimates(self):
+        # JSON-friendly estimates passed to the next invocation.
+        return dict(
+            (stage, [int(round(self.ewmas[stage])), int(round(self.getPercentile(stage)))])
+            for stage in self.ewmas.keys()
+        )
@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import boto3, threading, random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError
+from time import sleep, time
+
+
+class WritePool(object):
+    """Thread pool for DynamoDB writes; halves the in-flight requests on throttling and grows them back on success.
+    """
+
+    THROTTLINGERRORS = (
+        "ProvisionedThroughputExceededException",
+        "ThrottlingException",
+        "RequestLimitExceeded",
+        "TooManyRequestsException"
+    )
+
+    # Retried with the same backoff, without cutting the concurrency.
+    TRANSIENTERRORS = (
+        "InternalServerError",
+        "ServiceUnavailable"
+    )
+
+    def __init__(self, maxWorkers=8, minWorkers=1, maxRetries=8, baseDelay=0.05, maxDelay=5):
+        self.maxWorkers = max(int(maxWorkers), 1)
+        self.minWorkers = min(max(int(minWorkers), 1), self.maxWorkers)
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+        self.condition = threading.Condition()
+        self.concurrency = self.maxWorkers
+        self.inFlight = 0
+        self.successes = 0
+        self.futures = []
+        # Set on the pool threads, whose task already holds a slot.
+        self.local = threading.local()
+        self.counters = {"writes": 0, "retries": 0, "throttles": 0, "failures": 0}
+        self.startTime = time()
+
+    def acquire(self):
+        # Block the caller while the pool is at its current concurrency.
+        with self.condition:
+            while self.inFlight >= self.concurrency:
+                self.condition.wait()
+            self.inFlight += 1
+
+    def release(self):
+        with self.condition:
+            self.inFlight -= 1
+            self.condition.notify_all()
+
+    def submit(self, funct, *args, **kwargs):
+        self.acquire()
+        future = self.executor.submit(self._run, funct, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def _run(self, funct, *args, **kwargs):
+        self.local.slot = True
+        try:
+            return funct(*args, **kwargs)
+        except Exception:
+            with self.condition:
+                self.counters["failures"] += 1
+            raise
+        finally:
+            self.local.slot = False
+            self.release()
+
+    def call(self, funct, *args, **kwargs):
+        # Issue one write request, retrying throttling errors with jittered exponential backoff.
+        # A write from outside the pool threads takes a slot too, so it counts against the concurrency.
+        owned = not getattr(self.local, "slot", False)
+        if owned:
+            self.acquire()
+        try:
+            return self._call(funct, *args, **kwargs)
+        finally:
+            if owned:
+                self.release()
+
+    def _call(self, funct, *args, **kwargs):
+        retries = 0
+        while True:
+            try:
+                response = funct(*args, **kwargs)
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in self.THROTTLINGERRORS + self.TRANSIENTERRORS or retries >= self.maxRetries:
+                    raise
+                retries += 1
+                if code in self.THROTTLINGERRORS:
+                    self.throttle(retries)
+                else:
+                    self.backoff(retries)
+                continue
+            except (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError):
+                if retries >= self.maxRetries:
+                    raise
+                retries += 1
+                self.backoff(retries)
+                continue
+            with self.condition:
+                self.counters["writes"] += 1
+                self.successes += 1
+                if self.successes >= self.concurrency and self.concurrency < self.maxWorkers:
+                    self.concurrency += 1
+                    self.successes = 0
+                    self.condition.notify_all()
+            return response
+
+    def throttle(self, retries=1):
+        with self.condition:
+            self.counters["throttles"] += 1
+            self.successes = 0
+            self.concurrency = max(self.concurrency // 2, self.minWorkers)
+        self.backoff(retries)
+
+    def backoff(self, retries=1):
+        with self.condition:
+            self.counters["retries"] += 1
+        sleep(min(self.baseDelay * 2 ** retries, self.maxDelay) * random.uniform(0.5, 1))
+
+    @staticmethod
+    def getResource(serviceName="dynamodb"):
+        # The resource for the writes issued through call: botocore makes a single attempt, so every throttle
+        # reaches the pool and cuts the concurrency instead of being retried out of sight.
+        return boto3.resource(serviceName, config=Config(retries={"max_attempts": 1, "mode": "standard"}))
+
+    def wait(self):
+        # Wait for every submitted write and hand back the finished futures.
+        futures, self.futures = self.futures, []
+        wait(futures)
+        return futures
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters, concurrency=self.concurrency)
+        stats["writes_per_sec"] = round(stats["writes"] / max(time() - self.startTime, 0.001), 2)
+        return stats
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+class WriteBuffer(object):
+    """Background writer that coalesces the writes by key and hands them to a WritePool in batches, once a batch is
+    full or on a timer, so the caller never waits on the writes.
+    """
+
+    def __init__(self, writePool, funct, batchSize=25, intervalMs=1000):
+        self.writePool = writePool
+        self.funct = funct
+        self.batchSize = max(int(batchSize), 1)
+        self.interval = max(int(intervalMs), 1) / 1000.0
+        self.condition = threading.Condition()
+        # Held while a batch is handed to the pool, so a flush does not pass a batch on its way.
+        self.dispatchLock = threading.Lock()
+        self.pending = OrderedDict()
+        self.closed = False
+        self.counters = {"puts": 0, "coalesced": 0, "batches": 0}
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, key, *args):
+        with self.condition:
+            self.counters["puts"] += 1
+            if self.pending.pop(key, None) is not None:
+                # A later write of the same key replaces the pending one.
+                self.counters["coalesced"] += 1
+            self.pending[key] = args
+            if len(self.pending) >= self.batchSize:
+                self.condition.notify_all()
+
+    def take(self):
+        with self.condition:
+            batch, self.pending = list(self.pending.values()), OrderedDict()
+        return batch
+
+    def dispatch(self):
+        with self.dispatchLock:
+            batch = self.take()
+            for args in batch:
+                self.writePool.submit(self.funct, *args)
+            if len(batch) > 0:
+                with self.condition:
+                    self.counters["batches"] += 1
+
+    def run(self):
+        while True:
+            with self.condition:
+                deadline = time() + self.interval
+                while not self.closed and len(self.pending) < self.batchSize and time() < deadline:
+                    self.condition.wait(deadline - time())
+                if self.closed:
+                    return
+            self.dispatch()
+
+    def flush(self):
+        # Hand over whatever is pending and wait for every write, e.g. before a hand-off.
+        self.dispatch()
+        return self.writePool.wait()
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counters, pending=len(self.pending))
+
+    def close(self):
+        futures = self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        return futures
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import boto3, os, json, shutil
+from decimal import Decimal
+from datetime import datetime, date
+from botocore.exceptions import ClientError
+
+
+# Helper class to convert a snapshot to JSON.
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):   # pylint: disable=E0202
+        if isinstance(o, Decimal):
+            if o % 1 > 0:
+                return float(o)
+            else:
+                return int(o)
+        elif isinstance(o, (datetime, date)):
+            return o.strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(o, (bytes, bytearray)):
+            return str(o)
+        else:
+            return super(JSONEncoder, self).default(o)
+
+
+class SnapshotStore(object):
+    """Key/value store for the sheet snapshots; the value is a JSON document.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def getFile(self, key, path):
+        # Copy the stored file to the path; False when there is none.
+        raise NotImplementedError
+
+    def putFile(self, key, path):
+        raise NotImplementedError
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, cls=JSONEncoder, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def loads(s):
+        return json.loads(s, parse_float=Decimal)
+
+
+class S3SnapshotStore(SnapshotStore):
+    def __init__(self, bucket, prefix="googlesheets_pim_mage2"):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = boto3.client('s3')
+
+    def get(self, key):
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket, Key="{prefix}/{key}".format(prefix=self.prefix, key=key)
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return self.loads(response["Body"].read())
+
+    def put(self, key, value):
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key="{prefix}/{key}".format(prefix=self.prefix, key=key),
+            Body=self.dumps(value)
+        )
+
+    def getFile(self, key, path):
+        try:
+            self.s3.download_file(self.bucket, "{prefix}/{key}".format(prefix=self.prefix, key=key), path)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+        return True
+
+    def putFile(self, key, path):
+        self.s3.upload_file(path, self.bucket, "{prefix}/{key}".format(prefix=self.prefix, key=key))
+
+
+class LocalSnapshotStore(SnapshotStore):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return self.loads(f.read())
+
+    def put(self, key, value):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write aside and rename so a reader never sees a partial snapshot.
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.dumps(value))
+        os.replace(path + ".tmp", path)
+
+    def getFile(self, key, path):
+        source = os.path.join(self.directory, key)
+        if not os.path.exists(source):
+            return False
+        shutil.copyfile(source, path)
+        return True
+
+    def putFile(self, key, path):
+        target = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+
+def getSnapshotStore():
+    # S3 in the Lambda, a local directory for testing; no store disables the snapshot cache.
+    if os.environ.get("SNAPSHOTBUCKET"):
+        return S3SnapshotStore(os.environ["SNAPSHOTBUCKET"])
+    elif os.environ.get("SNAPSHOTDIR"):
+        return LocalSnapshotStore(os.environ["SNAPSHOTDIR"])
+    return None
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+import sqlite3, os, json, tempfile
+from decimal import Decimal
+from snapshotstore import JSONEncoder
+
+
+class SpillStore(object):
+    """SQLite file in /tmp holding the parsed rows of a sheet; they are grouped and sorted there and streamed back out.
+    """
+
+    def __init__(self, path=None, directory=None, batchSize=1000):
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".sqlite", dir=directory)
+            os.close(fd)
+        self.path = path
+        self.batchSize = batchSize
+        self.keys = None
+        # The tabs spill in worker threads and are staged from the main thread, one at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("pragma journal_mode=off")
+        self.connection.execute("pragma synchronous=off")
+        self.connection.execute("create table if not exists rows (seq integer primary key, k1 text, row text)")
+        self.connection.execute(
+            "create table if not exists results ("
+            "sku text primary key, data text, removed integer default 0, selected integer default 1)"
+        )
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, cls=JSONEncoder, ensure_ascii=False)
+
+    @staticmethod
+    def loads(s):
+        return json.loads(s, parse_float=Decimal)
+
+    def addRows(self, rows, *keys):
+        # Spill the parsed rows in batches; the keys are the grouping of groupRows, e.g. ("sku", "warehouse").
+        self.keys = keys
+        batch = []
+        for row in rows:
+            batch.append((row.get(keys[0]), self.dumps(row)))
+            if len(batch) >= self.batchSize:
+                self.connection.executemany("insert into rows (k1, row) values (?, ?)", batch)
+                batch = []
+        self.connection.executemany("insert into rows (k1, row) values (?, ?)", batch)
+        self.connection.execute("create index if not exists rows_k1 on rows (k1, seq)")
+        self.connection.commit()
+
+    def iterGroups(self):
+        # One sku at a time in sku order, shaped like a groupRows entry, e.g. {warehouse: [row, ...]}.
+        current, group = None, None
+        for (row,) in self.connection.execute("select row from rows order by k1, seq"):
+            row = self.loads(row)
+            if group is not None and row.get(self.keys[0]) != current:
+                yield current, group
+                group = None
+            if group is None:
+                current, group = row.get(self.keys[0]), ({} if len(self.keys) > 1 else [])
+            if len(self.keys) > 1:
+                # Rows come in sheet order within the sku, so the inner keys keep their first-seen order.
+                group.setdefault(row.get(self.keys[1]), []).append(row)
+            else:
+                group.append(row)
+        if group is not None:
+            yield current, group
+
+    def addResults(self, rows):
+        batch = [(row["sku"], self.dumps(row["data"])) for row in rows]
+        self.connection.executemany("insert or replace into results (sku, data) values (?, ?)", batch)
+
+    def getResults(self):
+        self.connection.execute("delete from rows")
+        self.connection.commit()
+        return SpilledRows(self)
+
+    def close(self):
+        self.connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SpilledRows(object):
+    """The built rows of a spill store read back in sku order; supports len() and iteration like the row list.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.connection.execute("select count(*) from results where selected = 1").fetchone()[0]
+
+    def __iter__(self):
+        cursor = self.store.connection.execute(
+            "select sku, data from results where selected = 1 order by removed, sku"
+        )
+        for sku, data in cursor:
+            yield {"sku": sku, "data": self.store.loads(data) if data is not None else None}
+
+    def select(self, skus, removed):
+        # Keep the changed skus and add the removed ones after them, as the delta of the row list does.
+        connection = self.store.connection
+        connection.execute("update results set selected = 0")
+        connection.executemany("update results set selected = 1 where sku = ?", ((sku,) for sku in skus))
+        connection.executemany(
+            "insert or replace into results (sku, data, removed, selected) values (?, null, 1, 1)",
+            ((sku,) for sku in removed)
+        )
+        connection.commit()
+        return self
@@ -6,12 +6,23 @@ __author__ = 'bibow'
 import sys
 sys.path.append('/opt')
 
-import boto3, requests, os, traceback, json, csv, uuid
-from io import StringIO
+import boto3, requests, os, traceback, json, csv, uuid, hashlib, copy, io, threading, itertools, tempfile
 from boto3.dynamodb.conditions import Key, Attr
 from datetime import datetime, timedelta, date
 from time import sleep, time
 from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from snapshotstore import getSnapshotStore
+from spillstore import SpillStore, SpilledRows
+from writepool import WritePool
+from timebudget import TimeBudget
+from metrics import Metrics
+from sheetparser import iterLines, getColumnPlan, getRow, getProductData, getCellValue
+
+try:
+    from openpyxl import load_workbook
+except ImportError:  # Only needed for the xlsx export.
+    load_workbook = None
 
 import logging
 logger = logging.getLogger()
@@ -38,6 +49,17 @@ class JSONEncoder(json.JSONEncoder):
 class ProductsDataSync(object):
     def __init__(self, **params):
         self.dynamodb = boto3.resource('dynamodb')
+        self.writePool = WritePool(
+            maxWorkers=int(params.get("write_concurrency", os.environ.get("WRITECONCURRENCY", 8)))
+        )
+        # The staging writes go through the pool, which owns their retries.
+        self.writeDynamodb = self.writePool.getResource()
+        self.workbooks = {}
+        self.workbookLock = threading.Lock()
+        self.metrics = Metrics(
+            dimensions={"FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "syncproductsdata_task")},
+            sampleRate=params.get("debug_sample_rate", os.environ.get("DEBUGSAMPLERATE", 0))
+        )
 
     @classmethod
     def invoke(cls, functionName, payload, invocationType="Event"):
@@ -53,30 +75,26 @@ class ProductsDataSync(object):
         if invocationType == "RequestResponse":
             return json.loads(response['Payload'].read())
 
-    def setProducts(self, rows):
-        try:
-            # Retrieve value 'attribute_value_x' by 'attribute_name_x'.
-            txFunct = lambda src: src.get(
-                list(
-                    filter(lambda key: key.find('attribute_name') != -1 and src[key]==src['code'], src.keys())
-                ).pop().replace('name', 'value')
-            ) if any((k.find('attribute_name') != -1 and v == src['code'] for k,v in src.items())) else None
+    @staticmethod
+    def groupRows(rows, *keys):
+        # Bucket the rows by the keys in one pass, e.g. {sku: {warehouse: [row, ...]}}.
+        groups = {}
+        for row in rows:
+            group = groups
+            for key in keys[:-1]:
+                group = group.setdefault(row.get(key), {})
+            group.setdefault(row.get(keys[-1]), []).append(row)
+        return groups
 
+    def setProducts(self, groups, plan):
+        try:
             products = []
-            for row in rows:
+            for _rows in groups.values():
+                row = _rows[-1]
                 product = {
                     'sku': row.pop('sku'),
-                    'data': {}
+                    'data': getProductData(plan, row)
                 }
-                for k,v in row.items():
-                    if k.find('attribute_value') != -1:
-                        continue
-                    elif k.find('attribute_name') != -1:
-                        product['data'][
-                            v.lower().strip().replace(" ", "_").replace("/", "_").replace("(", "").replace(")", "")
-                        ] = txFunct({'code': v, **row})
-                    else:
-                        product['data'][k] = v
                 product['data'] = dict(
                     (k, v) for k, v in product['data'].items() if v is not None
                 )
@@ -87,15 +105,13 @@ class ProductsDataSync(object):
             logger.exception(log)
             raise
 
-    def setInventory(self, rows):
+    def setInventory(self, groups):
         try:
             productsExtData = []
-            metaData = dict((k, list(set(map(lambda d: d[k], rows)))) for k in ['sku', 'warehouse'])
-            for sku in metaData["sku"]:
+            for sku, warehouses in groups.items():
                 inventories = []
-                for warehouse in metaData["warehouse"]:
-                    _rows = list(filter(lambda t: (t["sku"]==sku and t["warehouse"]==warehouse), rows))
-                    row = _rows.pop()
+                for warehouse, _rows in warehouses.items():
+                    row = _rows[-1]
                     storeId = row.get("store_id", 0)
                     full = True if row.get("full") == "TRUE" else False
 
@@ -122,12 +138,10 @@ class ProductsDataSync(object):
             logger.exception(log)
             raise
 
-    def setImageGallery(self, rows):
+    def setImageGallery(self, groups):
         try:
             productsExtData = []
-            metaData = dict((k, list(set(map(lambda d: d[k], rows)))) for k in ['sku'])
-            for sku in metaData["sku"]:
-                _rows = list(filter(lambda t: (t["sku"]==sku), rows))
+            for sku, _rows in groups.items():
                 imageGallery = {
                     "media_gallery": [
                         dict(
@@ -159,16 +173,14 @@ class ProductsDataSync(object):
             logger.exception(log)
             raise
 
-    def setVariants(self, rows):
+    def setVariants(self, groups):
         try:
             productsExtData = []
-            metaData = dict((k, list(set(map(lambda d: d[k], rows)))) for k in ['sku'])
-            for sku in metaData["sku"]:
+            for sku, _rows in groups.items():
                 data = {
                     "variants": []
                 }
-                _rows = list(filter(lambda t: (t["sku"]==sku), rows))
-                
+
                 while _rows:
                     row = _rows.pop()
                     sku = row.pop("sku")
@@ -195,14 +207,12 @@ class ProductsDataSync(object):
             logger.exception(log)
             raise
 
-    def setCustomOption(self, rows):
+    def setCustomOption(self, groups):
         try:
             productsExtData = []
-            metaData = dict((k, list(set(map(lambda d: d[k], rows)))) for k in ['sku', 'title'])
-            for sku in metaData["sku"]:
+            for sku, titles in groups.items():
                 options = []
-                for title in metaData["title"]:
-                    _rows = list(filter(lambda t: t.get("sku")==sku and t.get("title")==title, rows))
+                for _rows in titles.values():
                     option = {}
 
                     while _rows:
@@ -269,139 +279,695 @@ class ProductsDataSync(object):
             raise
 
     def getItems(self, tableName, source):
+        # Index the staged items by sku with only the keys needed for change detection and rewrites.
         response = self.dynamodb.Table(tableName).query(
             IndexName="updated_at_index",
             KeyConditionExpression=Key('source').eq(source),
-            ProjectionExpression="id,sku,#data",
-            ExpressionAttributeNames={"#data": "data"}
+            ProjectionExpression="id,sku,data_hash,created_at"
         )
-        items = response['Items']
+        items = dict((item["sku"], item) for item in response['Items'])
         while 'LastEvaluatedKey' in response:
             response = self.dynamodb.Table(tableName).query(
                 IndexName="updated_at_index",
                 KeyConditionExpression=Key('source').eq(source),
-                ProjectionExpression="id,sku,#data",
-                ExpressionAttributeNames={"#data": "data"},
+                ProjectionExpression="id,sku,data_hash,created_at",
                 ExclusiveStartKey=response['LastEvaluatedKey']
             )
-            items.extend(response['Items'])
-        items = [item for item in sorted(items, key=lambda item: item["sku"])]
+            items.update((item["sku"], item) for item in response['Items'])
         return items
 
-    def putItem(self, tableName, source=None, sku=None, data=None):
-        table = self.dynamodb.Table(tableName)
+    @staticmethod
+    def getDataHash(data, dataType=None):
+        # Canonical content hash of the data with the same equality rules as the previous field comparison.
+        txFunct = lambda x: json.dumps(x, cls=JSONEncoder, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        if dataType == "inventory":
+            data = sorted(
+                txFunct({"store_id": i["store_id"], "warehouse": i["warehouse"], "qty": i["qty"]}) for i in data
+            )
+        elif dataType == "customoption":
+            data = sorted(data, key=txFunct)
+        return hashlib.sha256(txFunct(data).encode("utf-8")).hexdigest()
+
+    def getEntity(self, tableName, source=None, sku=None, data=None, dataHash=None, item=None):
         createdAt = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         updatedAt = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         _id = uuid.uuid1().int>>64
 
-        response = table.query(
-            IndexName="sku_index",
-            KeyConditionExpression=Key("sku").eq(sku),
-            FilterExpression=Attr('source').eq(source)
-        )
+        # Only a sku missing from the loaded index costs a sku_index lookup.
+        if item is None:
+            response = self.dynamodb.Table(tableName).query(
+                IndexName="sku_index",
+                KeyConditionExpression=Key("sku").eq(sku),
+                FilterExpression=Attr('source').eq(source)
+            )
+            if response['Count'] != 0:
+                item = response["Items"][0]
 
-        if response['Count'] != 0:
-            item = response["Items"][0]
+        if item is not None:
             createdAt = item["created_at"]
             _id = item["id"]
 
-        entity = {
+        return {
             "id": _id,
             "source": source,
             "sku": sku,
             "data": data,
+            "data_hash": dataHash if dataHash is not None else self.getDataHash(data),
             "created_at": createdAt,
             "updated_at": updatedAt,
             "tx_status": "N",
-            "tx_note": "GOOGLESHEETS->STG"
+            "tx_note": "GOOGLESHEETS->STG",
+            # Only the pending items carry it, so they alone are in the sparse pending_index.
+            "pending": sku
         }
+
+    def writeItem(self, tableName, entity):
+        table = self.writeDynamodb.Table(tableName)
         try:
-            table.put_item(Item=entity)
+            self.writePool.call(table.put_item, Item=entity)
             return entity
         except Exception:
             entity["data"] = {}
+            entity["data_hash"] = None
             entity["tx_status"] = "F"
             entity["tx_note"] = traceback.format_exc()
-            table.put_item(Item=entity)
+            entity.pop("pending", None)
+            self.writePool.call(table.put_item, Item=entity)
             raise
 
+    def putItem(self, tableName, source=None, sku=None, data=None, dataHash=None, item=None):
+        entity = self.getEntity(tableName, source=source, sku=sku, data=data, dataHash=dataHash, item=item)
+        return self.writeItem(tableName, entity)
+
+    def putItems(self, tableName, entities):
+        # Queue the entities on the write pool as BatchWriteItem requests of 25.
+        return [
+            self.writePool.submit(self.batchWriteItems, tableName, entities[i:i+25])
+            for i in range(0, len(entities), 25)
+        ]
+
+    def batchWriteItems(self, tableName, entities, maxRetries=5):
+        with self.metrics.timer("stage-write"):
+            failed = self._batchWriteItems(tableName, entities, maxRetries=maxRetries)
+        self.metrics.count("staged", len(entities) - len(failed))
+        self.metrics.count("failed", len(failed))
+        return failed
+
+    def _batchWriteItems(self, tableName, entities, maxRetries=5):
+        # Write one batch and return the entities that failed.
+        failed = []
+        pending = dict((entity["id"], entity) for entity in entities)
+        retries = 0
+        try:
+            while pending:
+                response = self.writePool.call(
+                    self.writeDynamodb.batch_write_item,
+                    RequestItems={
+                        tableName: [{"PutRequest": {"Item": entity}} for entity in pending.values()]
+                    }
+                )
+                unprocessed = response.get("UnprocessedItems", {}).get(tableName, [])
+                pending = dict(
+                    (request["PutRequest"]["Item"]["id"], pending[request["PutRequest"]["Item"]["id"]])
+                    for request in unprocessed
+                )
+                if pending:
+                    retries += 1
+                    assert retries <= maxRetries, "Over the limit of retries for unprocessed items."
+                    self.writePool.throttle(retries)
+        except Exception:
+            log = traceback.format_exc()
+            logger.exception(log)
+            # Fall back to single writes so every entity keeps its own tx_status/tx_note.
+            for entity in pending.values():
+                try:
+                    self.writeItem(tableName, entity)
+                except Exception:
+                    log = traceback.format_exc()
+                    logger.exception(log)
+                    failed.append(entity)
+        return failed
+
+    def removeItem(self, tableName, source=None, sku=None, item=None):
+        # Flag a sku dropped from the sheet; it is not pushed to Magento and is restaged if it comes back.
+        table = self.dynamodb.Table(tableName)
+        if item is not None:
+            items = [item]
+        else:
+            items = table.query(
+                IndexName="sku_index",
+                KeyConditionExpression=Key("sku").eq(sku),
+                FilterExpression=Attr('source').eq(source)
+            )["Items"]
+        for item in items:
+            with self.metrics.timer("stage-write"):
+                self.writePool.call(
+                    self.writeDynamodb.Table(tableName).update_item,
+                    Key={
+                        'id': item['id']
+                    },
+                    UpdateExpression="set updated_at=:val0, tx_status=:val1, tx_note=:val2 remove data_hash, pending, failed, retry_at",
+                    ExpressionAttributeValues={
+                        ':val0': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+                        ':val1': "R",
+                        ':val2': "GOOGLESHEETS->STG: removed from the sheet"
+                    }
+                )
+            self.metrics.count("removed")
+
+    @staticmethod
+    def getStock(data):
+        # The [store_id, warehouse, qty] entries of an inventory in their staged order.
+        return [[str(i["store_id"]), i["warehouse"], str(i["qty"])] for i in data]
+
+    def getStockChanges(self, previous, data):
+        # The positions of the entries whose qty changed; None when the entries themselves changed.
+        current = self.getStock(data)
+        if [entry[:2] for entry in previous] != [entry[:2] for entry in current]:
+            return None
+        positions = [
+            i for i, (before, after) in enumerate(zip(previous, current)) if Decimal(before[2]) != Decimal(after[2])
+        ]
+        return positions if positions else None
+
+    def updateStock(self, tableName, entity, positions, previousHash):
+        # Write only the changed quantities of an inventory item and the store_ids to push to Magento.
+        # The item must still hold the entries they were diffed against; otherwise it is written in full.
+        values = {
+            ":val0": entity["updated_at"],
+            ":val1": "N",
+            ":val2": "GOOGLESHEETS->STG: stock",
+            ":val3": entity["data_hash"],
+            ":val4": set(str(entity["data"][i]["store_id"]) for i in positions),
+            ":val5": previousHash,
+            ":val6": entity["sku"],
+            ":val7": "S"
+        }
+        # The entries and their data_hash are updated together, so the item stays as writeItem would write it.
+        updates = ["updated_at=:val0", "tx_status=:val1", "tx_note=:val2", "data_hash=:val3", "pending=:val6"]
+        # Only a synced item, or one whose pending push is a stock push itself, is narrowed down to the changed
+        # stores; a full push still pending, failed or dead-lettered has no stock_store_ids and is written in full.
+        conditions = ["data_hash=:val5", "(tx_status=:val7 or attribute_exists(stock_store_ids))"]
+        for i in positions:
+            inventory = entity["data"][i]
+            for k in ("qty", "on_hand", "full", "in_stock"):
+                values[":{k}{i}".format(k=k, i=i)] = inventory[k]
+                updates.append("#data[{i}].{k}=:{k}{i}".format(k=k, i=i))
+            for k in ("store_id", "warehouse"):
+                values[":{k}{i}".format(k=k, i=i)] = inventory[k]
+                conditions.append("#data[{i}].{k}=:{k}{i}".format(k=k, i=i))
+        try:
+            with self.metrics.timer("stage-write"):
+                self.writePool.call(
+                    self.writeDynamodb.Table(tableName).update_item,
+                    Key={
+                        'id': entity['id']
+                    },
+                    # Staged again, so a failed item starts over with its retries.
+                    UpdateExpression="set {updates} add stock_store_ids :val4 remove failed, retry_at, tx_attempts".format(
+                        updates=", ".join(updates)
+                    ),
+                    ConditionExpression=" and ".join(conditions),
+                    ExpressionAttributeNames={"#data": "data"},
+                    ExpressionAttributeValues=values
+                )
+            self.metrics.count("stock_updated")
+            return []
+        except Exception:
+            log = traceback.format_exc()
+            logger.info(log)
+        try:
+            with self.metrics.timer("stage-write"):
+                self.writeItem(tableName, entity)
+            self.metrics.count("staged")
+            return []
+        except Exception:
+            log = traceback.format_exc()
+            logger.exception(log)
+            self.metrics.count("failed")
+            return [entity]
+
+    def getChanges(self, offset=0, **params):
+        # Work out what to stage; None when the export is unchanged since the last sync.
+        dataFeedUrl = params.get("data_feed_url")
+        if dataFeedUrl is None:
+            dataFeedUrl = self.getDataFeedUrl(**params)
+        logger.info("Data Feed URL: {datafeedurl}".format(datafeedurl=dataFeedUrl))
+        export = self.getExport(dataFeedUrl, **params)
+
+        # Skip the parse and the staging table entirely when the export is byte for byte the last synced one.
+        snapshotStore = getSnapshotStore()
+        snapshot = snapshotStore.get(self.getSnapshotKey(**params)) if snapshotStore is not None else None
+        if snapshot is not None and offset == 0 and snapshot["fingerprint"] == self.fingerprint:
+            logger.info("Data feed is unchanged since the last sync: {fingerprint}".format(
+                    fingerprint=snapshot["fingerprint"]
+                )
+            )
+            if hasattr(export, "close"):
+                export.close()
+            return None
+
+        rows, total = self.getDataSet(export, **params)
+        with self.metrics.timer("diff"):
+            return self.getDiff(rows, snapshot, **params)
+
+    def getDiff(self, rows, snapshot, **params):
+        # One pass over the rows, which may be streamed back from a spill store.
+        hashes, stock, removedHashes = {}, {}, {}
+        for row in rows:
+            hashes[row["sku"]] = self.getDataHash(row["data"], params.get("data_type"))
+            if params.get("data_type") == "inventory":
+                # An inventory keeps its entries in the snapshot for the stock fast path.
+                stock.setdefault("stock", {})[row["sku"]] = self.getStock(row["data"])
+
+        if snapshot is not None and snapshot.get("hashes") is not None:
+            # Diff against the per-sku hashes of the last synced export; only the delta is staged.
+            delta = True
+            previous = snapshot["hashes"]
+            items = dict(
+                (sku, {"id": _id, "created_at": createdAt})
+                for sku, (_id, createdAt) in snapshot.get("ids", {}).items()
+            )
+            removed = sorted(set(previous.keys()) - set(hashes.keys()))
+            changed = [sku for sku, dataHash in hashes.items() if previous.get(sku) != dataHash]
+            if isinstance(rows, SpilledRows):
+                rows = rows.select(changed, removed)
+            else:
+                rows = [row for row in rows if previous.get(row["sku"]) != hashes[row["sku"]]]
+                rows.extend({"sku": sku, "data": None} for sku in removed)
+            # Kept for a failed removal, so the sku stays in the snapshot and is removed again next time.
+            removedHashes = dict((sku, previous[sku]) for sku in removed)
+            if params.get("data_type") == "inventory":
+                # The previous entries of the changed skus for the stock fast path.
+                previousStock = snapshot.get("stock", {})
+                stock["previous"] = dict(
+                    (sku, {"data_hash": previous[sku], "stock": previousStock[sku]})
+                    for sku in changed if previous.get(sku) is not None and sku in previousStock
+                )
+            logger.info("Changed/Removed: {changed}/{removed}".format(
+                    changed=len(changed), removed=len(removed)
+                )
+            )
+        else:
+            delta = False
+            items = self.getItems(params.get("table_name"), params.get("source"))
+
+        changes = {
+            "rows": rows,
+            "hashes": hashes,
+            "items": items,
+            "removed": removedHashes,
+            "delta": delta,
+            "fingerprint": self.fingerprint
+        }
+        changes.update(stock)
+        return changes
+
+    def getSnapshot(self, hashes, items, fingerprint, stock=None, complete=True):
+        # A run with a failed write or removal keeps no fingerprint, so the same export is diffed again.
+        if not complete or any(dataHash is None for dataHash in hashes.values()):
+            fingerprint = None
+        snapshot = {
+            "fingerprint": fingerprint,
+            "hashes": hashes,
+            "ids": dict(
+                (sku, [item["id"], item["created_at"]])
+                for sku, item in items.items() if hashes.get(sku) is not None
+            )
+        }
+        if stock is not None:
+            snapshot["stock"] = dict((sku, entries) for sku, entries in stock.items() if hashes.get(sku) is not None)
+        return snapshot
+
+    @staticmethod
+    def getEvent(params, *keys):
+        # The event without the keys of this invocation's position (time_interval is set by the handler).
+        return dict((k, v) for k, v in params.items() if k not in ("time_interval",) + keys)
+
+    @classmethod
+    def dispatchShards(cls, functionName, **params):
+        # Coordinator: parse and diff the sheet once, then stage contiguous sku ranges in parallel workers.
+        productsDataSync = cls(**params)
+        snapshotStore = getSnapshotStore()
+        assert snapshotStore is not None, "Sharding requires SNAPSHOTBUCKET or SNAPSHOTDIR."
+        assert params.get("tabs") is None, "Sharding is for a single tab."
+
+        changes = productsDataSync.getChanges(**params)
+        if changes is None:
+            productsDataSync.metrics.flush()
+            return 0
+        hashes, items = changes["hashes"], changes["items"]
+        rows = [
+            row for row in changes["rows"]
+            if changes["delta"] or items.get(row["sku"]) is None or \
+                items[row["sku"]].get("data_hash") != hashes[row["sku"]]
+        ]
+        if isinstance(changes["rows"], SpilledRows):
+            changes["rows"].store.close()
+
+        runId = params.get("run_id", uuid.uuid4().hex)
+        shards = max(min(int(params.get("shards")), len(rows)), 1)
+        size = max(-(-len(rows) // shards), 1)
+        snapshotStore.put(
+            "runs/{run_id}/snapshot.json".format(run_id=runId),
+            productsDataSync.getSnapshot(hashes, items, changes["fingerprint"], stock=changes.get("stock"))
+        )
+        for shard in range(shards):
+            _rows = rows[shard*size:(shard+1)*size]
+            snapshotStore.put(
+                "runs/{run_id}/shard-{shard}.json".format(run_id=runId, shard=shard),
+                {
+                    "rows": _rows,
+                    # A removed sku has no hash; it is only merged back if its removal fails.
+                    "hashes": dict((row["sku"], hashes[row["sku"]]) for row in _rows if row["sku"] in hashes),
+                    "items": dict((row["sku"], items[row["sku"]]) for row in _rows if row["sku"] in items),
+                    "removed": dict(
+                        (row["sku"], changes["removed"][row["sku"]])
+                        for row in _rows if row["sku"] in changes.get("removed", {})
+                    ),
+                    "previous": dict(
+                        (row["sku"], changes["previous"][row["sku"]])
+                        for row in _rows if row["sku"] in changes.get("previous", {})
+                    )
+                }
+            )
+        productsDataSync.dynamodb.Table(os.environ.get("RUNSTABLENAME", "stg_runs")).put_item(
+            Item={
+                "run_id": runId,
+                "shards": shards,
+                "created_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            }
+        )
+        for shard in range(shards):
+            cls.invoke(
+                functionName,
+                dict(
+                    productsDataSync.getEvent(params, "offset", "loop"),
+                    **{"run_id": runId, "shard": str(shard), "shards": str(shards)}
+                )
+            )
+        logger.info("Run/Shards/Rows: {run_id}/{shards}/{rows}".format(run_id=runId, shards=shards, rows=len(rows)))
+        productsDataSync.metrics.flush()
+        return shards
+
+    def getShard(self, **params):
+        snapshotStore = getSnapshotStore()
+        shard = snapshotStore.get(
+            "runs/{run_id}/shard-{shard}.json".format(run_id=params["run_id"], shard=params["shard"])
+        )
+        return {
+            "rows": shard["rows"],
+            "hashes": shard["hashes"],
+            "items": shard["items"],
+            "previous": shard.get("previous", {}),
+            "removed": shard.get("removed", {}),
+            "delta": True,
+            "fingerprint": None
+        }
+
+    def getCheckpointKey(self, **params):
+        return "runs/{run_id}/checkpoint-{shard}.json".format(
+            run_id=params["run_id"], shard=params.get("shard", "0")
+        )
+
+    def putCheckpoint(self, changes, **params):
+        # Spilled rows are checkpointed as their SQLite files next to the JSON document.
+        snapshotStore = getSnapshotStore()
+        key = self.getCheckpointKey(**params)
+        checkpoint = []
+        for i, _changes in enumerate(changes):
+            if _changes is not None and isinstance(_changes["rows"], SpilledRows):
+                spillKey = key.replace(".json", "-{i}.sqlite".format(i=i))
+                _changes["rows"].store.connection.commit()
+                snapshotStore.putFile(spillKey, _changes["rows"].store.path)
+                _changes = dict(_changes, rows={"spill": spillKey})
+            checkpoint.append(_changes)
+        snapshotStore.put(key, checkpoint)
+
+    def getCheckpoint(self, **params):
+        snapshotStore = getSnapshotStore()
+        changes = snapshotStore.get(self.getCheckpointKey(**params))
+        for _changes in changes or []:
+            if _changes is not None and isinstance(_changes["rows"], dict):
+                fd, path = tempfile.mkstemp(suffix=".sqlite", dir=os.environ.get("SPILLDIR"))
+                os.close(fd)
+                snapshotStore.getFile(_changes["rows"]["spill"], path)
+                _changes["rows"] = SpilledRows(SpillStore(path=path))
+        return changes
+
+    def completeShard(self, hashes, items, complete=True, **params):
+        # Record the shard result; True only for the last shard of the run to finish.
+        snapshotStore = getSnapshotStore()
+        snapshotStore.put(
+            "runs/{run_id}/shard-{shard}.done.json".format(run_id=params["run_id"], shard=params["shard"]),
+            dict(self.getSnapshot(hashes, items, None), complete=complete)
+        )
+        # A set of the shard numbers, so a retried shard is counted once.
+        response = self.dynamodb.Table(os.environ.get("RUNSTABLENAME", "stg_runs")).update_item(
+            Key={
+                "run_id": params["run_id"]
+            },
+            UpdateExpression="add completed_shards :val0",
+            ExpressionAttributeValues={
+                ":val0": set([str(params["shard"])])
+            },
+            ReturnValues="ALL_NEW"
+        )
+        run = response["Attributes"]
+        # A shard retried after the run was merged does not merge it again.
+        return len(run["completed_shards"]) == int(run["shards"]) and run.get("merged_at") is None
+
+    def completeRun(self, **params):
+        self.dynamodb.Table(os.environ.get("RUNSTABLENAME", "stg_runs")).update_item(
+            Key={
+                "run_id": params["run_id"]
+            },
+            UpdateExpression="set merged_at=:val0",
+            ExpressionAttributeValues={
+                ":val0": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            }
+        )
+
+    def mergeShards(self, **params):
+        snapshotStore = getSnapshotStore()
+        snapshot = snapshotStore.get("runs/{run_id}/snapshot.json".format(run_id=params["run_id"]))
+        for shard in range(int(params["shards"])):
+            result = snapshotStore.get(
+                "runs/{run_id}/shard-{shard}.done.json".format(run_id=params["run_id"], shard=shard)
+            )
+            snapshot["hashes"].update(result["hashes"])
+            snapshot["ids"].update(result["ids"])
+            if not result.get("complete", True):
+                snapshot["fingerprint"] = None
+        # The same rules as a run without shards for the skus a shard failed to stage.
+        if any(dataHash is None for dataHash in snapshot["hashes"].values()):
+            snapshot["fingerprint"] = None
+        snapshot["ids"] = dict(
+            (sku, ids) for sku, ids in snapshot["ids"].items() if snapshot["hashes"].get(sku) is not None
+        )
+        return snapshot
+
+    @staticmethod
+    def getTabs(**params):
+        # The tabs of the sheet, e.g. [{"gid", "data_type"}], each one overriding the event settings.
+        if params.get("tabs") is None:
+            return [params]
+        tabs = [
+            dict(((k, v) for k, v in params.items() if k != "tabs"), **tab) for tab in params["tabs"]
+        ]
+        assert len(set((tab.get("table_name"), tab.get("source")) for tab in tabs)) == len(tabs), \
+            "Each tab requires its own table_name or source."
+        return tabs
+
+    def getTabChanges(self, tabs, offset=0):
+        # Fetch and transform the tabs concurrently; the copies share the staging writer of this instance.
+        if len(tabs) == 1:
+            return [self.getChanges(offset=offset, **tabs[0])]
+        with ThreadPoolExecutor(max_workers=len(tabs)) as executor:
+            futures = [executor.submit(copy.copy(self).getChanges, offset=offset, **tab) for tab in tabs]
+            return [future.result() for future in futures]
+
     @classmethod
     def dataSync(cls, **params):
         productsDataSync = cls(**params)
+        tabs = productsDataSync.getTabs(**params)
 
         offset = int(params.get("offset", "0"))
         if offset != 0:
             sleep(int(params.get("time_interval", 0)))
 
-        rows, total = productsDataSync.getDataSet(**params)
-        items = productsDataSync.getItems(params.get("table_name"), params.get("source"))
+        # A continuation resumes from the checkpoint of the previous loop instead of parsing the sheet again.
+        snapshotStore = getSnapshotStore()
+        changes = None
+        if snapshotStore is not None and offset != 0 and params.get("run_id") is not None:
+            changes = productsDataSync.getCheckpoint(**params)
+        if changes is None and params.get("shard") is not None:
+            # Shard worker: the coordinator already parsed and diffed the sheet.
+            changes = [productsDataSync.getShard(**params)]
+        elif changes is None:
+            changes = productsDataSync.getTabChanges(tabs, offset=offset)
+            if not any(changes):
+                productsDataSync.metrics.flush()
+                return
+        # The rows of every tab are staged through the same writer, tab by tab.
+        total = sum(len(_changes["rows"]) for _changes in changes if _changes is not None)
+        rows = itertools.islice(
+            ((i, row) for i, _changes in enumerate(changes) if _changes is not None for row in _changes["rows"]),
+            offset,
+            None
+        )
 
-        for row in rows:
-            stimems = int(round(time()*1000))
-            updateRequire = False
-            # validate data
-            txFunct = lambda x: json.loads(json.dumps(x, cls=JSONEncoder), parse_float=Decimal)
-            logger.info("validate data for {sku}".format(sku=row["sku"]))
-            _items = list(filter(lambda item: item["sku"] == row["sku"], items))
-            if len(_items) == 0:
-                updateRequire = True
-            else:
-                if params.get("data_type") == "inventory":
-                    if len(row["data"]) != len(_items[0]["data"]):
-                        updateRequire = True
-                    else:
-                        for i in row["data"]:
-                            k = list(filter(lambda j: txFunct(i)["store_id"]==txFunct(j)["store_id"] and \
-                                txFunct(i)["warehouse"]==txFunct(j)["warehouse"] and \
-                                txFunct(i)["qty"]==txFunct(j)["qty"],
-                                _items[0]["data"])
-                            )
-                            if len(k) == 0:
-                                updateRequire = True
-                                break
-                elif params.get("data_type") in ("imagegallery", "variants"):
-                    if txFunct(row["data"]) != txFunct(_items[0]["data"]):
-                        updateRequire = True
-                elif params.get("data_type") in ("customoption"):
-                    if len(row["data"]) != len(_items[0]["data"]):
-                        updateRequire = True
-                    else:
-                        for i in row["data"]:
-                            k = list(filter(lambda j: txFunct(i)==txFunct(j), _items[0]["data"]))
-                            if len(k) == 0:
-                                updateRequire = True
-                                break
-                else:
-                    if txFunct(row["data"]) != txFunct(_items[0]["data"]):
-                        updateRequire = True
-            
-            if updateRequire:
-                try:
-                    # process data
-                    logger.info("process data for {sku}".format(sku=row["sku"]))
-                    entity = productsDataSync.putItem(
-                        params.get("table_name"),
-                        source=params.get("source"),
-                        sku=row["sku"],
-                        data=row["data"]
-                    )
-                    logger.info("Data: {data}".format(
-                            data=json.dumps(entity.get("data"), indent=4, cls=JSONEncoder, ensure_ascii=False)
+        # Staged entities are written in concurrent batches; whatever is buffered is flushed when the generator stops.
+        entities, owners = {}, {}
+        def flush(*indexes):
+            for i in indexes or list(entities.keys()):
+                productsDataSync.putItems(tabs[i].get("table_name"), entities.pop(i, []))
+
+        def drain():
+            for future in productsDataSync.writePool.wait():
+                for entity in future.result():
+                    changes[owners[entity["id"]]]["hashes"][entity["sku"]] = None
+
+        try:
+            for i, row in rows:
+                stimems = int(round(time()*1000))
+                tab, hashes, items = tabs[i], changes[i]["hashes"], changes[i]["items"]
+                # validate data
+                logger.info("validate data for {sku}".format(sku=row["sku"]))
+                dataHash = hashes.get(row["sku"])
+                item = items.get(row["sku"])
+                updateRequire = changes[i]["delta"] or item is None or item.get("data_hash") != dataHash
+
+                if updateRequire and row["data"] is None:
+                    try:
+                        logger.info("remove data for {sku}".format(sku=row["sku"]))
+                        productsDataSync.removeItem(
+                            tab.get("table_name"), source=tab.get("source"), sku=row["sku"], item=item
                         )
-                    )
-                except Exception:
-                    log = traceback.format_exc()
-                    logger.exception(log)
+                    except Exception:
+                        # Keep the sku in the snapshot with its previous hash so the next export removes it again.
+                        hashes[row["sku"]] = changes[i].get("removed", {}).get(
+                            row["sku"], item.get("data_hash") if item is not None else None
+                        )
+                        changes[i]["complete"] = False
+                        log = traceback.format_exc()
+                        logger.exception(log)
+                elif updateRequire:
+                    try:
+                        # process data
+                        logger.info("process data for {sku}".format(sku=row["sku"]))
+                        entity = productsDataSync.getEntity(
+                            tab.get("table_name"),
+                            source=tab.get("source"),
+                            sku=row["sku"],
+                            data=row["data"],
+                            dataHash=dataHash,
+                            item=item
+                        )
+                        items[row["sku"]] = dict((k, entity[k]) for k in ("id", "created_at", "data_hash"))
+                        owners[entity["id"]] = i
+                        previous = changes[i].get("previous", {}).get(row["sku"])
+                        positions = productsDataSync.getStockChanges(previous["stock"], row["data"]) \
+                            if previous is not None and item is not None else None
+                        if positions is not None:
+                            # Stock fast path: only the changed quantities of a staged inventory item.
+                            productsDataSync.writePool.submit(
+                                productsDataSync.updateStock,
+                                tab.get("table_name"),
+                                entity,
+                                positions,
+                                previous["data_hash"]
+                            )
+                        else:
+                            entities.setdefault(i, []).append(entity)
+                        if productsDataSync.metrics.isSampled():
+                            logger.info("Data: {data}".format(
+                                    data=json.dumps(entity.get("data"), indent=4, cls=JSONEncoder, ensure_ascii=False)
+                                )
+                            )
+                    except Exception:
+                        # Leave the sku out of the snapshot so the next export stages it again.
+                        hashes[row["sku"]] = None
+                        log = traceback.format_exc()
+                        logger.exception(log)
+
+                # The latency is tracked per stage: staging the row and queueing its writes.
+                spendms = {"stage": int(round(time()*1000)) - stimems}
+                stimems = int(round(time()*1000))
+                offset += 1
+                if len(entities.get(i, [])) >= 25:
+                    flush(i)
+                # Every write lands before the final progress.
+                if offset >= total:
+                    flush()
+                    drain()
 
-            offset += 1
-            spendms = int(round(time()*1000)) - stimems
-            yield offset, total, spendms
+                spendms["write"] = int(round(time()*1000)) - stimems
+                productsDataSync.metrics.tick()
+                yield offset, total, spendms
+        finally:
+            flush()
+            drain()
+            logger.info("Write pool: {stats}".format(stats=json.dumps(productsDataSync.writePool.stats())))
+            productsDataSync.metrics.flush()
+            # Handed off before the end: checkpoint the dataset with this loop's ids and failures.
+            if offset < total and snapshotStore is not None and params.get("run_id") is not None:
+                productsDataSync.putCheckpoint(changes, **params)
+            for _changes in changes:
+                if _changes is not None and isinstance(_changes["rows"], SpilledRows):
+                    _changes["rows"].store.close()
+
+        synced = []
+        for i, (tab, _changes) in enumerate(zip(tabs, changes)):
+            if _changes is None:
+                continue
+            # Only a completed run records the snapshot, so an interrupted one is synced again.
+            if params.get("shard") is not None:
+                # The last shard to finish records the snapshot and starts the Magento sync.
+                if not productsDataSync.completeShard(
+                    _changes["hashes"], _changes["items"], complete=_changes.get("complete", True), **params
+                ):
+                    return
+                snapshot = productsDataSync.mergeShards(**params)
+            else:
+                snapshot = productsDataSync.getSnapshot(
+                    _changes["hashes"],
+                    _changes["items"],
+                    _changes["fingerprint"],
+                    stock=_changes.get("stock"),
+                    complete=_changes.get("complete", True)
+                )
+            if snapshotStore is not None:
+                snapshotStore.put(productsDataSync.getSnapshotKey(**tab), snapshot)
+            synced.append(i)
+
+        if len(synced) == 0:
+            return
+        # One Magento run drains the changed tabs together; it orders the data types of a sku by their dependencies.
+        event = productsDataSync.getEvent(params, "offset", "loop", "run_id", "shard", "shards", "time_budget", "tabs")
+        if params.get("tabs") is not None:
+            event["data_types"] = [params["tabs"][i] for i in synced]
+        cls.invoke(os.environ["SYNCPRODUCTSDATAMAGE2TASKARN"], event)
+        if params.get("shard") is not None:
+            # Only once the snapshot is recorded and the Magento sync started; a retry before that merges again.
+            productsDataSync.completeRun(**params)
+
+    def getSnapshotKey(self, **params):
+        gid = params.get("gid", params.get("sheet_name"))
+        if gid is None:
+            gid = hashlib.sha256(params.get("data_feed_url", "").encode("utf-8")).hexdigest()
+        return "snapshots/{source}/{gid}.json".format(source=params.get("source"), gid=gid)
 
     def getDataFeedUrl(self, **params):
         googleSheetId = params.get("google_sheet_id")
         gid = params.get("gid")
 
-        if googleSheetId is not None and gid is not None:
+        if googleSheetId is not None and params.get("export_format") == "xlsx":
+            # The whole workbook in one export; the tabs are picked by sheet_name.
+            dataFeedUrl = "https://docs.google.com/spreadsheets/d/{id}/export?format=xlsx&id={id}".format(
+                id=googleSheetId
+            )
+        elif googleSheetId is not None and gid is not None:
             dataFeedUrl = "https://docs.google.com/spreadsheets/d/{id}/export?format=csv&id={id}&gid={gid}".format(
                 id=googleSheetId,
                 gid=gid
@@ -412,54 +978,138 @@ class ProductsDataSync(object):
         assert dataFeedUrl, "Data Feed URL is None.  Please check the parameters."
         return dataFeedUrl
 
-    def getDataSet(self, **params):
-        dataFeedUrl = params.get("data_feed_url")
-        if dataFeedUrl is None:
-            dataFeedUrl = self.getDataFeedUrl(**params)
-        logger.info("Data Feed URL: {datafeedurl}".format(datafeedurl=dataFeedUrl))
+    def getWorkbook(self, dataFeedUrl, bufferSize=65536):
+        # The tabs share one download of the workbook and its fingerprint.
+        with self.workbookLock:
+            if dataFeedUrl not in self.workbooks.keys():
+                with requests.get(dataFeedUrl, stream=True) as response:
+                    response.raise_for_status()
+                    workbook = b"".join(self.metrics.timed("fetch", response.iter_content(chunk_size=bufferSize)))
+                self.workbooks[dataFeedUrl] = (workbook, hashlib.sha256(workbook).hexdigest())
+            return self.workbooks[dataFeedUrl]
 
-        s = requests.get(dataFeedUrl).content
+    def getExport(self, dataFeedUrl, **params):
+        # Download the export before anything is parsed and fingerprint its raw bytes on the way.
+        # A csv export is spooled to /tmp past spool_max_bytes; an xlsx export is the shared workbook.
+        bufferSize = int(params.get("buffer_size", 65536))
+        if params.get("export_format") == "xlsx":
+            # Any change to the workbook counts as a change of each tab; the per-sku diff finds the real delta.
+            export, self.fingerprint = self.getWorkbook(dataFeedUrl, bufferSize=bufferSize)
+            return export
+        fingerprint = hashlib.sha256()
+        export = tempfile.SpooledTemporaryFile(
+            max_size=int(params.get("spool_max_bytes", 8388608)), dir=os.environ.get("SPILLDIR")
+        )
+        with requests.get(dataFeedUrl, stream=True) as response:
+            response.raise_for_status()
+            for chunk in self.metrics.timed("fetch", response.iter_content(chunk_size=bufferSize)):
+                fingerprint.update(chunk)
+                export.write(chunk)
+        export.seek(0)
+        self.fingerprint = fingerprint.hexdigest()
+        return export
 
-        offset = int(params.get("offset", "0"))
+    def iterValues(self, export, **params):
+        # The cell values of the tab row by row, the header first.
+        bufferSize = int(params.get("buffer_size", 65536))
+        if params.get("export_format") == "xlsx":
+            assert load_workbook is not None, "The xlsx export requires openpyxl."
+            workbook = load_workbook(io.BytesIO(export), read_only=True, data_only=True)
+            try:
+                # The workbook holds every tab, so the first sheet would stage another tab's rows unnoticed.
+                sheetName = params.get("sheet_name")
+                assert sheetName is not None, "The xlsx export requires the sheet_name of the tab."
+                worksheet = workbook[sheetName]
+                # The cells with their number formats, which the CSV export renders the values by.
+                for cells in self.metrics.timed("decode", worksheet.iter_rows()):
+                    yield [getCellValue(cell.value, cell.number_format) for cell in cells]
+            finally:
+                workbook.close()
+        else:
+            try:
+                # Read back from the spool, so only the decode is timed here; the fetch was timed by getExport.
+                lines = iterLines(
+                    SpooledExport(export), params.get("decode"), bufferSize=bufferSize, metrics=self.metrics, fetchStage=None
+                )
+                for values in csv.reader(lines):
+                    yield values
+            finally:
+                export.close()
 
-        rows = []
-        for row in csv.DictReader(StringIO(s.decode(params.get("decode")))):
-            row = dict(
-                (
-                    k.lower().strip().replace(" ", "_").replace("/", "_").replace("(", "").replace(")", ""), 
-                    v.strip().split("|") if len(v.split("|")) > 1 else v.strip()
-                ) for k, v in row.items() if k is not None and (v!="" and v is not None)
-            )
+    def getRows(self, export, **params):
+        self.columnPlan = None
+        for values in self.iterValues(export, **params):
+            if self.columnPlan is None:
+                self.columnPlan = getColumnPlan(values)
+                continue
+            with self.metrics.timer("parse"):
+                row = getRow(self.columnPlan, values)
             if "sku" in row.keys() and row["sku"] != "---":
                 if params.get("data_type") == "inventory":
                     if "warehouse" not in row.keys():
                         row["warehouse"] = "admin"
                     if "stock" in row.keys():
                         row["qty"] = row.get("stock")
-                    rows.append(row)
+                    yield row
                 elif params.get("data_type") == "imagegallery":
                     for k, v in row.items():
                         if k.find('image') == 0:
-                            rows.append({
+                            yield {
                                 'sku': row['sku'],
                                 'type': 'media_gallery',
                                 'value': v
-                            })
+                            }
                 else:
-                    rows.append(row)
+                    yield row
+
+    def getDataSet(self, export, **params):
+        # Rows are grouped as they are parsed from the download stream.
+        rows = self.getRows(export, **params)
+        dataType = params.get("data_type")
+        if dataType == 'products':
+            # The column plan is compiled from the header once the rows are consumed.
+            keys, builder = ("sku",), lambda groups: self.setProducts(groups, self.columnPlan)
+        elif dataType == 'inventory':
+            keys, builder = ("sku", "warehouse"), self.setInventory
+        elif dataType == 'imagegallery':
+            keys, builder = ("sku",), self.setImageGallery
+        elif dataType == 'variants':
+            keys, builder = ("sku",), self.setVariants
+        elif dataType == 'customoption':
+            keys, builder = ("sku", "title"), self.setCustomOption
+        else:
+            rows = list(rows)
+            return sorted(rows, key=lambda row: row["sku"]), len(rows)
+
+        if str(params.get("spill", "false")).lower() == "true":
+            return self.getSpilledDataSet(rows, keys, builder)
+
+        groups = self.groupRows(rows, *keys)
+        with self.metrics.timer("transform"):
+            rows = sorted(builder(groups), key=lambda row: row["sku"])
+        return rows, len(rows)
+
+    def getSpilledDataSet(self, rows, keys, builder):
+        # Memory-bounded: the rows are grouped and sorted in a SQLite file in /tmp and built one sku at a time.
+        spillStore = SpillStore(directory=os.environ.get("SPILLDIR"))
+        spillStore.addRows(rows, *keys)
+        for sku, group in spillStore.iterGroups():
+            with self.metrics.timer("transform"):
+                results = builder({sku: group})
+            spillStore.addResults(results)
+        rows = spillStore.getResults()
+        return rows, len(rows)
 
-        if params.get("data_type") == 'products':
-            rows = self.setProducts(rows)
-        elif params.get("data_type") == 'inventory':
-            rows = self.setInventory(rows)
-        elif params.get("data_type") == 'imagegallery':
-            rows = self.setImageGallery(rows)
-        elif params.get("data_type") == 'variants':
-            rows = self.setVariants(rows)
-        elif params.get("data_type") == 'customoption':
-            rows = self.setCustomOption(rows)
 
-        return sorted(rows[offset:], key=lambda row: row["sku"]), len(rows)
+class SpooledExport(object):
+    """The downloaded export read back in chunks, like the streamed response it was written from.
+    """
+
+    def __init__(self, export):
+        self.export = export
+
+    def iter_content(self, chunk_size):
+        return iter(lambda: self.export.read(chunk_size), b"")
 
 
 def handler(event, context):
@@ -471,30 +1121,43 @@ def handler(event, context):
         lastRequestId = context.aws_request_id # keep request id for next invokation
 
     params = dict(event, **{
-        "time_interval": int(os.environ["TIMEINTERVAL"])
+        "time_interval": int(os.environ["TIMEINTERVAL"]),
+        "run_id": event.get("run_id", uuid.uuid4().hex)
     })
     
     try:
-        maxspendms = 0
+        # Seeded with the latency estimates of the previous loop.
+        timeBudget = TimeBudget(
+            estimates=params.get("time_budget"),
+            reserveMs=int(params.get("handoff_reserve_ms", os.environ.get("HANDOFFRESERVEMS", 3000)))
+        )
+        offset, total, spendms = int(params.get("offset", "0")), 0, {}
         logger.info("Allow MS/Loop: {allowms}/{loop}".format(
             allowms=context.get_remaining_time_in_millis(), 
             loop=int(params.get("loop", "0")))
         )
-        nextLoop = lambda offset, total, maxspendms: \
-            context.get_remaining_time_in_millis() - maxspendms*5 <= 0 and total - offset > 0
-        for offset, total, spendms in ProductsDataSync.dataSync(**params):
-            if total - offset <= 0:
-                ProductsDataSync.invoke(os.environ["SYNCPRODUCTSDATAMAGE2TASKARN"], event)
-
-            maxspendms = spendms if spendms > maxspendms else maxspendms
-            if nextLoop(offset, total, maxspendms):
+        if int(params.get("shards", "1")) > 1 and params.get("shard") is None:
+            ProductsDataSync.dispatchShards(context.invoked_function_arn, **params)
+            return
+
+        dataSync = ProductsDataSync.dataSync(**params)
+        for offset, total, spendms in dataSync:
+            timeBudget.record(spendms)
+            if timeBudget.shouldHandOff(context.get_remaining_time_in_millis(), total - offset):
                 loop = int(event.get("loop", "0")) + 1
                 assert  loop <= 100, "Over the limit of loops."
-                payload = dict(event, **{"offset": str(offset), "loop": str(loop)})
+                payload = dict(event, **{
+                    "offset": str(offset),
+                    "loop": str(loop),
+                    "run_id": params["run_id"],
+                    "time_budget": timeBudget.getEstimates()
+                })
                 logger.info("payload: {payload}".format(
                         payload=json.dumps(payload, indent=4, cls=JSONEncoder, ensure_ascii=False)
                     )
                 )
+                # Flush the buffered staging writes before the next loop starts.
+                dataSync.close()
                 ProductsDataSync.invoke(context.invoked_function_arn, payload)
                 break
 
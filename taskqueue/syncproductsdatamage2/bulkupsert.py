@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+__author__ = 'bibow'
+
+
+class BulkUpsert(object):
+    """Page-wise product upsert through the connection of a Mage2Connector: the ids and the attribute metadata are
+    resolved for the whole page and the EAV values are written with one multi-row REPLACE per backend table.
+    """
+
+    GETPRODUCTIDSBYSKUSQL = """SELECT sku, entity_id FROM catalog_product_entity WHERE sku IN ({skus});"""
+
+    INSERTCATALOGPRODUCTENTITIESSQL = """
+        INSERT INTO catalog_product_entity
+        (attribute_set_id, type_id, sku, has_options, required_options, created_at, updated_at)
+        VALUES {vls};"""
+
+    UPDATECATALOGPRODUCTSSQL = """
+        UPDATE catalog_product_entity
+        SET attribute_set_id = %s,
+        type_id = %s,
+        updated_at = UTC_TIMESTAMP()
+        WHERE {key} IN ({ids});"""
+
+    ATTRIBUTESMETADATASQL = """
+        SELECT DISTINCT t1.attribute_code, t1.attribute_id, t2.entity_type_id, t1.backend_type, t1.frontend_input
+        FROM eav_attribute t1, eav_entity_type t2
+        WHERE t1.entity_type_id = t2.entity_type_id
+        AND t1.attribute_code IN ({codes})
+        AND t2.entity_type_code = %s;"""
+
+    GETOPTIONIDSSQL = """
+        SELECT t1.attribute_id, t2.value, t2.option_id
+        FROM eav_attribute_option t1, eav_attribute_option_value t2
+        WHERE t1.option_id = t2.option_id
+        AND t1.attribute_id IN ({attributeIds})
+        AND t2.value IN ({values})
+        AND t2.store_id = %s;"""
+
+    GETADMINVALUESSQL = """
+        SELECT attribute_id, {key} AS id
+        FROM {entityTypeCode}_entity_{dataType}
+        WHERE store_id = %s
+        AND attribute_id IN ({attributeIds})
+        AND {key} IN ({ids});"""
+
+    REPLACEATTRIBUTEVALUESSQL = """REPLACE INTO {entityTypeCode}_entity_{dataType} ({cols}) VALUES (%s, %s, %s, %s);"""
+
+    GETWEBSITEIDSSQL = """SELECT store_id, website_id FROM store WHERE store_id IN ({storeIds});"""
+
+    INSERTPRODUCTWEBSITESQL = """INSERT IGNORE INTO catalog_product_website (product_id, website_id) VALUES (%s, %s);"""
+
+    # The same exceptions as Mage2Connector.syncEntityData.
+    DONOTUPDATEOPTIONATTRIBUTES = ['status', 'visibility', 'tax_class_id']
+
+    def __init__(self, mage2Connector, entityTypeCode='catalog_product', adminStoreId=0):
+        self.mage2Connector = mage2Connector
+        self.entityTypeCode = entityTypeCode
+        self.adminStoreId = adminStoreId
+
+    @property
+    def cursor(self):
+        return self.mage2Connector.adaptor.mySQLCursor
+
+    @property
+    def key(self):
+        return 'row_id' if self.mage2Connector.setting['VERSION'] == "EE" else 'entity_id'
+
+    @staticmethod
+    def placeholders(values):
+        return ", ".join(["%s"] * len(values))
+
+    def getProductIds(self, skus):
+        sql = self.GETPRODUCTIDSBYSKUSQL.format(skus=self.placeholders(skus))
+        self.cursor.execute(sql, list(skus))
+        return dict((row["sku"], int(row["entity_id"])) for row in self.cursor.fetchall())
+
+    def insertProducts(self, products, attributeSetId):
+        if self.mage2Connector.setting['VERSION'] == 'EE':
+            # The EE entity needs its sequence_product row and entity_id = row_id, so it goes through the connector.
+            return dict(
+                (
+                    product["sku"],
+                    self.mage2Connector.insertCatalogProductEntity(
+                        product["sku"], product["attributeSet"], product["typeId"]
+                    )
+                ) for product in products
+            )
+        vls = ", ".join(["(%s, %s, %s, 0, 0, UTC_TIMESTAMP(), UTC_TIMESTAMP())"] * len(products))
+        param = []
+        for product in products:
+            param.extend([attributeSetId, product["typeId"], product["sku"]])
+        self.cursor.execute(self.INSERTCATALOGPRODUCTENTITIESSQL.format(vls=vls), param)
+        return self.getProductIds([product["sku"] for product in products])
+
+    def updateProducts(self, products, productIds, attributeSetId):
+        # One update per type_id.
+        typeIds = {}
+        for product in products:
+            typeIds.setdefault(product["typeId"], []).append(productIds[product["sku"]])
+        for typeId, ids in typeIds.items():
+            sql = self.UPDATECATALOGPRODUCTSSQL.format(key=self.key, ids=self.placeholders(ids))
+            self.cursor.execute(sql, [attributeSetId, typeId] + ids)
+
+    @property
+    def metadataCache(self):
+        # Set on the connectors of a Mage2Connection with METADATACACHETTL > 0.
+        return getattr(self.mage2Connector, "metadataCache", None)
+
+    def getAttributesMetadata(self, attributeCodes):
+        if self.metadataCache is not None:
+            return dict(
+                (
+                    attributeCode,
+                    self.mage2Connector.getAttributeMetadata(attributeCode, self.entityTypeCode)[1]
+                ) for attributeCode in attributeCodes
+            )
+        sql = self.ATTRIBUTESMETADATASQL.format(codes=self.placeholders(attributeCodes))
+        self.cursor.execute(sql, list(attributeCodes) + [self.entityTypeCode])
+        attributesMetadata = dict((row["attribute_code"], row) for row in self.cursor.fetchall())
+        for attributeCode in attributeCodes:
+            if attributeCode not in attributesMetadata.keys():
+                log = "Entity Type/Attribute Code: {0}/{1} does not exist".format(self.entityTypeCode, attributeCode)
+                raise Exception(log)
+        return attributesMetadata
+
+    @staticmethod
+    def getOptionKey(attributeId, value):
+        # MySQL compares the option values case-insensitively.
+        return (int(attributeId), str(value).strip().lower())
+
+    @staticmethod
+    def splitMultiSelect(value, delimiter="|"):
+        value = value.strip('"').strip("'").strip("\n").strip()
+        return [v.strip() for v in value.split(delimiter)]
+
+    def getOptionIds(self, options):
+        # options: [(attributeId, value)], resolved in one query; the missing ones are added through the connector.
+        optionIds = {}
+        if self.metadataCache is not None:
+            for attributeId, value in options:
+                optionId = self.metadataCache.getOptionId(attributeId, value)
+                if optionId is not None:
+                    optionIds[self.getOptionKey(attributeId, value)] = optionId
+            options = [
+                (attributeId, value) for attributeId, value in options
+                if self.getOptionKey(attributeId, value) not in optionIds.keys()
+            ]
+        if len(options) == 0:
+            return optionIds
+        attributeIds = list(set(attributeId for attributeId, value in options))
+        values = list(set(value for attributeId, value in options))
+        sql = self.GETOPTIONIDSSQL.format(
+            attributeIds=self.placeholders(attributeIds), values=self.placeholders(values)
+        )
+        self.cursor.execute(sql, attributeIds + values + [self.adminStoreId])
+        for row in self.cursor.fetchall():
+            optionIds.setdefault(self.getOptionKey(row["attribute_id"], row["value"]), row["option_id"])
+        for attributeId, value in options:
+            if self.getOptionKey(attributeId, value) not in optionIds.keys():
+                optionIds[self.getOptionKey(attributeId, value)] = self.mage2Connector.setAttributeOptionValues(
+                    attributeId, {0: value}, adminStoreId=self.adminStoreId
+                )
+            elif self.metadataCache is not None:
+                self.metadataCache.setOptionId(attributeId, value, optionIds[self.getOptionKey(attributeId, value)])
+        return optionIds
+
+    def getOptions(self, products, attributesMetadata):
+        # The (attributeId, value) of the option attributes, in a stable order.
+        options = set()
+        for product in products:
+            for attributeCode, value in product["data"].items():
+                attributeMetadata = attributesMetadata[attributeCode]
+                if attributeMetadata['frontend_input'] == 'select' and attributeCode not in self.DONOTUPDATEOPTIONATTRIBUTES:
+                    options.add((attributeMetadata['attribute_id'], value))
+                elif attributeMetadata['frontend_input'] == 'multiselect':
+                    options.update((attributeMetadata['attribute_id'], v) for v in self.splitMultiSelect(value))
+        return sorted(options, key=lambda option: (option[0], str(option[1])))
+
+    def createOptions(self, products):
+        """Add the option values of the products missing in Magento 2 and commit them at once. The writers of a
+        process call it one at a time, so a new value is added by a single connection.
+        """
+        attributeCodes = list(set(code for product in products for code in product["data"].keys()))
+        if len(attributeCodes) == 0:
+            return
+        try:
+            # A new snapshot, so the options just committed by the other writers are found.
+            self.mage2Connector.adaptor.commit()
+            self.getOptionIds(self.getOptions(products, self.getAttributesMetadata(attributeCodes)))
+            self.mage2Connector.adaptor.commit()
+        except Exception:
+            self.mage2Connector.adaptor.rollback()
+            raise
+
+    def getValues(self, products, attributesMetadata):
+        # The option attributes are mapped to their option ids, as syncEntityData does per attribute.
+        optionIds = self.getOptionIds(self.getOptions(products, attributesMetadata))
+
+        values = []
+        for product in products:
+            for attributeCode, value in product["data"].items():
+                attributeMetadata = attributesMetadata[attributeCode]
+                attributeId = attributeMetadata['attribute_id']
+                if attributeMetadata['frontend_input'] == 'select' and attributeCode not in self.DONOTUPDATEOPTIONATTRIBUTES:
+                    value = optionIds[self.getOptionKey(attributeId, value)]
+                elif attributeMetadata['frontend_input'] == 'multiselect':
+                    value = ",".join(
+                        str(optionIds[self.getOptionKey(attributeId, v)]) for v in self.splitMultiSelect(value)
+                    )
+                values.append((attributeMetadata['backend_type'], product, attributeId, value))
+        return values
+
+    def getAdminValues(self, dataType, attributeIds, productIds):
+        # The (attribute_id, id) pairs that already have an admin store value.
+        sql = self.GETADMINVALUESSQL.format(
+            key=self.key,
+            entityTypeCode=self.entityTypeCode,
+            dataType=dataType,
+            attributeIds=self.placeholders(attributeIds),
+            ids=self.placeholders(productIds)
+        )
+        self.cursor.execute(sql, [self.adminStoreId] + attributeIds + productIds)
+        return set((int(row["attribute_id"]), int(row["id"])) for row in self.cursor.fetchall())
+
+    def replaceAttributeValues(self, values, productIds):
+        tables = {}
+        for dataType, product, attributeId, value in values:
+            # The static attributes live on the entity table.
+            if dataType != "static":
+                tables.setdefault(dataType, []).append((product, attributeId, value))
+
+        cols = "{key}, attribute_id, store_id, value".format(key=self.key)
+        for dataType, entries in tables.items():
+            attributeIds = list(set(int(attributeId) for product, attributeId, value in entries))
+            ids = list(set(productIds[product["sku"]] for product, attributeId, value in entries))
+            adminValues = self.getAdminValues(dataType, attributeIds, ids)
+            param = []
+            for product, attributeId, value in entries:
+                productId = productIds[product["sku"]]
+                # A value goes to the admin store until the attribute has one there, as in syncEntityData.
+                storeId = product["storeId"] if (int(attributeId), productId) in adminValues else self.adminStoreId
+                param.append([productId, attributeId, storeId, value])
+            sql = self.REPLACEATTRIBUTEVALUESSQL.format(
+                entityTypeCode=self.entityTypeCode, dataType=dataType, cols=cols
+            )
+            # pymysql sends the rows of an executemany REPLACE as one multi-row statement.
+            self.cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+            self.cursor.executemany(sql, param)
+            self.cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+    def assignWebsites(self, products, productIds):
+        storeIds = list(set(str(product["storeId"]) for product in products))
+        self.cursor.execute(self.GETWEBSITEIDSSQL.format(storeIds=self.placeholders(storeIds)), storeIds)
+        websiteIds = dict((str(row["store_id"]), row["website_id"]) for row in self.cursor.fetchall())
+        param = [
+            [productIds[product["sku"]], websiteIds.get(str(product["storeId"])) or 1] for product in products
+        ]
+        self.cursor.executemany(self.INSERTPRODUCTWEBSITESQL, param)
+
+    def upsertProducts(self, products, attributeSet='Default'):
+        """products: [{"sku", "attributeSet", "data", "typeId", "storeId"}] with distinct skus; one transaction.
+        Returns {sku: product_id}.
+        """
+        try:
+            entityMetadata = self.mage2Connector.getEntityMetaData(self.entityTypeCode, attributeSet)
+            attributeSetId = entityMetadata['attribute_set_id']
+            productIds = self.getProductIds([product["sku"] for product in products])
+            existing = [product for product in products if product["sku"] in productIds.keys()]
+            if len(existing) > 0:
+                self.updateProducts(existing, productIds, attributeSetId)
+            new = [product for product in products if product["sku"] not in productIds.keys()]
+            if len(new) > 0:
+                productIds.update(self.insertProducts(new, attributeSetId))
+
+            attributeCodes = list(set(code for product in products for code in product["data"].keys()))
+            if len(attributeCodes) > 0:
+                attributesMetadata = self.getAttributesMetadata(attributeCodes)
+                self.replaceAttributeValues(self.getValues(products, attributesMetadata), productIds)
+            self.assignWebsites(products, productIds)
+            self.mage2Connector.adaptor.commit()
+            return dict((product["sku"], productIds[product["sku"]]) for product in products)
+        except Exception:
+            self.mage2Connector.adaptor.rollback()
+            raise
@@ -6,18 +6,23 @@ __author__ = 'bibow'
 import sys
 sys.path.append('/opt')
 
-import boto3, os, traceback, json
+import boto3, os, traceback, json, copy, threading, queue, zlib, heapq, itertools, collections, uuid
 from boto3.dynamodb.conditions import Key, Attr
-from aws_mage2connector import Mage2Connector
-from sshtunnel import SSHTunnelForwarder
 from time import sleep, time
 from decimal import Decimal
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from writepool import WritePool, WriteBuffer
+from timebudget import TimeBudget
+from metrics import Metrics
+from mage2connection import getMage2Connection
+from bulkupsert import BulkUpsert
 
 import logging
 logger = logging.getLogger()
 logger.setLevel(eval(os.environ["LOGGINGLEVEL"]))
 lastRequestId = None
+# The writers of the process add new option values one at a time.
+optionsLock = threading.Lock()
 
 
 # Helper class to convert an entity to JSON.
@@ -32,15 +37,49 @@ class JSONEncoder(json.JSONEncoder):
             return o.strftime("%Y-%m-%d %H:%M:%S")
         elif isinstance(o, (bytes, bytearray)):
             return str(o)
+        elif isinstance(o, set):
+            return sorted(o)
         else:
             return super(JSONEncoder, self).default(o)
 
 
 class ProductsDataSyncMage2(object):
+    # The order the data types of a sku are synced in: the product first, then what attaches to it.
+    DEPENDENCIES = ["products", "categories", "links", "variants", "customoption", "imagegallery", "inventory"]
+
     def __init__(self, **params):
         self.dynamodb = boto3.resource('dynamodb')
-        self.mage2Connector = Mage2Connector(
-            setting=params.get("mage2_setting"), logger=logger
+        # The tunnel and the connection of a warm container are reused after a ping.
+        self.mage2Connection = getMage2Connection(
+            params.get("mage2_setting"), logger=logger
+        )
+        self.mage2Connector = self.mage2Connection.getConnector()
+        self.mage2Workers = max(int(params.get("mage2_workers", os.environ.get("MAGE2WORKERS", 1))), 1)
+        self.lanes = self.getLanes(**params)
+        # The retry lane reads the failed items due for a retry instead of the pending ones.
+        self.retry = str(params.get("retry", False)).lower() == "true"
+        self.maxAttempts = max(int(params.get("max_attempts", os.environ.get("MAXATTEMPTS", 5))), 1)
+        self.retryBackoff = int(params.get("retry_backoff_s", os.environ.get("RETRYBACKOFFSECONDS", 60)))
+        self.fetched = 0
+        self.exhausted = {}
+        # The resume position of each lane; it passes a sku once the sku and all before it are written back.
+        self.cursor = self.getCursor(**params)
+        self.read = collections.deque()
+        self.done = set()
+        self.writePool = WritePool(
+            maxWorkers=int(params.get("write_concurrency", os.environ.get("WRITECONCURRENCY", 8)))
+        )
+        # The status writes go through the pool, which owns their retries.
+        self.writeDynamodb = self.writePool.getResource()
+        # The status writes are coalesced per item and flushed in the background.
+        self.statusWriter = WriteBuffer(
+            self.writePool,
+            self.updateItem,
+            intervalMs=int(params.get("status_flush_ms", os.environ.get("STATUSFLUSHMS", 1000)))
+        )
+        self.metrics = Metrics(
+            dimensions={"FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "syncproductsdatamage2_task")},
+            sampleRate=params.get("debug_sample_rate", os.environ.get("DEBUGSAMPLERATE", 0))
         )
 
     @classmethod
@@ -48,7 +87,7 @@ class ProductsDataSyncMage2(object):
         response = boto3.client('lambda').invoke(
             FunctionName=functionName,
             InvocationType=invocationType,
-            Payload=json.dumps(payload),
+            Payload=json.dumps(payload, cls=JSONEncoder),
         )
         if "FunctionError" in response.keys():
             log = json.loads(response['Payload'].read())
@@ -57,98 +96,453 @@ class ProductsDataSyncMage2(object):
         if invocationType == "RequestResponse":
             return json.loads(response['Payload'].read())
 
-    def getItems(self, tableName, source):
-        response = self.dynamodb.Table(tableName).query(
-            IndexName="updated_at_index",
+    def getItems(self, tableName, source, exclusiveStartKey=None):
+        # The pending items a page at a time in sku order, with the key to resume after the page.
+        # pending_index is sparse: an item is in it only while staged and not yet synced.
+        kwargs = dict(
+            IndexName="pending_index",
             KeyConditionExpression=Key('source').eq(source),
-            FilterExpression=Attr('tx_status').eq('N'),
-            ProjectionExpression="id,sku,#data",
+            ProjectionExpression="id,sku,#data,stock_store_ids,tx_attempts",
             ExpressionAttributeNames={"#data": "data"}
         )
-        items = response['Items']
-        while 'LastEvaluatedKey' in response:
-            response = self.dynamodb.Table(tableName).query(
-                IndexName="updated_at_index",
-                KeyConditionExpression=Key('source').eq(source),
-                FilterExpression=Attr('tx_status').eq('N'),
-                ProjectionExpression="id,sku,#data",
-                ExpressionAttributeNames={"#data": "data"},
-                ExclusiveStartKey=response['LastEvaluatedKey']
-            )
-            items.extend(response['Items'])
-        items = [item for item in sorted(items, key=lambda item: item["sku"])]
-        return items
+        if self.retry:
+            # failed_index is sparse as well: only the failed items waiting for a retry are in it.
+            kwargs["IndexName"] = "failed_index"
+            kwargs["FilterExpression"] = Attr('retry_at').lte(datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        while True:
+            if exclusiveStartKey is not None:
+                kwargs["ExclusiveStartKey"] = exclusiveStartKey
+            with self.metrics.timer("fetch"):
+                response = self.dynamodb.Table(tableName).query(**kwargs)
+            exclusiveStartKey = response.get('LastEvaluatedKey')
+            yield response['Items'], exclusiveStartKey
+            if exclusiveStartKey is None:
+                return
+
+    @staticmethod
+    def getDataType(dataType):
+        # "products-inventory" and the like are the staged names of "inventory".
+        return dataType[len("products-"):] if dataType.startswith("products-") else dataType
+
+    @classmethod
+    def getLanes(cls, **params):
+        # A lane per staged data type, e.g. data_types=[{"data_type", "table_name", "source"}], each one overriding
+        # the event settings like the tabs of the staging run; without data_types the event is the only lane.
+        lanes = [
+            dict(((k, v) for k, v in params.items() if k != "data_types"), **lane)
+            for lane in params.get("data_types") or [{}]
+        ]
+        for lane in lanes:
+            lane["data_type"] = cls.getDataType(lane["data_type"])
+        assert len(set((lane.get("table_name"), lane.get("source")) for lane in lanes)) == len(lanes), \
+            "Each data type requires its own table_name or source."
+        return lanes
+
+    @classmethod
+    def getRank(cls, dataType):
+        return cls.DEPENDENCIES.index(dataType) if dataType in cls.DEPENDENCIES else len(cls.DEPENDENCIES)
+
+    def iterLane(self, index, lane):
+        # The items of a lane as they are read; fetched and exhausted tell how many are known to be pending.
+        items = self.getItems(lane["table_name"], lane["source"], exclusiveStartKey=self.cursor["keys"][index])
+        for items, lastEvaluatedKey in items:
+            self.fetched += len(items)
+            self.exhausted[index] = lastEvaluatedKey is None
+            for item in items:
+                yield lane, item
+
+    def iterChains(self):
+        # The lanes merged in sku order (pending_index sorts them by sku); each sku comes as one chain of
+        # (lane, item) entries in the order of its dependencies.
+        self.exhausted = dict((index, False) for index in range(len(self.lanes)))
+        entries = heapq.merge(
+            *[self.iterLane(index, lane) for index, lane in enumerate(self.lanes)],
+            key=lambda entry: entry[1]["sku"]
+        )
+        for sku, chain in itertools.groupby(entries, key=lambda entry: entry[1]["sku"]):
+            chain = sorted(chain, key=lambda entry: self.getRank(entry[0]["data_type"]))
+            self.read.append(chain)
+            yield chain
+
+    def getCursor(self, **params):
+        # The cursor of the hand-off payload, or the one recorded for the run_id, e.g. to resume a run by hand.
+        cursor = params.get("cursor")
+        if cursor is None and params.get("run_id") is not None:
+            run = self.dynamodb.Table(os.environ.get("RUNSTABLENAME", "stg_runs")).get_item(
+                Key={"run_id": params["run_id"]}
+            ).get("Item")
+            cursor = run.get("cursor") if run is not None else None
+        if cursor is None:
+            cursor = {"sku": None, "keys": [None] * len(self.lanes)}
+        assert len(cursor["keys"]) == len(self.lanes), "The cursor does not match the data_types."
+        return cursor
+
+    def advanceCursor(self):
+        # The written-back skus at the head of the read order; the writers may finish them out of order.
+        while len(self.read) > 0 and self.read[0][0][1]["sku"] in self.done:
+            chain = self.read.popleft()
+            self.done.discard(chain[0][1]["sku"])
+            self.cursor["sku"] = chain[0][1]["sku"]
+            for lane, productData in chain:
+                # The index key of the item, the LastEvaluatedKey to query the lane from.
+                self.cursor["keys"][self.lanes.index(lane)] = {
+                    "id": productData["id"],
+                    "source": lane["source"],
+                    ("failed" if self.retry else "pending"): productData["sku"]
+                }
+
+    def putCursor(self, runId, loop):
+        self.dynamodb.Table(os.environ.get("RUNSTABLENAME", "stg_runs")).update_item(
+            Key={"run_id": runId},
+            UpdateExpression="set #cursor=:val0, #loop=:val1, updated_at=:val2",
+            ExpressionAttributeNames={"#cursor": "cursor", "#loop": "loop"},
+            ExpressionAttributeValues={
+                ":val0": self.cursor,
+                ":val1": loop,
+                ":val2": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+            }
+        )
+
+    def getTotal(self):
+        # The items read so far, plus one while any lane has pages left to read.
+        return self.fetched + (0 if all(self.exhausted.values()) else 1)
 
     def updateItem(self, tableName, productData):
-        response = self.dynamodb.Table(tableName).update_item(
+        with self.metrics.timer("status-write"):
+            return self._updateItem(tableName, productData)
+
+    def _updateItem(self, tableName, productData):
+        # The item leaves the pending_index either way; a failed one enters the failed_index until it is retried.
+        updateExpression = "set updated_at=:val0, tx_status=:val1, tx_note=:val2, product_id=:val3"
+        expressionAttributeValues = {
+            ':val0': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            ':val1': productData['tx_status'],
+            ':val2': productData['tx_note'],
+            ':val3': productData['product_id']
+        }
+        if productData['tx_status'] == 'S':
+            # The pushed stock changes are cleared; a failed push keeps them for the next one.
+            updateExpression += " remove pending, stock_store_ids, failed, retry_at, tx_attempts"
+        elif productData['tx_status'] == 'F':
+            updateExpression += ", tx_attempts=:val4, failed=:val5, retry_at=:val6 remove pending"
+            expressionAttributeValues.update({
+                ':val4': productData['tx_attempts'],
+                ':val5': productData['sku'],
+                ':val6': productData['retry_at']
+            })
+        else:
+            # Dead-lettered: no more retries until the item is staged again.
+            updateExpression += ", tx_attempts=:val4 remove pending, failed, retry_at"
+            expressionAttributeValues[':val4'] = productData['tx_attempts']
+        response = self.writePool.call(
+            self.writeDynamodb.Table(tableName).update_item,
             Key={
                 'id': productData['id']
             },
-            UpdateExpression="set updated_at=:val0, tx_status=:val1, tx_note=:val2, product_id=:val3",
-            ExpressionAttributeValues={
-                ':val0': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-                ':val1': productData['tx_status'],
-                ':val2': productData['tx_note'],
-                ':val3': productData['product_id']
-            },
-            ReturnValues="UPDATED_NEW"
+            UpdateExpression=updateExpression,
+            ExpressionAttributeValues=expressionAttributeValues,
         )
         return response
 
-    @classmethod
-    def dataSync(cls, **params):
-        productsDataSync = cls(**params)
-        dataType = params.get("data_type")
-        dataType = dataType.strip(
-            "products-") if dataType != "products" else dataType
-        productsData = productsDataSync.getItems(
-            params.get("table_name"),
-            params.get("source")
+    def getProduct(self, productData, **params):
+        typeId = productData["data"].pop("type_id", "simple")
+        storeId = productData["data"].pop("store_id", "0")
+        txmap = params.get("txmap")
+        data = dict (
+            (k, v) for k, v in dict(
+                (
+                    k,
+                    productData["data"].get(v.get("key")) if productData["data"].get(v.get("key")) is not None else v.get("default")
+                ) for k, v in txmap.items()
+            ).items() if v is not None
         )
-        offset = 0
-        for productData in productsData:
+        return {
+            "sku": productData["sku"],
+            "attributeSet": params.get("attribute_set", "Default"),
+            "data": data,
+            "typeId": typeId,
+            "storeId": storeId
+        }
+
+    def setSynced(self, productData, productId):
+        productData['product_id'] = productId
+        productData['tx_status'] = 'S'
+        productData['tx_note'] = 'STG->MAGE2'
+        self.metrics.count("synced")
+
+    def setRetry(self, productData):
+        # Retried with an exponential backoff; after max attempts the item is dead-lettered as D.
+        attempts = int(productData.get('tx_attempts', 0)) + 1
+        productData['tx_attempts'] = attempts
+        if attempts >= self.maxAttempts:
+            productData['tx_status'] = 'D'
+            self.metrics.count("dead-lettered")
+            return
+        productData['tx_status'] = 'F'
+        productData['retry_at'] = (
+            datetime.utcnow() + timedelta(seconds=self.retryBackoff * 2 ** (attempts - 1))
+        ).strftime("%Y-%m-%d %H:%M:%S")
+
+    def setFailed(self, productData):
+        productData['product_id'] = '####'
+        productData['tx_note'] = traceback.format_exc()
+        self.setRetry(productData)
+        self.metrics.count("failed")
+
+    def setSkipped(self, productData):
+        # The product of the sku failed, so there is nothing to attach the data to.
+        productData['product_id'] = '####'
+        productData['tx_note'] = 'STG->MAGE2: skipped, the product of the sku failed.'
+        self.setRetry(productData)
+        self.metrics.count("skipped")
+
+    def syncItem(self, productData, dataType, product=None, **params):
+        try:
+            if dataType == "products":
+                product = self.getProduct(productData, **params) if product is None else product
+                with self.metrics.timer("mage2-write"):
+                    productId = self.mage2Connector.syncProduct(
+                        product["sku"], product["attributeSet"], product["data"], product["typeId"], product["storeId"]
+                    )
+            else:
+                sku = productData["sku"]
+                data = productData["data"]
+                if dataType == "inventory" and productData.get("stock_store_ids"):
+                    # Only the stores with changed quantities; the connector totals a store over all its entries.
+                    data = [d for d in data if str(d["store_id"]) in productData["stock_store_ids"]]
+                with self.metrics.timer("mage2-write"):
+                    productId = self.mage2Connector.syncProductExtData(sku, dataType, data)
+            self.setSynced(productData, productId)
+        except Exception:
+            self.setFailed(productData)
+
+    def syncBatch(self, batch, **params):
+        # One transaction for the page; if it fails, each product is retried on its own so only the bad ones fail.
+        entries = []
+        for productData in batch:
             try:
-                stimems = int(round(time()*1000))
-                try:    
-                    if dataType == "products":
-                        sku = productData["sku"]
-                        typeId = productData["data"].pop("type_id", "simple")
-                        storeId = productData["data"].pop("store_id", "0")
-                        attributeSet = params.get("attribute_set", "Default")
-                        txmap = params.get("txmap")
-                        data = dict (
-                            (k, v) for k, v in dict(
-                                (
-                                    k,
-                                    productData["data"].get(v.get("key")) if productData["data"].get(v.get("key")) is not None else v.get("default")
-                                ) for k, v in txmap.items()
-                            ).items() if v is not None
+                entries.append((productData, self.getProduct(productData, **params)))
+            except Exception:
+                self.setFailed(productData)
+        if len(entries) == 0:
+            return
+        try:
+            with self.metrics.timer("mage2-batch-write"):
+                productIds = BulkUpsert(self.mage2Connector).upsertProducts(
+                    [product for productData, product in entries],
+                    attributeSet=params.get("attribute_set", "Default")
+                )
+            for productData, product in entries:
+                self.setSynced(productData, productIds[product["sku"]])
+        except Exception:
+            logger.warning("Batch of {count} falls back to per SKU: {log}".format(
+                    count=len(entries), log=traceback.format_exc()
+                )
+            )
+            self.metrics.count("batch-fallback")
+            for productData, product in entries:
+                self.syncItem(productData, "products", product=product, **params)
+
+    @classmethod
+    def getPages(cls, chains, batchSize):
+        # Pages of batchSize skus; batchSize <= 1 is the per-SKU sync.
+        page = []
+        for chain in chains:
+            if len(page) >= max(batchSize, 1):
+                yield page
+                page = []
+            page.append(chain)
+        if len(page) > 0:
+            yield page
+
+    def createOptions(self, page):
+        # Two writers adding the same new option value would each insert it in their own transaction, so the
+        # option values of the page are added and committed under optionsLock before the page is synced.
+        products = []
+        for chain in page:
+            for lane, productData in chain:
+                try:
+                    if lane["data_type"] == "products":
+                        products.append(self.getProduct(copy.deepcopy(productData), **lane))
+                    elif lane["data_type"] == "variants":
+                        products.extend(
+                            {"data": variant["attributes"]} for variant in productData["data"].get("variants", [])
                         )
-                        productData['product_id'] = productsDataSync.mage2Connector.syncProduct(sku, attributeSet, data, typeId, storeId)
-                    else:
-                        sku = productData["sku"]
-                        data = productData["data"]
-                        productData['product_id'] = productsDataSync.mage2Connector.syncProductExtData(sku, dataType, data)
-                    # productData['product_id'] = '####'
-                    productData['tx_status'] = 'S'
-                    productData['tx_note'] = 'STG->MAGE2'
-                    logger.info(json.dumps(productData, indent=4, cls=JSONEncoder, ensure_ascii=False))
                 except Exception:
-                    productData['product_id'] = '####'
-                    productData['tx_status'] = 'F'
-                    productData['tx_note'] = traceback.format_exc()
-                productsDataSync.updateItem(params.get("table_name"), productData)
-                logger.info(json.dumps(
-                        productData, indent=4, cls=JSONEncoder, ensure_ascii=False
+                    # The sync itself fails the item.
+                    continue
+        if len(products) == 0:
+            return
+        try:
+            with optionsLock:
+                BulkUpsert(self.mage2Connector).createOptions(products)
+        except Exception:
+            # E.g. an unknown attribute; the sync fails the items that have it.
+            logger.warning(traceback.format_exc())
+
+    def syncPage(self, page):
+        # The products of the page first, batched per lane, then the data attached to them sku by sku.
+        stimems = int(round(time()*1000))
+        if self.mage2Workers > 1:
+            self.createOptions(page)
+        for lane in self.lanes:
+            if lane["data_type"] != "products":
+                continue
+            batch = [productData for chain in page for _lane, productData in chain if _lane is lane]
+            if len(batch) > 1:
+                self.syncBatch(batch, **lane)
+            elif len(batch) == 1:
+                self.syncItem(batch[0], "products", **lane)
+        for chain in page:
+            failed = any(lane["data_type"] == "products" and productData["tx_status"] != "S" for lane, productData in chain)
+            for lane, productData in chain:
+                if lane["data_type"] == "products":
+                    continue
+                if failed:
+                    self.setSkipped(productData)
+                else:
+                    self.syncItem(productData, lane["data_type"], **lane)
+        return int(round(time()*1000)) - stimems
+
+    def syncPartition(self, slot, pages, stop, results):
+        # A writer thread on its own connection of the shared tunnel; once stopped, it finishes the page at hand.
+        try:
+            worker = copy.copy(self)
+            worker.mage2Connector = self.mage2Connection.getConnector(slot=slot)
+            for page in pages:
+                if stop.is_set():
+                    break
+                results.put((page, worker.syncPage(page)))
+        except Exception:
+            # The rest of the partition stays pending for the next run. Nothing drains this partition any more,
+            # so the feeder and the other writers are stopped instead of waiting on it.
+            logger.error(traceback.format_exc())
+            stop.set()
+        finally:
+            results.put(None)
+
+    @staticmethod
+    def iterPartition(partition, stop):
+        # The chains of a writer until the feeder ends the partition; once stopped, an empty partition ends
+        # it as well, since the feeder gives up on a full one.
+        while True:
+            try:
+                chain = partition.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return
+                continue
+            if chain is None:
+                return
+            yield chain
+
+    @staticmethod
+    def putPartition(partition, chain, stop):
+        # A stopped writer no longer drains its queue, so give up once stopped.
+        while True:
+            try:
+                partition.put(chain, timeout=0.1)
+                return True
+            except queue.Full:
+                if stop.is_set():
+                    return False
+
+    def feedPartitions(self, chains, partitions, stop):
+        # Route the skus to the writers as the pages are read; None ends a partition.
+        try:
+            for chain in chains:
+                if stop.is_set():
+                    break
+                # A sku always goes to the same writer, so no two connections touch one entity.
+                slot = zlib.crc32(chain[0][1]["sku"].encode("utf-8")) % len(partitions)
+                self.putPartition(partitions[slot], chain, stop)
+        except Exception:
+            # The unread items stay pending for the next run.
+            logger.error(traceback.format_exc())
+        finally:
+            for partition in partitions:
+                self.putPartition(partition, None, stop)
+
+    def iterPages(self, chains, batchSize, stop):
+        # The synced pages with the ms of their sync, as the writers finish them.
+        if self.mage2Workers <= 1:
+            for page in self.getPages(chains, batchSize):
+                if stop.is_set():
+                    return
+                yield page, self.syncPage(page)
+            return
+
+        partitions = [queue.Queue(maxsize=max(batchSize, 1) * 2) for slot in range(self.mage2Workers)]
+        results = queue.Queue()
+        threads = [
+            threading.Thread(
+                target=self.syncPartition,
+                args=(slot, self.getPages(self.iterPartition(partition, stop), batchSize), stop, results)
+            ) for slot, partition in enumerate(partitions)
+        ]
+        threads.append(threading.Thread(target=self.feedPartitions, args=(chains, partitions, stop)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        running = len(partitions)
+        while running > 0:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+            yield result
+
+    def writeBack(self, page):
+        for chain in page:
+            self.done.add(chain[0][1]["sku"])
+            for lane, productData in chain:
+                # Queued for the background writer while the next product goes to Magento.
+                self.statusWriter.put((lane["table_name"], productData['id']), lane["table_name"], productData)
+                if self.metrics.isSampled():
+                    logger.info(json.dumps(
+                            productData, indent=4, cls=JSONEncoder, ensure_ascii=False
+                        )
                     )
+        self.advanceCursor()
+
+    def dataSync(self, **params):
+        batchSize = int(params.get("batch_size", os.environ.get("BATCHSIZE", 0)))
+        # Streamed, so the first sku syncs after one page read of each lane.
+        chains = self.iterChains()
+        offset = 0
+        stop = threading.Event()
+        pages = self.iterPages(chains, batchSize, stop)
+        try:
+            for page, syncms in pages:
+                # The latency is tracked per stage: the Magento sync and queueing the status write.
+                # Every item of a page reports the page, the cost of the next step at a page boundary.
+                spendms = {"sync": syncms}
+                stimems = int(round(time()*1000))
+                self.writeBack(page)
+                spendms["write"] = int(round(time()*1000)) - stimems
+                for entry in itertools.chain(*page):
+                    offset += 1
+                    self.metrics.tick()
+                    yield offset, self.getTotal(), spendms
+        except GeneratorExit:
+            # Closed for a hand-off; the writers finish the pages at hand and their statuses are still written back.
+            # The connections stay open for the next invocation of this container.
+            stop.set()
+            for page, syncms in pages:
+                self.writeBack(page)
+        finally:
+            # The outstanding status writes are flushed before the hand-off or the end of the invocation.
+            for future in self.statusWriter.close():
+                if future.exception() is not None:
+                    logger.error(future.exception())
+            # The option ids learned by the run are written to the metadata cache file once.
+            if self.mage2Connection.metadataCache is not None:
+                self.mage2Connection.metadataCache.flush()
+            logger.info("Write pool: {stats}".format(
+                    stats=json.dumps(dict(self.writePool.stats(), **self.statusWriter.stats()))
                 )
-            
-                offset += 1
-                spendms = int(round(time()*1000)) - stimems
-                yield offset, len(productsData), spendms
-            except Exception:
-                del productsDataSync.mage2Connector
-                break
+            )
+            self.metrics.flush()
 
 def handler(event, context):
     # TODO implement
@@ -158,50 +552,49 @@ def handler(event, context):
     else:
         lastRequestId = context.aws_request_id # keep request id for next invokation
     
-    mage2Setting = event.get("mage2_setting")
-    with SSHTunnelForwarder(
-        (mage2Setting['SSHSERVER'], mage2Setting['SSHSERVERPORT']),
-        ssh_username=mage2Setting['SSHUSERNAME'],
-        ssh_pkey=mage2Setting.get('SSHPKEY'),
-        ssh_password=mage2Setting.get('SSHPASSWORD'),
-        remote_bind_address=(
-            mage2Setting['REMOTEBINDSERVER'], mage2Setting['REMOTEBINDSERVERPORT']
-        ),
-        local_bind_address=(
-            mage2Setting['LOCALBINDSERVER'], mage2Setting['LOCALBINDSERVERPORT']
+    try:
+        # Seeded with the latency estimates of the previous loop.
+        timeBudget = TimeBudget(
+            estimates=event.get("time_budget"),
+            reserveMs=int(event.get("handoff_reserve_ms", os.environ.get("HANDOFFRESERVEMS", 3000)))
         )
-    ) as server:
-        try:
-            maxspendms = 0
-            logger.info("Allow MS/Loop: {allowms}/{loop}".format(
-                allowms=context.get_remaining_time_in_millis(), 
-                loop=int(event.get("loop", "0")))
-            )
-            nextLoop = lambda offset, total, maxspendms: \
-                context.get_remaining_time_in_millis() - maxspendms*5 <= 0 and total - offset > 0
-            
-            dataSync = ProductsDataSyncMage2.dataSync(**event)
-            for offset, total, spendms in dataSync:
-                maxspendms = spendms if spendms > maxspendms else maxspendms
-                if nextLoop(offset, total, maxspendms):
-                    loop = int(event.get("loop", "0")) + 1
-                    assert  loop <= 100, "Over the limit of loops."
-                    payload = dict(event, **{"loop": str(loop)})
-                    logger.info("payload: {payload}".format(
-                            payload=json.dumps(payload, indent=4, cls=JSONEncoder, ensure_ascii=False)
-                        )
+        logger.info("Allow MS/Loop: {allowms}/{loop}".format(
+            allowms=context.get_remaining_time_in_millis(), 
+            loop=int(event.get("loop", "0")))
+        )
+        
+        runId = event.get("run_id", uuid.uuid4().hex)
+        productsDataSync = ProductsDataSyncMage2(**event)
+        dataSync = productsDataSync.dataSync(**event)
+        for offset, total, spendms in dataSync:
+            timeBudget.record(spendms)
+            if timeBudget.shouldHandOff(context.get_remaining_time_in_millis(), total - offset):
+                loop = int(event.get("loop", "0")) + 1
+                assert  loop <= 100, "Over the limit of loops."
+                # The next loop starts once this one is written back, at the cursor past the last written sku.
+                dataSync.close()
+                productsDataSync.putCursor(runId, loop)
+                payload = dict(
+                    event,
+                    **{
+                        "loop": str(loop),
+                        "time_budget": timeBudget.getEstimates(),
+                        "run_id": runId,
+                        "cursor": productsDataSync.cursor
+                    }
+                )
+                logger.info("payload: {payload}".format(
+                        payload=json.dumps(payload, indent=4, cls=JSONEncoder, ensure_ascii=False)
                     )
-                    ProductsDataSyncMage2.invoke(context.invoked_function_arn, payload)
-                    dataSync.throw(Exception("Database connection is closed."))
-                    break
-        except Exception:
-            log = traceback.format_exc()
-            logger.exception(log)
-            boto3.client("sns").publish(
-                TopicArn=os.environ["SNSTOPICARN"],
-                Subject=context.invoked_function_arn,
-                MessageStructure="json",
-                Message=json.dumps({"default": log})
-            )
-        server.stop()
-        server.close()
\ No newline at end of file
+                )
+                ProductsDataSyncMage2.invoke(context.invoked_function_arn, payload)
+                break
+    except Exception:
+        log = traceback.format_exc()
+        logger.exception(log)
+        boto3.client("sns").publish(
+            TopicArn=os.environ["SNSTOPICARN"],
+            Subject=context.invoked_function_arn,
+            MessageStructure="json",
+            Message=json.dumps({"default": log})
+        )
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# The Lambda functions import their layer modules from /opt; the tests put the source directories on the path instead.
+import sys, os, importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in ("taskqueue/common", "taskqueue/syncproductsdata", "taskqueue/syncproductsdatamage2"):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+os.environ.setdefault("LOGGINGLEVEL", "logging.ERROR")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("SNSTOPICARN", "arn:aws:sns:us-east-1:000000000000:googlesheets_pim_mage2_log")
+
+
+def loadTasks(function):
+    # Both functions name their module tasks.py, so each one is loaded under the name of its function.
+    name = "{function}_tasks".format(function=function)
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "taskqueue", function, "tasks.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
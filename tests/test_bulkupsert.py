@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from bulkupsert import BulkUpsert
+
+ATTRIBUTES = {
+    "name": {"attribute_id": 73, "backend_type": "varchar", "frontend_input": "text"},
+    "price": {"attribute_id": 77, "backend_type": "decimal", "frontend_input": "price"},
+    "color": {"attribute_id": 93, "backend_type": "int", "frontend_input": "select"},
+    "material": {"attribute_id": 136, "backend_type": "varchar", "frontend_input": "multiselect"},
+    "has_options": {"attribute_id": 40, "backend_type": "static", "frontend_input": "boolean"}
+}
+
+
+class FakeMySQLCursor(object):
+    # The tables BulkUpsert reads, answered from memory; the writes are recorded.
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+        self.executed = []
+        self.replaced = {}
+
+    def execute(self, sql, params=None):
+        database = self.database
+        self.executed.append((" ".join(sql.split()), params))
+        self.rows = []
+        if sql.startswith("SELECT sku, entity_id FROM catalog_product_entity"):
+            self.rows = [{"sku": sku, "entity_id": database.entities[sku]} for sku in params if sku in database.entities]
+        elif "INSERT INTO catalog_product_entity" in sql:
+            for i in range(0, len(params), 3):
+                database.entities[params[i+2]] = max(database.entities.values()) + 1
+        elif "FROM eav_attribute t1, eav_entity_type t2" in sql:
+            self.rows = [
+                dict(ATTRIBUTES[code], attribute_code=code, entity_type_id=4) for code in params[:-1] if code in ATTRIBUTES
+            ]
+        elif "FROM eav_attribute_option t1" in sql:
+            self.rows = [
+                {"attribute_id": attributeId, "value": value, "option_id": optionId}
+                for (attributeId, value), optionId in database.options.items() if attributeId in params and value in params
+            ]
+        elif "SELECT attribute_id, entity_id AS id" in sql:
+            self.rows = [
+                {"attribute_id": attributeId, "id": productId}
+                for attributeId, productId in database.adminValues if attributeId in params and productId in params
+            ]
+        elif "FROM store" in sql:
+            self.rows = [{"store_id": storeId, "website_id": 2} for storeId in params if storeId == "1"]
+
+    def executemany(self, sql, params):
+        self.replaced.setdefault(sql.split()[2] if sql.startswith("REPLACE") else "catalog_product_website", []).extend(params)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeAdaptor(object):
+    def __init__(self, database):
+        self.mySQLCursor = FakeMySQLCursor(database)
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.entities = {"A": 10}
+        self.options = {(93, "Red"): 5}
+        # A already has a name in the admin store.
+        self.adminValues = set([(73, 10)])
+
+
+class FakeConnector(object):
+    setting = {"VERSION": "CE"}
+
+    def __init__(self, database):
+        self.database = database
+        self.adaptor = FakeAdaptor(database)
+
+    def getEntityMetaData(self, entityTypeCode, attributeSet):
+        return {"attribute_set_id": 4}
+
+    def setAttributeOptionValues(self, attributeId, options, adminStoreId=0):
+        optionId = max(self.database.options.values()) + 1
+        self.database.options[(attributeId, options[0])] = optionId
+        return optionId
+
+
+def getProduct(sku, data, typeId="simple", storeId="1"):
+    return {"sku": sku, "attributeSet": "Default", "data": data, "typeId": typeId, "storeId": storeId}
+
+
+def test_upsertProducts():
+    connector = FakeConnector(FakeDatabase())
+    products = [
+        getProduct("A", {"name": "Alpha", "price": "9.5", "color": "Red"}),
+        getProduct("B", {"name": "Beta", "color": "Blue", "material": "Cotton|Silk", "has_options": "0"}, typeId="configurable"),
+        getProduct("C", {"price": "3"}, storeId="0")
+    ]
+    productIds = BulkUpsert(connector).upsertProducts(products)
+    # The existing sku keeps its entity id and the new ones are inserted in one statement.
+    assert productIds == {"A": 10, "B": 11, "C": 12}
+    executed = connector.adaptor.mySQLCursor.executed
+    inserts = [params for sql, params in executed if sql.startswith("INSERT INTO catalog_product_entity")]
+    assert inserts == [[4, "configurable", "B", 4, "simple", "C"]]
+    updates = [params for sql, params in executed if sql.startswith("UPDATE catalog_product_entity")]
+    assert updates == [[4, "simple", 10]]
+    # One REPLACE per backend table; the option values are their ids, a new one added, and static is left out.
+    replaced = connector.adaptor.mySQLCursor.replaced
+    assert sorted(replaced.keys()) == ["catalog_product_entity_decimal", "catalog_product_entity_int",
+                                       "catalog_product_entity_varchar", "catalog_product_website"]
+    assert sorted(replaced["catalog_product_entity_varchar"]) == sorted([
+        [10, 73, "1", "Alpha"], [11, 73, 0, "Beta"], [11, 136, 0, "7,8"]
+    ])
+    assert sorted(replaced["catalog_product_entity_decimal"]) == [[10, 77, 0, "9.5"], [12, 77, 0, "3"]]
+    assert sorted(replaced["catalog_product_entity_int"]) == [[10, 93, 0, 5], [11, 93, 0, 6]]
+    assert sorted(replaced["catalog_product_website"]) == [[10, 2], [11, 2], [12, 1]]
+    assert (connector.adaptor.commits, connector.adaptor.rollbacks) == (1, 0)
+
+
+def test_upsertProducts_unknownAttribute():
+    # An unknown attribute rolls the whole page back.
+    connector = FakeConnector(FakeDatabase())
+    try:
+        BulkUpsert(connector).upsertProducts([getProduct("A", {"name": "Alpha", "colour": "Red"})])
+        assert False, "An unknown attribute is accepted."
+    except Exception as e:
+        assert str(e) == "Entity Type/Attribute Code: catalog_product/colour does not exist"
+    assert (connector.adaptor.commits, connector.adaptor.rollbacks) == (0, 1)
+    assert connector.adaptor.mySQLCursor.replaced == {}
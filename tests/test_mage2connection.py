@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import pytest
+import mage2connection
+from mage2connection import getMage2Connection
+
+SETTING = {
+    "SSHSERVER": "bastion", "SSHSERVERPORT": 22, "SSHUSERNAME": "ec2-user",
+    "REMOTEBINDSERVER": "db", "REMOTEBINDSERVERPORT": 3306, "LOCALBINDSERVER": "127.0.0.1", "LOCALBINDSERVERPORT": 10022
+}
+
+
+class FakeDatabase(object):
+    # The MySQL server behind the tunnel: a connection answers once the database is up and until it is dropped.
+    def __init__(self, downFor=0):
+        self.downFor = downFor
+        self.connectors = []
+
+
+class FakeCursor(object):
+    def __init__(self, database):
+        self.database = database
+        self.dropped = False
+
+    def execute(self, sql, params=None):
+        if self.database.downFor > 0:
+            self.database.downFor -= 1
+            raise Exception("Can't connect to MySQL server.")
+        if self.dropped:
+            raise Exception("MySQL server has gone away.")
+
+    def fetchone(self):
+        return (1,)
+
+
+class FakeAdaptor(object):
+    def __init__(self, database):
+        self.mySQLCursor = FakeCursor(database)
+
+
+class FakeForwarder(object):
+    started = []
+
+    def __init__(self, sshAddress, **kwargs):
+        self.is_active = False
+        self.tunnel_is_up = {}
+
+    def start(self):
+        self.is_active = True
+        self.tunnel_is_up = {("127.0.0.1", 10022): True}
+        FakeForwarder.started.append(self)
+
+    def check_tunnels(self):
+        pass
+
+    def stop(self):
+        self.is_active = False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+
+    def connector(setting=None, logger=None):
+        mage2Connector = type("FakeMage2Connector", (object,), {})()
+        mage2Connector.adaptor = FakeAdaptor(database)
+        database.connectors.append(mage2Connector)
+        return mage2Connector
+
+    monkeypatch.setenv("METADATACACHETTL", "0")
+    monkeypatch.setattr(mage2connection, "connections", {})
+    monkeypatch.setattr(mage2connection, "Mage2Connector", connector)
+    monkeypatch.setattr(mage2connection, "SSHTunnelForwarder", FakeForwarder)
+    monkeypatch.setattr(FakeForwarder, "started", [])
+    return database
+
+
+def test_reuse(database):
+    # A warm container gets the same tunnel and connection back after a ping.
+    mage2Connection = getMage2Connection(SETTING)
+    mage2Connector = mage2Connection.getConnector()
+    assert getMage2Connection(dict(SETTING)) is mage2Connection
+    assert getMage2Connection(SETTING).getConnector() is mage2Connector
+    assert len(database.connectors) == 1
+    assert len(FakeForwarder.started) == 1
+    assert mage2Connection.counters == {"reuses": 1, "reconnects": 0, "tunnels": 1}
+
+
+def test_reconnect(database):
+    # A connection that fails the ping is reopened through the tunnel if it is up, and through a new one if not.
+    mage2Connection = getMage2Connection(SETTING)
+    mage2Connector = mage2Connection.getConnector()
+    mage2Connector.adaptor.mySQLCursor.dropped = True
+    reopened = mage2Connection.getConnector()
+    assert reopened is not mage2Connector
+    assert len(FakeForwarder.started) == 1
+    assert mage2Connection.counters == {"reuses": 0, "reconnects": 1, "tunnels": 1}
+    reopened.adaptor.mySQLCursor.dropped = True
+    mage2Connection.tunnel.tunnel_is_up = {("127.0.0.1", 10022): False}
+    mage2Connection.getConnector()
+    assert len(FakeForwarder.started) == 2
+    assert not FakeForwarder.started[0].is_active
+    assert mage2Connection.counters == {"reuses": 0, "reconnects": 2, "tunnels": 2}
+
+
+def test_slots(database):
+    # Each slot is its own connection through the shared tunnel.
+    mage2Connection = getMage2Connection(SETTING)
+    assert mage2Connection.getConnector(slot=0) is not mage2Connection.getConnector(slot=1)
+    assert len(FakeForwarder.started) == 1
+
+
+def test_waitReady(database):
+    # The connection is probed until the tunnel forwards instead of sleeping a fixed time.
+    database.downFor = 3
+    mage2Connection = mage2connection.Mage2Connection(SETTING, readyTimeout=5, probeInterval=0.001)
+    mage2Connector = mage2Connection.getConnector()
+    assert len(database.connectors) == 4
+    assert mage2Connection.mage2Connectors == {0: mage2Connector}
+
+
+def test_waitReady_timeout(database):
+    database.downFor = 1000
+    mage2Connection = mage2connection.Mage2Connection(SETTING, readyTimeout=0.05, probeInterval=0.001)
+    try:
+        mage2Connection.getConnector()
+        assert False, "A connection that never answers is returned."
+    except Exception as e:
+        assert str(e) == "Mage2 DB connection is not ready in 0.05s."
+    assert mage2Connection.mage2Connectors == {}
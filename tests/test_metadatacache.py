@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+import json
+from metadatacache import MetadataCache
+
+
+def test_flush(tmpdir, monkeypatch):
+    # The option ids are saved once by flush, not on every lookup.
+    metadataCache = MetadataCache(str(tmpdir.join("mage2metadata.json")))
+    saves = []
+    save = metadataCache.save
+    monkeypatch.setattr(metadataCache, "save", lambda: saves.append(1) or save())
+    for i in range(100):
+        metadataCache.setOptionId(93, "Value {i}".format(i=i), i)
+    metadataCache.invalidateOptions(93, ["Value 0"])
+    assert saves == []
+    metadataCache.flush()
+    metadataCache.flush()
+    assert saves == [1]
+    with open(metadataCache.path) as f:
+        assert len(json.load(f)["options"]["93"]) == 99
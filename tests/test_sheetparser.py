@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import csv, hashlib
+from datetime import datetime
+from sheetparser import iterLines, getColumnPlan, getRow, getProductData, getCellValue
+from metrics import Metrics
+
+
+class FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+
+def test_iterLines():
+    # Multi-byte characters and quoted newlines split over the chunk boundaries.
+    content = 'sku,name\nA,"Café\nCrème"\nB,Über\n'.encode("utf-8")
+    fingerprint = hashlib.sha256()
+    rows = list(csv.reader(iterLines(FakeResponse(content), "utf-8", bufferSize=3, fingerprint=fingerprint)))
+    assert rows == [["sku", "name"], ["A", "Café\nCrème"], ["B", "Über"]]
+    assert fingerprint.hexdigest() == hashlib.sha256(content).hexdigest()
+
+
+def test_iterLines_metrics():
+    content = b"sku,name\nA,Alpha\n"
+    metrics = Metrics(emit=lambda record: None)
+    list(iterLines(FakeResponse(content), "utf-8", bufferSize=4, metrics=metrics))
+    assert len(metrics.timings["fetch"]) == len(metrics.timings["decode"]) == 5
+    metrics = Metrics(emit=lambda record: None)
+    list(iterLines(FakeResponse(content), "utf-8", bufferSize=4, metrics=metrics, fetchStage=None))
+    assert list(metrics.timings.keys()) == ["decode"]
+
+
+def test_getProductData():
+    plan = getColumnPlan(["SKU", "Type/ID", "Attribute Name 1", "Attribute Value 1", "Tags"])
+    row = getRow(plan, [" A ", "simple", "Size (EU)", "42", "x|y"])
+    assert row == {"sku": "A", "type_id": "simple", "attribute_name_1": "Size (EU)", "attribute_value_1": "42", "tags": ["x", "y"]}
+    row.pop("sku")
+    assert getProductData(plan, row) == {"type_id": "simple", "size_eu": "42", "tags": ["x", "y"]}
+    assert plan["codes"] == {"Size (EU)": "size_eu"}
+
+
+def test_getCellValue():
+    assert getCellValue(None) == ""
+    assert getCellValue(True) == "TRUE"
+    assert getCellValue(3.0) == "3"
+    assert getCellValue(0.1 + 0.2) == "0.3"
+    assert getCellValue(1234.5, "#,##0.00") == "1,234.50"
+    assert getCellValue(0.125, "0.0%") == "12.5%"
+    # Unrendered formats fall back to General.
+    assert getCellValue(5, '"$"#,##0.00') == "5"
+    # m is the month, or the minute next to an hour or a second.
+    assert getCellValue(datetime(2020, 11, 2, 9, 5, 7), "dd/mm/yy h:mm:ss") == "02/11/20 9:05:07"
+    assert getCellValue(datetime(2020, 11, 2, 21, 5), "[$-409]mmmm d, yyyy hh:mm AM/PM") == "November 2, 2020 09:05 PM"
+    assert getCellValue(datetime(2020, 11, 2), "General") == "2020-11-02 00:00:00"
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import copy, os
+from conftest import loadTasks
+from spillstore import SpillStore
+from metrics import Metrics
+
+tasks = loadTasks("syncproductsdata")
+ProductsDataSync = tasks.ProductsDataSync
+
+INVENTORY = [
+    {"sku": "B", "warehouse": "w1", "qty": "2", "store_id": "1"},
+    {"sku": "A", "warehouse": "w1", "qty": "5", "store_id": "1", "full": "TRUE"},
+    {"sku": "A", "warehouse": "w2", "qty": "1.5"},
+    {"sku": "C", "warehouse": "w2", "qty": "x"},
+    {"sku": "A", "warehouse": "w1", "qty": "7", "store_id": "1", "full": "TRUE"},
+    {"sku": "B", "warehouse": "w2", "qty": "3", "store_id": "2"}
+]
+
+VARIANTS = [
+    {"sku": "A", "variant_sku": "A-1", "color": "Red"},
+    {"sku": "B", "variant_sku": "B-1", "color": "Green"},
+    {"sku": "A", "variant_sku": "A-2", "color": "Blue", "variant_visibility": "TRUE"}
+]
+
+
+def getSync():
+    productsDataSync = ProductsDataSync.__new__(ProductsDataSync)
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    return productsDataSync
+
+
+def test_iterGroups():
+    # The groups of groupRows, one sku at a time in sku order.
+    spillStore = SpillStore()
+    try:
+        spillStore.addRows(iter(INVENTORY), "sku", "warehouse")
+        assert list(spillStore.iterGroups()) == sorted(ProductsDataSync.groupRows(INVENTORY, "sku", "warehouse").items())
+    finally:
+        spillStore.close()
+
+
+def test_getSpilledDataSet():
+    # The spilled build gives the rows and hashes of the in-memory one.
+    productsDataSync = getSync()
+    for rows, keys, builder in (
+        (INVENTORY, ("sku", "warehouse"), productsDataSync.setInventory),
+        (VARIANTS, ("sku",), productsDataSync.setVariants)
+    ):
+        expected = sorted(builder(ProductsDataSync.groupRows(copy.deepcopy(rows), *keys)), key=lambda row: row["sku"])
+        spilled, total = productsDataSync.getSpilledDataSet(iter(copy.deepcopy(rows)), keys, builder)
+        try:
+            assert total == len(expected)
+            assert list(spilled) == expected
+            dataType = "inventory" if builder == productsDataSync.setInventory else None
+            assert [ProductsDataSync.getDataHash(row["data"], dataType) for row in spilled] == \
+                [ProductsDataSync.getDataHash(row["data"], dataType) for row in expected]
+        finally:
+            spilled.store.close()
+
+
+def test_select_close():
+    # The delta keeps the changed skus and appends the removed ones; close() removes the file.
+    productsDataSync = getSync()
+    spilled, total = productsDataSync.getSpilledDataSet(
+        iter(copy.deepcopy(INVENTORY)), ("sku", "warehouse"), productsDataSync.setInventory
+    )
+    path = spilled.store.path
+    assert os.path.exists(path)
+    spilled.select(["B"], ["D"])
+    assert [(row["sku"], row["data"] is None) for row in spilled] == [("B", False), ("D", True)]
+    assert len(spilled) == 2
+    spilled.store.close()
+    assert not os.path.exists(path)
@@ -0,0 +1,751 @@
+# -*- coding: utf-8 -*-
+import copy, hashlib, os
+from decimal import Decimal
+from botocore.exceptions import ClientError
+from conftest import loadTasks
+from sheetparser import getColumnPlan, getRow
+from writepool import WritePool
+from metrics import Metrics
+
+tasks = loadTasks("syncproductsdata")
+ProductsDataSync = tasks.ProductsDataSync
+
+
+def getSync():
+    # The builders only need the instance for the class helpers; no AWS resource is touched.
+    return ProductsDataSync.__new__(ProductsDataSync)
+
+
+def getRows(header, lines):
+    plan = getColumnPlan(header)
+    return plan, [getRow(plan, values) for values in lines]
+
+
+def bySku(rows):
+    return sorted(rows, key=lambda row: row["sku"])
+
+
+def test_groupRows():
+    rows = [
+        {"sku": "A", "warehouse": "w1", "qty": "1"},
+        {"sku": "B", "warehouse": "w1", "qty": "2"},
+        {"sku": "A", "warehouse": "w2", "qty": "3"},
+        {"sku": "A", "warehouse": "w1", "qty": "4"}
+    ]
+    assert ProductsDataSync.groupRows(rows, "sku") == {"A": [rows[0], rows[2], rows[3]], "B": [rows[1]]}
+    assert ProductsDataSync.groupRows(rows, "sku", "warehouse") == {
+        "A": {"w1": [rows[0], rows[3]], "w2": [rows[2]]},
+        "B": {"w1": [rows[1]]}
+    }
+
+
+def test_setProducts():
+    plan, rows = getRows(
+        ["SKU", "Name", "Attribute Name 1", "Attribute Value 1", "Attribute Name 2", "Attribute Value 2", "Category"],
+        [
+            ["A", "Alpha", "Color", "Red", "Size (EU)", "", "a|b"],
+            ["B", "Beta", "Color", "Blue", "", "", ""]
+        ]
+    )
+    products = getSync().setProducts(ProductsDataSync.groupRows(rows, "sku"), plan)
+    assert bySku(products) == [
+        {"sku": "A", "data": {"name": "Alpha", "color": "Red", "category": ["a", "b"]}},
+        {"sku": "B", "data": {"name": "Beta", "color": "Blue"}}
+    ]
+
+
+def test_setInventory():
+    rows = [
+        {"sku": "A", "warehouse": "w1", "qty": "5", "store_id": "1", "full": "TRUE"},
+        {"sku": "A", "warehouse": "w2", "qty": "x"},
+        {"sku": "A", "warehouse": "w1", "qty": "7", "store_id": "1", "full": "TRUE"},
+        # B has no w2 row: the old builder crossed every sku with every warehouse and crashed on it.
+        {"sku": "B", "warehouse": "w1", "qty": "0"}
+    ]
+    inventories = getSync().setInventory(ProductsDataSync.groupRows(rows, "sku", "warehouse"))
+    assert bySku(inventories) == [
+        {
+            "sku": "A",
+            "data": [
+                {
+                    "store_id": "1", "warehouse": "w1", "on_hand": Decimal("7"), "past_on_hand": 0,
+                    "qty": Decimal("7"), "full": True, "in_stock": True
+                },
+                {
+                    "store_id": 0, "warehouse": "w2", "on_hand": 0, "past_on_hand": 0,
+                    "qty": Decimal("0"), "full": False, "in_stock": False
+                }
+            ]
+        },
+        {
+            "sku": "B",
+            "data": [
+                {
+                    "store_id": 0, "warehouse": "w1", "on_hand": 0, "past_on_hand": 0,
+                    "qty": Decimal("0"), "full": False, "in_stock": False
+                }
+            ]
+        }
+    ]
+
+
+def test_setImageGallery():
+    rows = [
+        {"sku": "A", "type": "media_gallery", "value": "a1.jpg"},
+        {"sku": "A", "type": "thumbnail", "value": "a2.jpg", "label": "Thumb"},
+        {"sku": "B", "type": "media_gallery", "value": "b1.jpg"}
+    ]
+    galleries = getSync().setImageGallery(ProductsDataSync.groupRows(rows, "sku"))
+    media = lambda value, **kwargs: dict(
+        {"value": value, "store_id": "0", "position": "1", "media_source": "CSV", "media_type": "image"}, **kwargs
+    )
+    assert bySku(galleries) == [
+        {
+            "sku": "A",
+            "data": {
+                "media_gallery": [media("a1.jpg"), media("a2.jpg", label="Thumb")],
+                "image": "a1.jpg", "small_image": "a1.jpg", "thumbnail": "a2.jpg", "swatch_image": "a1.jpg"
+            }
+        },
+        {
+            "sku": "B",
+            "data": {
+                "media_gallery": [media("b1.jpg")],
+                "image": "b1.jpg", "small_image": "b1.jpg", "thumbnail": "b1.jpg", "swatch_image": "b1.jpg"
+            }
+        }
+    ]
+
+
+def test_setVariants():
+    rows = [
+        {"sku": "A", "variant_sku": "A-1", "store_id": "0", "variant_visibility": "TRUE", "color": "Red", "size": ""},
+        {"sku": "A", "variant_sku": "A-2", "color": "Blue"},
+        {"sku": "B", "variant_sku": "B-1", "variant_visibility": "FALSE", "color": "Green"}
+    ]
+    variants = getSync().setVariants(ProductsDataSync.groupRows(copy.deepcopy(rows), "sku"))
+    assert bySku(variants) == [
+        {
+            "sku": "A",
+            "data": {
+                "variants": [
+                    {"variant_sku": "A-2", "attributes": {"color": "Blue"}},
+                    {"variant_sku": "A-1", "attributes": {"color": "Red"}}
+                ],
+                "store_id": "0",
+                "variant_visibility": True
+            }
+        },
+        {
+            "sku": "B",
+            "data": {
+                "variants": [{"variant_sku": "B-1", "attributes": {"color": "Green"}}],
+                "variant_visibility": False
+            }
+        }
+    ]
+
+
+def test_setCustomOption():
+    rows = [
+        {"sku": "A", "title": "Engraving", "type": "field", "option_price": "5", "option_value_title": "Text"},
+        {"sku": "A", "title": "Gift Wrap", "type": "checkbox", "option_value_title": "Yes", "option_value_price": "2"},
+        {"sku": "A", "title": "Gift Wrap", "type": "checkbox", "option_value_title": "No"},
+        # B has no Gift Wrap rows: the old builder crossed every sku with every title.
+        {"sku": "B", "title": "Engraving", "type": "field", "is_require": "1", "option_value_title": "Text"}
+    ]
+    options = getSync().setCustomOption(ProductsDataSync.groupRows(copy.deepcopy(rows), "sku", "title"))
+    value = lambda title, **kwargs: dict(
+        {"option_value_title": title, "store_id": "0", "option_value_sort_order": "1"}, **kwargs
+    )
+    assert bySku(options) == [
+        {
+            "sku": "A",
+            "data": [
+                {
+                    "title": "Engraving", "store_id": "0", "type": "field", "is_require": "0", "sort_order": "1",
+                    "option_price": "5", "option_values": [value("Text")]
+                },
+                {
+                    "title": "Gift Wrap", "store_id": "0", "type": "checkbox", "is_require": "0", "sort_order": "1",
+                    "option_values": [value("No"), value("Yes", option_value_price="2")]
+                }
+            ]
+        },
+        {
+            "sku": "B",
+            "data": [
+                {
+                    "title": "Engraving", "store_id": "0", "type": "field", "is_require": "1", "sort_order": "1",
+                    "option_values": [value("Text")]
+                }
+            ]
+        }
+    ]
+
+
+def test_getDataHash():
+    # Equal content hashes the same whatever its key order and however its numbers are typed.
+    getDataHash = ProductsDataSync.getDataHash
+    assert getDataHash({"name": "A", "price": Decimal("9.50")}) == getDataHash({"price": 9.5, "name": "A"})
+    assert getDataHash({"qty": Decimal("3")}) == getDataHash({"qty": 3})
+    assert getDataHash({"name": "A"}) != getDataHash({"name": "B"})
+    # An inventory is compared by its entries in any order, on store_id, warehouse and qty only.
+    inventory = [
+        {"store_id": "1", "warehouse": "w1", "qty": Decimal("5"), "on_hand": Decimal("5"), "full": True},
+        {"store_id": "2", "warehouse": "w2", "qty": Decimal("0"), "on_hand": 0, "full": False}
+    ]
+    reordered = [dict(inventory[1], qty=0), dict(inventory[0], qty=5)]
+    assert getDataHash(inventory, "inventory") == getDataHash(reordered, "inventory")
+    changed = [inventory[0], dict(inventory[1], qty=Decimal("1"))]
+    assert getDataHash(inventory, "inventory") != getDataHash(changed, "inventory")
+    assert getDataHash(inventory, "inventory") != getDataHash(inventory[:1], "inventory")
+    # The custom options in any order; the entries of other data types keep their order.
+    options = [{"title": "Engraving", "type": "field"}, {"title": "Gift Wrap", "type": "checkbox"}]
+    assert getDataHash(options, "customoption") == getDataHash(options[::-1], "customoption")
+    assert getDataHash(options, "variants") != getDataHash(options[::-1], "variants")
+
+
+class FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeSnapshotStore(object):
+    def __init__(self, snapshots=None):
+        self.snapshots = snapshots or {}
+
+    def get(self, key):
+        return self.snapshots.get(key)
+
+    def put(self, key, value):
+        self.snapshots[key] = value
+
+
+def test_getChanges_unchanged(monkeypatch):
+    # An export byte for byte the same as the snapshot ends before anything is parsed.
+    content = b"sku,name\nA,Alpha\nB,Beta\n"
+    params = {"data_feed_url": "https://sheet/export", "source": "S", "data_type": "products", "spool_max_bytes": 8}
+    monkeypatch.setattr(tasks.requests, "get", lambda url, stream=False: FakeResponse(content))
+    productsDataSync = ProductsDataSync(**params)
+    snapshotStore = FakeSnapshotStore({
+        productsDataSync.getSnapshotKey(**params): {"fingerprint": hashlib.sha256(content).hexdigest(), "hashes": {}}
+    })
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    parsed = []
+    monkeypatch.setattr(ProductsDataSync, "getRows", lambda self, export, **params: parsed.append(export) or iter([]))
+    assert productsDataSync.getChanges(**params) is None
+    assert parsed == []
+
+
+def test_getChanges_changed(monkeypatch):
+    # A changed export is parsed from the spool (rolled over to a file past spool_max_bytes) and diffed by sku.
+    content = "sku,name\nA,Alpha\nB,Beta\n".encode("utf-8")
+    params = {
+        "data_feed_url": "https://sheet/export", "source": "S", "data_type": "products", "decode": "utf-8",
+        "spool_max_bytes": 8, "buffer_size": 4
+    }
+    monkeypatch.setattr(tasks.requests, "get", lambda url, stream=False: FakeResponse(content))
+    productsDataSync = ProductsDataSync(**params)
+    previous = {"A": productsDataSync.getDataHash({"name": "Alpha"}), "C": "removed"}
+    snapshotStore = FakeSnapshotStore({
+        productsDataSync.getSnapshotKey(**params): {"fingerprint": "stale", "hashes": previous, "ids": {}}
+    })
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    records = []
+    productsDataSync.metrics = Metrics(emit=records.append)
+    changes = productsDataSync.getChanges(**params)
+    assert changes["fingerprint"] == hashlib.sha256(content).hexdigest()
+    assert changes["rows"] == [{"sku": "B", "data": {"name": "Beta"}}, {"sku": "C", "data": None}]
+    # The download is timed once as it is fetched, and the spool read back as the decode.
+    productsDataSync.metrics.flush()
+    assert records[0]["fetch.count"] == 6
+    assert records[0]["decode.count"] == 6
+
+
+def test_dataSync_removeFails(monkeypatch):
+    # A sku whose removal fails keeps its previous hash, so the next export diffs it as removed again.
+    params = {"data_feed_url": "https://sheet/export", "source": "S", "data_type": "products", "table_name": "stg_products"}
+    changes = {
+        "rows": [{"sku": "C", "data": None}],
+        "hashes": {"A": "a"},
+        "items": {"A": {"id": "1", "created_at": "2020-01-01 00:00:00"}, "C": {"id": "3", "created_at": "2020-01-01 00:00:00"}},
+        "removed": {"C": "c"},
+        "delta": True,
+        "fingerprint": "f"
+    }
+    snapshotStore = FakeSnapshotStore()
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    monkeypatch.setattr(ProductsDataSync, "getTabChanges", lambda self, tabs, offset=0: [changes])
+    monkeypatch.setattr(ProductsDataSync, "removeItem", lambda self, tableName, **kwargs: 1/0)
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: None))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    list(ProductsDataSync.dataSync(**params))
+    snapshot = snapshotStore.get(getSync().getSnapshotKey(**params))
+    assert snapshot["hashes"] == {"A": "a", "C": "c"}
+    assert snapshot["ids"]["C"] == ["3", "2020-01-01 00:00:00"]
+
+
+class FakeStagingTable(object):
+    # No staged item is found by sku.
+    def query(self, **kwargs):
+        return {"Count": 0, "Items": []}
+
+
+def test_dataSync_writeFails(monkeypatch):
+    # A run with failed writes records no fingerprint, so the same export is diffed and the skus are staged again.
+    content = b"sku,name\nA,Alpha\nB,Beta\n"
+    params = {
+        "data_feed_url": "https://sheet/export", "source": "S", "data_type": "products", "decode": "utf-8",
+        "table_name": "stg_products"
+    }
+    monkeypatch.setattr(tasks.requests, "get", lambda url, stream=False: FakeResponse(content))
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: None))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    key = getSync().getSnapshotKey(**params)
+    snapshotStore = FakeSnapshotStore({
+        key: {
+            "fingerprint": "stale",
+            "hashes": {"A": "a", "B": "b"},
+            "ids": {"A": ["1", "2020-01-01 00:00:00"], "B": ["2", "2020-01-01 00:00:00"]}
+        }
+    })
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    monkeypatch.setattr(ProductsDataSync, "_batchWriteItems", lambda self, tableName, entities, maxRetries=5: entities)
+    list(ProductsDataSync.dataSync(**params))
+    snapshot = snapshotStore.get(key)
+    assert snapshot == {"fingerprint": None, "hashes": {"A": None, "B": None}, "ids": {}}
+
+    staged = []
+    class Sync(ProductsDataSync):
+        def __init__(self, **params):
+            super(Sync, self).__init__(**params)
+            self.dynamodb = FakeDynamodb(FakeStagingTable())
+    monkeypatch.setattr(
+        ProductsDataSync, "_batchWriteItems",
+        lambda self, tableName, entities, maxRetries=5: staged.extend(entity["sku"] for entity in entities) or []
+    )
+    list(Sync.dataSync(**params))
+    assert sorted(staged) == ["A", "B"]
+    snapshot = snapshotStore.get(key)
+    assert snapshot["fingerprint"] == hashlib.sha256(content).hexdigest()
+    assert sorted(snapshot["ids"].keys()) == ["A", "B"]
+
+
+def test_dataSync_removeFails_fingerprint(monkeypatch):
+    # A failed removal records no fingerprint either.
+    params = {"data_feed_url": "https://sheet/export", "source": "S", "data_type": "products", "table_name": "stg_products"}
+    changes = {
+        "rows": [{"sku": "C", "data": None}],
+        "hashes": {"A": "a"},
+        "items": {"C": {"id": "3", "created_at": "2020-01-01 00:00:00"}},
+        "removed": {"C": "c"},
+        "delta": True,
+        "fingerprint": "f"
+    }
+    snapshotStore = FakeSnapshotStore()
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    monkeypatch.setattr(ProductsDataSync, "getTabChanges", lambda self, tabs, offset=0: [changes])
+    monkeypatch.setattr(ProductsDataSync, "removeItem", lambda self, tableName, **kwargs: 1/0)
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: None))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    list(ProductsDataSync.dataSync(**params))
+    assert snapshotStore.get(getSync().getSnapshotKey(**params))["fingerprint"] is None
+
+
+def test_getRows_xlsx():
+    # The xlsx export renders its cells by their number formats, so it yields the rows of the CSV export.
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+    params = {"data_type": "products", "decode": "utf-8", "source": "S"}
+    productsDataSync = ProductsDataSync(**params)
+    with open(os.path.join(fixtures, "products.xlsx"), "rb") as f:
+        xlsxRows = list(productsDataSync.getRows(f.read(), export_format="xlsx", sheet_name="products", **params))
+    csvRows = list(productsDataSync.getRows(open(os.path.join(fixtures, "products.csv"), "rb"), **params))
+    assert xlsxRows == csvRows
+    assert csvRows[0] == {
+        "sku": "A-1", "name": "Alpha", "price": "12.50", "weight": "0.3", "discount": "15%", "release_date": "1/5/2020",
+        "updated_at": "2020-01-05 14:03:09", "active": "TRUE", "qty": "1,200", "attribute_name_1": "Color",
+        "attribute_value_1": "Red"
+    }
+
+
+class FakeRunsTable(object):
+    # The two updates of a sharded run on stg_runs.
+    def __init__(self, run):
+        self.run = run
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues=None):
+        if UpdateExpression.startswith("add completed_shards"):
+            self.run.setdefault("completed_shards", set()).update(ExpressionAttributeValues[":val0"])
+        else:
+            self.run["merged_at"] = ExpressionAttributeValues[":val0"]
+        return {"Attributes": dict(self.run)}
+
+
+class FakeDynamodb(object):
+    def __init__(self, table):
+        self.table = table
+
+    def Table(self, tableName):
+        return self.table
+
+
+def test_completeShard(monkeypatch):
+    # A retried shard is counted once, and a merged run is not merged again.
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: FakeSnapshotStore())
+    productsDataSync = getSync()
+    productsDataSync.dynamodb = FakeDynamodb(FakeRunsTable({"run_id": "r", "shards": Decimal("2")}))
+    complete = lambda shard: productsDataSync.completeShard({}, {}, run_id="r", shard=shard)
+    assert complete("0") is False
+    assert complete("0") is False
+    assert complete("1") is True
+    productsDataSync.completeRun(run_id="r")
+    assert complete("1") is False
+
+
+def test_mergeShards_incomplete(monkeypatch):
+    # A shard with a failed write drops the fingerprint and the ids of its failed skus from the merged snapshot.
+    ids = {"A": ["1", "2020-01-01 00:00:00"], "B": ["2", "2020-01-01 00:00:00"]}
+    snapshotStore = FakeSnapshotStore({
+        "runs/r/snapshot.json": {"fingerprint": "f", "hashes": {"A": "a", "B": "b"}, "ids": dict(ids)},
+        "runs/r/shard-0.done.json": {"fingerprint": None, "hashes": {"A": "a"}, "ids": {"A": ids["A"]}, "complete": True},
+        "runs/r/shard-1.done.json": {"fingerprint": None, "hashes": {"B": None}, "ids": {}, "complete": True}
+    })
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    snapshot = getSync().mergeShards(run_id="r", shards="2")
+    assert snapshot == {"fingerprint": None, "hashes": {"A": "a", "B": None}, "ids": {"A": ids["A"]}}
+
+
+def getInventory(sku, *entries):
+    rows = [{"sku": sku, "store_id": storeId, "warehouse": warehouse, "qty": qty} for storeId, warehouse, qty in entries]
+    return getSync().setInventory(ProductsDataSync.groupRows(rows, "sku", "warehouse"))[0]["data"]
+
+
+class FakeInventoryTable(object):
+    # Staged inventory items; a stock update is checked against the data_hash and the status of the item.
+    def __init__(self, items):
+        self.items = items
+        self.updates = []
+        self.puts = []
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        item = self.items[Key["id"]]
+        if item["data_hash"] != ExpressionAttributeValues[":val5"] or \
+            not (item["tx_status"] == ExpressionAttributeValues[":val7"] or "stock_store_ids" in item):
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": ""}}, "UpdateItem")
+        self.updates.append((Key["id"], UpdateExpression, ExpressionAttributeValues))
+
+    def put_item(self, Item):
+        self.puts.append(Item)
+
+
+def getStockSync(table):
+    productsDataSync = getSync()
+    productsDataSync.writePool = WritePool(maxWorkers=2)
+    productsDataSync.writeDynamodb = FakeDynamodb(table)
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    return productsDataSync
+
+
+def test_getStockChanges():
+    productsDataSync = getSync()
+    previous = productsDataSync.getStock(getInventory("A", ("1", "w1", "5"), ("2", "w2", "3")))
+    # Only a quantity changed: its position.
+    assert productsDataSync.getStockChanges(previous, getInventory("A", ("1", "w1", "5"), ("2", "w2", "4"))) == [1]
+    # A quantity and the entries changed: written in full.
+    assert productsDataSync.getStockChanges(
+        previous, getInventory("A", ("1", "w1", "6"), ("2", "w2", "3"), ("3", "w3", "1"))
+    ) is None
+    assert productsDataSync.getStockChanges(previous, getInventory("A", ("1", "w1", "5.0"), ("2", "w2", "3"))) is None
+
+
+def getStockEntity(productsDataSync, *entries):
+    data = getInventory("A", *entries)
+    return productsDataSync.getEntity(
+        "stg_inventory", source="I", sku="A", data=data, dataHash=productsDataSync.getDataHash(data, "inventory"),
+        item={"id": "1", "created_at": "2020-01-01 00:00:00"}
+    )
+
+
+def test_updateStock():
+    # A synced item gets the changed entry and its data_hash in one update.
+    table = FakeInventoryTable({"1": {"data_hash": "old", "tx_status": "S"}})
+    productsDataSync = getStockSync(table)
+    entity = getStockEntity(productsDataSync, ("1", "w1", "5"), ("2", "w2", "4"))
+    assert productsDataSync.updateStock("stg_inventory", entity, [1], "old") == []
+    assert table.puts == []
+    (_id, updateExpression, values), = table.updates
+    assert "data_hash=:val3" in updateExpression and values[":val3"] == entity["data_hash"]
+    assert "#data[1].qty=:qty1" in updateExpression and "#data[1].on_hand=:on_hand1" in updateExpression
+    assert "#data[0]" not in updateExpression
+    assert values[":val4"] == set(["2"])
+
+
+def test_updateStock_fullPushPending():
+    # A failed full push has no stock_store_ids: the item is written in full, not narrowed to the stock.
+    for status in ("N", "F", "D"):
+        table = FakeInventoryTable({"1": {"data_hash": "old", "tx_status": status}})
+        productsDataSync = getStockSync(table)
+        entity = getStockEntity(productsDataSync, ("1", "w1", "5"), ("2", "w2", "4"))
+        assert productsDataSync.updateStock("stg_inventory", entity, [1], "old") == []
+        assert table.updates == []
+        assert [item["data"] for item in table.puts] == [entity["data"]]
+    # A pending stock push is extended with the newly changed stores.
+    table = FakeInventoryTable({"1": {"data_hash": "old", "tx_status": "F", "stock_store_ids": set(["1"])}})
+    productsDataSync = getStockSync(table)
+    entity = getStockEntity(productsDataSync, ("1", "w1", "5"), ("2", "w2", "4"))
+    assert productsDataSync.updateStock("stg_inventory", entity, [1], "old") == []
+    assert len(table.updates) == 1 and table.puts == []
+
+
+def test_dataSync_stock(monkeypatch):
+    # A stock-only change takes the partial update; a mixed change is written in full.
+    params = {"source": "I", "data_type": "inventory", "table_name": "stg_inventory", "data_feed_url": "https://sheet/export"}
+    before = {"A": getInventory("A", ("1", "w1", "5")), "B": getInventory("B", ("1", "w1", "5"))}
+    after = {"A": getInventory("A", ("1", "w1", "6")), "B": getInventory("B", ("1", "w1", "6"), ("2", "w2", "1"))}
+    dataHash = lambda sku, data: ProductsDataSync.getDataHash(data[sku], "inventory")
+    changes = {
+        "rows": [{"sku": sku, "data": after[sku]} for sku in ("A", "B")],
+        "hashes": dict((sku, dataHash(sku, after)) for sku in ("A", "B")),
+        "items": {
+            "A": {"id": "1", "created_at": "2020-01-01 00:00:00"}, "B": {"id": "2", "created_at": "2020-01-01 00:00:00"}
+        },
+        "previous": dict(
+            (sku, {"data_hash": dataHash(sku, before), "stock": ProductsDataSync.getStock(before[sku])}) for sku in ("A", "B")
+        ),
+        "delta": True,
+        "fingerprint": "f"
+    }
+    table = FakeInventoryTable({
+        "1": {"data_hash": dataHash("A", before), "tx_status": "S"}, "2": {"data_hash": dataHash("B", before), "tx_status": "S"}
+    })
+    class Sync(ProductsDataSync):
+        def __init__(self, **params):
+            super(Sync, self).__init__(**params)
+            self.writeDynamodb = FakeDynamodb(table)
+    staged = []
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: FakeSnapshotStore())
+    monkeypatch.setattr(ProductsDataSync, "getTabChanges", lambda self, tabs, offset=0: [changes])
+    monkeypatch.setattr(
+        ProductsDataSync, "_batchWriteItems",
+        lambda self, tableName, entities, maxRetries=5: staged.extend(entity["sku"] for entity in entities) or []
+    )
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: None))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    list(Sync.dataSync(**params))
+    assert [_id for _id, updateExpression, values in table.updates] == ["1"]
+    assert staged == ["B"]
+
+
+class FakeBatchDynamodb(object):
+    # Each batch_write_item answers the ids of the next entry of unprocessed as UnprocessedItems; put_item fails once per id in failing.
+    def __init__(self, unprocessed, failing=()):
+        self.unprocessed = unprocessed
+        self.failing = list(failing)
+        self.batches = []
+        self.puts = []
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems["stg_products"]
+        self.batches.append([request["PutRequest"]["Item"]["id"] for request in requests])
+        unprocessed = self.unprocessed.pop(0) if self.unprocessed else []
+        return {
+            "UnprocessedItems": {
+                "stg_products": [request for request in requests if request["PutRequest"]["Item"]["id"] in unprocessed]
+            }
+        }
+
+    def Table(self, tableName):
+        return self
+
+    def put_item(self, Item):
+        if Item["id"] in self.failing:
+            self.failing.remove(Item["id"])
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": ""}}, "PutItem")
+        self.puts.append(dict(Item))
+
+
+def getBatchSync(dynamodb):
+    productsDataSync = getSync()
+    productsDataSync.writePool = WritePool(maxWorkers=2, baseDelay=0.001)
+    productsDataSync.writeDynamodb = dynamodb
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    return productsDataSync
+
+
+def getBatchEntities():
+    return [{"id": _id, "sku": _id, "data": {"name": _id}, "data_hash": _id, "tx_status": "N", "pending": _id} for _id in "ABC"]
+
+
+def test_batchWriteItems_unprocessed():
+    # The unprocessed items are sent again on their own after a throttle.
+    dynamodb = FakeBatchDynamodb([["B"]])
+    productsDataSync = getBatchSync(dynamodb)
+    assert productsDataSync.batchWriteItems("stg_products", getBatchEntities()) == []
+    assert dynamodb.batches == [["A", "B", "C"], ["B"]]
+    assert dynamodb.puts == []
+    assert productsDataSync.writePool.stats()["throttles"] == 1
+    assert productsDataSync.metrics.counters == {"staged": 3, "failed": 0}
+
+
+def test_batchWriteItems_fallback():
+    # Out of retries, the unprocessed items are put one by one; one that fails is written as F and returned.
+    dynamodb = FakeBatchDynamodb([["B", "C"]] * 3, failing=["C"])
+    productsDataSync = getBatchSync(dynamodb)
+    failed = productsDataSync.batchWriteItems("stg_products", getBatchEntities(), maxRetries=2)
+    assert dynamodb.batches == [["A", "B", "C"], ["B", "C"], ["B", "C"]]
+    assert [(item["id"], item["tx_status"]) for item in dynamodb.puts] == [("B", "N"), ("C", "F")]
+    assert [entity["id"] for entity in failed] == ["C"]
+    assert "pending" not in dynamodb.puts[1]
+    assert productsDataSync.metrics.counters == {"staged": 2, "failed": 1}
+
+
+def getCheckpointChanges(skus):
+    return {
+        "rows": [{"sku": sku, "data": {"name": sku}} for sku in skus],
+        "hashes": dict((sku, ProductsDataSync.getDataHash({"name": sku})) for sku in skus),
+        "items": dict((sku, {"id": sku, "created_at": "2020-01-01 00:00:00"}) for sku in skus),
+        "removed": {},
+        "delta": True,
+        "fingerprint": "f"
+    }
+
+
+def test_checkpoint(monkeypatch, tmp_path):
+    # The changes of a loop read back as they were saved, the spilled rows from their SQLite file.
+    monkeypatch.setenv("SNAPSHOTDIR", str(tmp_path))
+    monkeypatch.delenv("SNAPSHOTBUCKET", raising=False)
+    productsDataSync = getSync()
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    rows = [{"sku": "B", "warehouse": "w1", "qty": "2"}, {"sku": "A", "warehouse": "w1", "qty": "1.5"}]
+    spilled, total = productsDataSync.getSpilledDataSet(iter(rows), ("sku", "warehouse"), productsDataSync.setInventory)
+    changes = [getCheckpointChanges(["A", "B"]), None, dict(getCheckpointChanges(["C"]), rows=spilled)]
+    productsDataSync.putCheckpoint(changes, run_id="r")
+    spilled.store.close()
+    checkpoint = productsDataSync.getCheckpoint(run_id="r")
+    try:
+        assert checkpoint[:2] == changes[:2]
+        assert dict((k, v) for k, v in checkpoint[2].items() if k != "rows") == \
+            dict((k, v) for k, v in changes[2].items() if k != "rows")
+        assert list(checkpoint[2]["rows"]) == [
+            {"sku": "A", "data": [{"store_id": 0, "warehouse": "w1", "on_hand": 0, "past_on_hand": 0, "qty": Decimal("1.5"),
+                                   "full": False, "in_stock": True}]},
+            {"sku": "B", "data": [{"store_id": 0, "warehouse": "w1", "on_hand": 0, "past_on_hand": 0, "qty": 2,
+                                   "full": False, "in_stock": True}]}
+        ]
+    finally:
+        checkpoint[2]["rows"].store.close()
+    assert productsDataSync.getCheckpoint(run_id="other") is None
+
+
+def test_dataSync_resume(monkeypatch, tmp_path):
+    # A continuation stages the rows after the saved offset only, with the failures of the loops before it.
+    monkeypatch.setenv("SNAPSHOTDIR", str(tmp_path))
+    monkeypatch.delenv("SNAPSHOTBUCKET", raising=False)
+    params = {
+        "source": "S", "data_type": "products", "table_name": "stg_products", "data_feed_url": "https://sheet/export",
+        "run_id": "r"
+    }
+    skus = ["A", "B", "C", "D", "E"]
+    parsed, staged = [], []
+    monkeypatch.setattr(
+        ProductsDataSync, "getTabChanges",
+        lambda self, tabs, offset=0: parsed.append(offset) or [getCheckpointChanges(skus)]
+    )
+    # A fails in the first loop.
+    monkeypatch.setattr(
+        ProductsDataSync, "_batchWriteItems",
+        lambda self, tableName, entities, maxRetries=5: staged.extend(e["sku"] for e in entities) or \
+            [e for e in entities if e["sku"] == "A"]
+    )
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: None))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    dataSync = ProductsDataSync.dataSync(**params)
+    assert [next(dataSync)[:2] for i in range(2)] == [(1, 5), (2, 5)]
+    # Handed off: the buffered writes are flushed and the checkpoint is saved.
+    dataSync.close()
+    assert staged == ["A", "B"]
+    staged[:] = []
+    assert [offset for offset, total, spendms in ProductsDataSync.dataSync(offset="2", **params)] == [3, 4, 5]
+    assert parsed == [0]
+    assert staged == ["C", "D", "E"]
+    snapshot = tasks.getSnapshotStore().get(getSync().getSnapshotKey(**params))
+    assert snapshot["fingerprint"] is None
+    assert [sku for sku, dataHash in sorted(snapshot["hashes"].items()) if dataHash is None] == ["A"]
+
+
+def test_getRows_xlsxSheetName():
+    # The workbook holds every tab, so a tab without its sheet_name is an error, not the first sheet.
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+    params = {"data_type": "products", "decode": "utf-8", "source": "S"}
+    productsDataSync = ProductsDataSync(**params)
+    with open(os.path.join(fixtures, "products.xlsx"), "rb") as f:
+        workbook = f.read()
+    try:
+        list(productsDataSync.getRows(workbook, export_format="xlsx", **params))
+        assert False, "A tab without sheet_name is read from the first sheet."
+    except AssertionError as e:
+        assert str(e) == "The xlsx export requires the sheet_name of the tab."
+
+
+def test_getTabs():
+    params = {"google_sheet_id": "s", "table_name": "stg_products", "source": "P", "data_type": "products"}
+    assert ProductsDataSync.getTabs(**params) == [params]
+    tabs = ProductsDataSync.getTabs(
+        tabs=[{"gid": "0"}, {"gid": "1", "data_type": "inventory", "source": "I"}], **params
+    )
+    assert tabs == [dict(params, gid="0"), dict(params, gid="1", data_type="inventory", source="I")]
+    try:
+        ProductsDataSync.getTabs(tabs=[{"gid": "0"}, {"gid": "1", "data_type": "inventory"}], **params)
+        assert False, "Two tabs staged on the same table and source are accepted."
+    except AssertionError as e:
+        assert str(e) == "Each tab requires its own table_name or source."
+
+
+def test_dataSync_tabs(monkeypatch):
+    # The tabs are fetched concurrently, staged through the same writer and synced to Magento 2 in one event.
+    exports = {
+        "https://sheet/products": b"sku,name\nA,Alpha\nB,Beta\n",
+        "https://sheet/inventory": b"sku,warehouse,qty\nA,w1,5\n"
+    }
+    params = {
+        "table_name": "stg_products", "decode": "utf-8",
+        "tabs": [
+            {"data_feed_url": "https://sheet/products", "data_type": "products", "source": "P"},
+            {"data_feed_url": "https://sheet/inventory", "data_type": "inventory", "source": "I"}
+        ]
+    }
+    monkeypatch.setattr(tasks.requests, "get", lambda url, stream=False: FakeResponse(exports[url]))
+    snapshotStore = FakeSnapshotStore()
+    monkeypatch.setattr(tasks, "getSnapshotStore", lambda: snapshotStore)
+    staged, events, writePools = [], [], set()
+    monkeypatch.setattr(
+        ProductsDataSync, "_batchWriteItems",
+        lambda self, tableName, entities, maxRetries=5: writePools.add(id(self.writePool)) or \
+            staged.extend((entity["source"], entity["sku"]) for entity in entities) or []
+    )
+    monkeypatch.setattr(ProductsDataSync, "invoke", classmethod(lambda cls, functionName, payload: events.append(payload)))
+    monkeypatch.setenv("SYNCPRODUCTSDATAMAGE2TASKARN", "arn")
+    class Sync(ProductsDataSync):
+        def __init__(self, **params):
+            super(Sync, self).__init__(**params)
+            self.dynamodb = FakeDynamodb(FakeStagingTable())
+    assert [offset for offset, total, spendms in Sync.dataSync(**params)] == [1, 2, 3]
+    assert sorted(staged) == [("I", "A"), ("P", "A"), ("P", "B")]
+    assert len(writePools) == 1
+    assert [event["data_types"] for event in events] == [params["tabs"]]
+    assert "tabs" not in events[0]
+    assert sorted(snapshotStore.snapshots.keys()) == sorted(getSync().getSnapshotKey(**tab) for tab in params["tabs"])
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+import threading, time, zlib, collections
+from conftest import loadTasks
+from metrics import Metrics
+
+tasks = loadTasks("syncproductsdatamage2")
+ProductsDataSyncMage2 = tasks.ProductsDataSyncMage2
+
+
+class FakeConnection(object):
+    def __init__(self, failing=()):
+        self.failing = failing
+
+    def getConnector(self, slot=None):
+        if slot in self.failing:
+            raise Exception("Can not connect writer {slot}.".format(slot=slot))
+        return object()
+
+
+class FakeSync(ProductsDataSyncMage2):
+    # The writer threads without Magento or DynamoDB: a page syncs in no time.
+    def __init__(self, mage2Workers, mage2Connection):
+        self.mage2Workers = mage2Workers
+        self.mage2Connection = mage2Connection
+
+    def syncPage(self, page):
+        return 0
+
+
+def getChains(skus):
+    lane = {"data_type": "products", "table_name": "stg_products", "source": "S"}
+    return [[(lane, {"id": sku, "sku": sku})] for sku in skus]
+
+
+def runPages(productsDataSync, chains, batchSize):
+    # Collected on a thread, so a hang fails the test instead of blocking it.
+    synced = []
+    thread = threading.Thread(
+        target=lambda: synced.extend(productsDataSync.iterPages(iter(chains), batchSize, threading.Event()))
+    )
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), "iterPages hangs."
+    return [chain[0][1]["sku"] for page, syncms in synced for chain in page]
+
+
+def test_iterPages():
+    skus = ["SKU-{i:03d}".format(i=i) for i in range(40)]
+    assert sorted(runPages(FakeSync(3, FakeConnection()), getChains(skus), 2)) == skus
+
+
+def test_iterPages_writerFails():
+    # Writer 0 can not connect: the feeder fills its partition and the others must not wait on it.
+    skus = ["SKU-{i:03d}".format(i=i) for i in range(200)]
+    synced = runPages(FakeSync(2, FakeConnection(failing=(0,))), getChains(skus), 1)
+    assert all(zlib.crc32(sku.encode("utf-8")) % 2 == 1 for sku in synced)
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.options = []
+
+
+class FakeCursor(object):
+    # Answers the metadata and option queries of BulkUpsert from the committed options only.
+    def __init__(self, connector):
+        self.connector = connector
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if "eav_entity_type t2" in sql:
+            self.rows = [
+                {"attribute_code": code, "attribute_id": 93, "entity_type_id": 4, "backend_type": "int", "frontend_input": "select"}
+                for code in params[:-1] if code == "color"
+            ]
+        elif "eav_attribute_option t1" in sql:
+            with self.connector.database.lock:
+                self.rows = [
+                    {"attribute_id": attributeId, "value": value, "option_id": optionId}
+                    for optionId, (attributeId, value) in enumerate(self.connector.database.options)
+                    if value in params
+                ]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeAdaptor(object):
+    def __init__(self, connector):
+        self.connector = connector
+        self.mySQLCursor = FakeCursor(connector)
+
+    def commit(self):
+        with self.connector.database.lock:
+            self.connector.database.options.extend(self.connector.pending)
+        self.connector.pending = []
+
+    def rollback(self):
+        self.connector.pending = []
+
+
+class FakeConnector(object):
+    setting = {"VERSION": "CE"}
+
+    def __init__(self, database):
+        self.database = database
+        self.pending = []
+        self.adaptor = FakeAdaptor(self)
+
+    def setAttributeOptionValues(self, attributeId, options, adminStoreId=0):
+        # Slow enough for the writers to overlap.
+        time.sleep(0.05)
+        self.pending.append((attributeId, options[0]))
+        return len(self.database.options) + len(self.pending)
+
+
+def test_createOptions():
+    # Writers of the same new option value: it is added once.
+    database = FakeDatabase()
+    lane = {"data_type": "products", "table_name": "stg_products", "source": "S", "txmap": {"color": {"key": "color"}}}
+    threads = []
+    for slot in range(4):
+        productsDataSync = FakeSync(4, FakeConnection())
+        productsDataSync.mage2Connector = FakeConnector(database)
+        page = [[(lane, {"id": "A", "sku": "A", "data": {"color": "Red"}})]]
+        threads.append(threading.Thread(target=productsDataSync.createOptions, args=(page,)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert database.options == [(93, "Red")]
+
+
+class FakeItemsTable(object):
+    # A staging table read through its sparse index in sku order, pageSize items per page.
+    def __init__(self, skus, source, pageSize=2):
+        self.items = [{"id": "{source}-{sku}".format(source=source, sku=sku), "sku": sku, "data": {}} for sku in skus]
+        self.source = source
+        self.pageSize = pageSize
+        self.queries = []
+
+    def query(self, IndexName, ExclusiveStartKey=None, **kwargs):
+        self.queries.append(dict(kwargs, IndexName=IndexName, ExclusiveStartKey=ExclusiveStartKey))
+        rangeKey = IndexName.split("_")[0]
+        items = [item for item in self.items if ExclusiveStartKey is None or item["sku"] > ExclusiveStartKey[rangeKey]]
+        page = items[:self.pageSize]
+        response = {"Items": page}
+        if len(items) > self.pageSize:
+            response["LastEvaluatedKey"] = {"id": page[-1]["id"], "source": self.source, rangeKey: page[-1]["sku"]}
+        return response
+
+
+class FakeRunsTable(object):
+    def __init__(self, runs):
+        self.runs = runs
+
+    def get_item(self, Key):
+        run = self.runs.get(Key["run_id"])
+        return {"Item": run} if run is not None else {}
+
+
+class FakeDynamodb(object):
+    def __init__(self, tables):
+        self.tables = tables
+
+    def Table(self, tableName):
+        return self.tables[tableName]
+
+
+DATATYPES = [
+    {"data_type": "products-inventory", "table_name": "stg_inventory", "source": "I"},
+    {"data_type": "products", "table_name": "stg_products", "source": "P"}
+]
+
+
+def getCursorSync(tables, retry=False, **params):
+    # The reading side of the sync on fake tables.
+    productsDataSync = ProductsDataSyncMage2.__new__(ProductsDataSyncMage2)
+    productsDataSync.dynamodb = FakeDynamodb(tables)
+    productsDataSync.lanes = ProductsDataSyncMage2.getLanes(data_types=DATATYPES, **params)
+    productsDataSync.retry = retry
+    productsDataSync.fetched = 0
+    productsDataSync.exhausted = {}
+    productsDataSync.read = collections.deque()
+    productsDataSync.done = set()
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    productsDataSync.cursor = productsDataSync.getCursor(**params)
+    return productsDataSync
+
+
+def getTables():
+    return {
+        "stg_inventory": FakeItemsTable(["A", "C", "D", "F"], "I"),
+        "stg_products": FakeItemsTable(["A", "B", "C", "E", "F"], "P")
+    }
+
+
+def test_iterChains():
+    # The lanes are merged across their pages in sku order; the product leads each chain whatever the lane order.
+    productsDataSync = getCursorSync(getTables())
+    chains = list(productsDataSync.iterChains())
+    assert [[(lane["data_type"], item["id"]) for lane, item in chain] for chain in chains] == [
+        [("products", "P-A"), ("inventory", "I-A")],
+        [("products", "P-B")],
+        [("products", "P-C"), ("inventory", "I-C")],
+        [("inventory", "I-D")],
+        [("products", "P-E")],
+        [("products", "P-F"), ("inventory", "I-F")]
+    ]
+    assert list(productsDataSync.read) == chains
+    assert productsDataSync.fetched == 9
+    assert productsDataSync.exhausted == {0: True, 1: True}
+
+
+def test_advanceCursor():
+    # The cursor only passes a sku once it and every sku read before it are written back.
+    productsDataSync = getCursorSync(getTables())
+    chains = dict((chain[0][1]["sku"], chain) for chain in productsDataSync.iterChains())
+    productsDataSync.done.update(["B", "C"])
+    productsDataSync.advanceCursor()
+    assert productsDataSync.cursor == {"sku": None, "keys": [None, None]}
+    productsDataSync.done.add("A")
+    productsDataSync.advanceCursor()
+    assert productsDataSync.cursor == {
+        "sku": "C",
+        "keys": [{"id": "I-C", "source": "I", "pending": "C"}, {"id": "P-C", "source": "P", "pending": "C"}]
+    }
+    # D is only in the inventory lane, so the products lane keeps its key.
+    productsDataSync.done.add("D")
+    productsDataSync.advanceCursor()
+    assert productsDataSync.cursor["keys"] == [
+        {"id": "I-D", "source": "I", "pending": "D"}, {"id": "P-C", "source": "P", "pending": "C"}
+    ]
+    assert [chain[0][1]["sku"] for chain in productsDataSync.read] == ["E", "F"]
+    assert productsDataSync.done == set()
+
+
+def test_getCursor():
+    cursor = {"sku": "C", "keys": [{"id": "I-C", "source": "I", "pending": "C"}, {"id": "P-C", "source": "P", "pending": "C"}]}
+    # From the hand-off payload, from the run recorded in stg_runs, or from the start.
+    assert getCursorSync(getTables(), cursor=cursor).cursor == cursor
+    tables = dict(getTables(), stg_runs=FakeRunsTable({"r": {"run_id": "r", "cursor": cursor}}))
+    assert getCursorSync(tables, run_id="r").cursor == cursor
+    assert getCursorSync(tables, run_id="new").cursor == {"sku": None, "keys": [None, None]}
+    try:
+        getCursorSync(getTables(), cursor={"sku": None, "keys": [None]})
+        assert False, "A cursor of other data_types is accepted."
+    except AssertionError as e:
+        assert str(e) == "The cursor does not match the data_types."
+
+
+def test_resume():
+    # A resumed lane is queried from its key and yields only the skus after it.
+    tables = getTables()
+    cursor = {"sku": "C", "keys": [{"id": "I-C", "source": "I", "pending": "C"}, {"id": "P-C", "source": "P", "pending": "C"}]}
+    productsDataSync = getCursorSync(tables, cursor=cursor)
+    assert [chain[0][1]["sku"] for chain in productsDataSync.iterChains()] == ["D", "E", "F"]
+    assert tables["stg_products"].queries[0]["ExclusiveStartKey"] == cursor["keys"][1]
+    # The retry lane reads failed_index, and its keys are on failed.
+    tables = getTables()
+    productsDataSync = getCursorSync(tables, retry=True)
+    chains = list(productsDataSync.iterChains())
+    productsDataSync.done.update(chain[0][1]["sku"] for chain in chains)
+    productsDataSync.advanceCursor()
+    assert tables["stg_products"].queries[0]["IndexName"] == "failed_index"
+    assert productsDataSync.cursor["keys"][1] == {"id": "P-F", "source": "P", "failed": "F"}
+
+
+def test_retry(monkeypatch):
+    # The flag comes as a string from the README events and the hand-off payloads.
+    monkeypatch.setattr(tasks, "getMage2Connection", lambda setting, logger=None: FakeConnection())
+    for value, retry in ((True, True), ("true", True), ("TRUE", True), ("false", False), ("0", False), (False, False)):
+        productsDataSync = ProductsDataSyncMage2(data_type="products", table_name="stg_products", source="S", retry=value)
+        productsDataSync.statusWriter.close()
+        assert productsDataSync.retry is retry
+    productsDataSync = ProductsDataSyncMage2(data_type="products", table_name="stg_products", source="S")
+    productsDataSync.statusWriter.close()
+    assert productsDataSync.retry is False
+
+
+class FakeProductConnector(object):
+    # The per-SKU writes of a Mage2Connector; the skus in failing raise.
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.products = []
+        self.extData = []
+
+    def syncProduct(self, sku, attributeSet, data, typeId, storeId):
+        if sku in self.failing:
+            raise Exception("Can not sync {sku}.".format(sku=sku))
+        self.products.append(sku)
+        return len(self.products)
+
+    def syncProductExtData(self, sku, dataType, data):
+        self.extData.append((sku, dataType))
+        return 1
+
+
+class FailingBulkUpsert(object):
+    def __init__(self, mage2Connector):
+        pass
+
+    def upsertProducts(self, products, attributeSet="Default"):
+        raise Exception("Deadlock found when trying to get lock.")
+
+
+def getPageSync(connector):
+    productsDataSync = ProductsDataSyncMage2.__new__(ProductsDataSyncMage2)
+    productsDataSync.mage2Connector = connector
+    productsDataSync.mage2Workers = 1
+    productsDataSync.maxAttempts = 5
+    productsDataSync.retryBackoff = 60
+    productsDataSync.metrics = Metrics(emit=lambda record: None)
+    return productsDataSync
+
+
+def getProductData(sku, **data):
+    return {"id": sku, "sku": sku, "data": dict({"name": sku}, **data)}
+
+
+def test_syncBatch_fallback(monkeypatch):
+    # A failed batch falls back to per-SKU writes, so only the bad product fails.
+    monkeypatch.setattr(tasks, "BulkUpsert", FailingBulkUpsert)
+    connector = FakeProductConnector(failing=("B",))
+    productsDataSync = getPageSync(connector)
+    batch = [getProductData(sku) for sku in ("A", "B", "C")]
+    productsDataSync.syncBatch(batch, txmap={"name": {"key": "name"}})
+    assert connector.products == ["A", "C"]
+    assert [productData["tx_status"] for productData in batch] == ["S", "F", "S"]
+    assert productsDataSync.metrics.counters == {"batch-fallback": 1, "synced": 2, "failed": 1}
+
+
+def test_syncPage_parentFails(monkeypatch):
+    # The children of a configurable that fails are skipped, not synced; those of a synced one follow it.
+    monkeypatch.setattr(tasks, "BulkUpsert", FailingBulkUpsert)
+    connector = FakeProductConnector(failing=("P",))
+    productsDataSync = getPageSync(connector)
+    productsDataSync.lanes = ProductsDataSyncMage2.getLanes(
+        txmap={"name": {"key": "name"}},
+        data_types=[
+            {"data_type": "products-inventory", "table_name": "stg_inventory", "source": "I"},
+            {"data_type": "products-variants", "table_name": "stg_variants", "source": "V"},
+            {"data_type": "products", "table_name": "stg_products", "source": "P"}
+        ]
+    )
+    inventory, variants, products = productsDataSync.lanes
+    page = [
+        [
+            (products, getProductData("P", type_id="configurable")),
+            (variants, {"id": "V-P", "sku": "P", "data": {"variants": []}}),
+            (inventory, {"id": "I-P", "sku": "P", "data": []})
+        ],
+        [
+            (products, getProductData("Q", type_id="configurable")),
+            (variants, {"id": "V-Q", "sku": "Q", "data": {"variants": []}}),
+            (inventory, {"id": "I-Q", "sku": "Q", "data": []})
+        ]
+    ]
+    productsDataSync.syncPage(page)
+    assert connector.products == ["Q"]
+    assert connector.extData == [("Q", "variants"), ("Q", "inventory")]
+    statuses = [(productData["id"], productData["tx_status"]) for chain in page for lane, productData in chain]
+    assert statuses == [("P", "F"), ("V-P", "F"), ("I-P", "F"), ("Q", "S"), ("V-Q", "S"), ("I-Q", "S")]
+    assert page[0][1][1]["tx_note"] == "STG->MAGE2: skipped, the product of the sku failed."
+    assert productsDataSync.metrics.counters["skipped"] == 2
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from timebudget import TimeBudget
+
+
+def test_shouldHandOff():
+    # The next item through every stage plus the reserve must fit in the remaining time.
+    timeBudget = TimeBudget(reserveMs=1000, minSamples=1)
+    for ms in [10] * 99 + [500]:
+        timeBudget.record({"sync": ms, "write": 5})
+    assert timeBudget.getEstimate("sync") == 500
+    assert timeBudget.getRequiredMs() == 1505
+    assert timeBudget.shouldHandOff(1505, pending=1)
+    assert not timeBudget.shouldHandOff(1506, pending=1)
+    # Nothing left, nothing to hand off.
+    assert not timeBudget.shouldHandOff(0, pending=0)
+
+
+def test_seeded():
+    # The estimates of the previous invocation hold until this one has enough samples of its own.
+    seeded = TimeBudget(estimates={"sync": [100, 800]}, reserveMs=0, minSamples=20)
+    seeded.record({"sync": 10})
+    assert seeded.getPercentile("sync") == 800
+    assert seeded.getRequiredMs() == 800
+    for i in range(19):
+        seeded.record({"sync": 10})
+    assert seeded.getPercentile("sync") == 10
+    # The ewma still remembers the seed.
+    assert seeded.getRequiredMs() == seeded.ewmas["sync"] > 10
+    assert TimeBudget(estimates=seeded.getEstimates()).seeds == {"sync": [round(seeded.ewmas["sync"]), 10.0]}
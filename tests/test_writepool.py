@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import threading
+from botocore.exceptions import ClientError
+from writepool import WritePool, WriteBuffer
+
+
+def getThrottle():
+    return ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "UpdateItem")
+
+
+def test_call_takesSlot():
+    # A direct call waits while the submitted writes hold every slot.
+    writePool = WritePool(maxWorkers=1)
+    release = threading.Event()
+    writePool.submit(release.wait)
+    called = threading.Event()
+    thread = threading.Thread(target=writePool.call, args=(called.set,))
+    thread.daemon = True
+    thread.start()
+    try:
+        assert not called.wait(0.2)
+    finally:
+        release.set()
+    thread.join(timeout=5)
+    assert called.is_set()
+    writePool.shutdown()
+
+
+def test_call_inSubmitted():
+    # A call inside a submitted write uses the slot of its task instead of waiting for another one.
+    writePool = WritePool(maxWorkers=1)
+    future = writePool.submit(writePool.call, lambda: "written")
+    assert future.result(timeout=5) == "written"
+    writePool.shutdown()
+
+
+def test_call_throttled():
+    # A throttle halves the concurrency and the write is retried by the pool.
+    writePool = WritePool(maxWorkers=8, baseDelay=0.001)
+    responses = [getThrottle(), getThrottle(), "written"]
+    def write():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    assert writePool.call(write) == "written"
+    stats = writePool.stats()
+    assert (stats["throttles"], stats["retries"], stats["writes"], stats["concurrency"]) == (2, 2, 1, 2)
+    writePool.shutdown()
+
+
+def test_writeBuffer_coalesces():
+    # A later write of the same key replaces the pending one; close writes whatever is left.
+    writes = []
+    writePool = WritePool(maxWorkers=2)
+    writeBuffer = WriteBuffer(writePool, lambda key, value: writes.append((key, value)), batchSize=100, intervalMs=60000)
+    writeBuffer.put("a", "a", 1)
+    writeBuffer.put("b", "b", 1)
+    writeBuffer.put("a", "a", 2)
+    assert writes == []
+    futures = writeBuffer.close()
+    assert len(futures) == 2
+    assert sorted(writes) == [("a", 2), ("b", 1)]
+    assert writeBuffer.stats() == {"puts": 3, "coalesced": 1, "batches": 1, "pending": 0}
+    writePool.shutdown()
+
+
+def test_writeBuffer_dispatches():
+    # A full batch is handed to the pool without waiting for the timer.
+    written = threading.Event()
+    writes = []
+    def write(key):
+        writes.append(key)
+        if len(writes) == 3:
+            written.set()
+    writePool = WritePool(maxWorkers=2)
+    writeBuffer = WriteBuffer(writePool, write, batchSize=3, intervalMs=60000)
+    for key in ("a", "b", "c"):
+        writeBuffer.put(key, key)
+    assert written.wait(5)
+    writeBuffer.close()
+    assert sorted(writes) == ["a", "b", "c"]
+    writePool.shutdown()
+
+
+def test_writeBuffer_flushes():
+    # A partial batch goes out on the timer.
+    written = threading.Event()
+    writePool = WritePool(maxWorkers=1)
+    writeBuffer = WriteBuffer(writePool, lambda key: written.set(), batchSize=100, intervalMs=50)
+    writeBuffer.put("a", "a")
+    assert written.wait(5)
+    writeBuffer.close()
+    writePool.shutdown()